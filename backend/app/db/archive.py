@@ -0,0 +1,330 @@
+'''
+Export and import of subjects with everything they reference: their documents (and the
+documents of other subjects they link as near-duplicates), compressed text bodies, page
+ranges still being parsed and quizzes. An archive is a gzip stream of BSON records, the
+same framing mongodump uses, so ObjectIds, dates and binary text blobs round-trip
+unchanged and nothing is re-encoded as JSON. Both directions stream: export reads with
+batched cursors and emits compressed chunks as they fill, import decodes chunk by chunk
+and writes with unordered bulk inserts, so neither holds a whole subject in memory.
+An import is spooled and checked from end to end before the first record is written, so a
+truncated or damaged archive writes nothing. Importing the same archive twice is harmless,
+records that already exist are skipped, so an import cut short by a database error is
+completed by running it again.
+
+    python -m app.db.archive export [--subject ID ...] [--user USER] -o FILE
+    python -m app.db.archive import FILE [--user USER]
+'''
+from app.db import database
+from app.db.database import Database
+from app.db.operations import bulk_insert
+from bson import ObjectId
+from bson.errors import InvalidBSON
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator, Dict, List
+import argparse
+import asyncio
+import bson
+import logging
+import os
+import tempfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Records read per cursor batch and written per bulk insert
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 500))
+# Compressed bytes buffered before a chunk is emitted
+ARCHIVE_CHUNK_BYTES = int(os.getenv("ARCHIVE_CHUNK_BYTES", 1024 * 1024))
+# Compressed bytes of an import kept in memory while it is checked; larger ones spill to disk
+ARCHIVE_SPOOL_BYTES = int(os.getenv("ARCHIVE_SPOOL_BYTES", 16 * 1024 * 1024))
+# Limits on an archive sent to the import route, in compressed bytes and records; 0 disables a limit
+ARCHIVE_IMPORT_MAX_BYTES = int(os.getenv("ARCHIVE_IMPORT_MAX_BYTES", 1024 * 1024 * 1024))
+ARCHIVE_IMPORT_MAX_RECORDS = int(os.getenv("ARCHIVE_IMPORT_MAX_RECORDS", 1000000))
+# A record holds one stored document, which MongoDB caps at 16 MiB, and its kind
+ARCHIVE_MAX_RECORD_BYTES = 16 * 1024 * 1024 + 1024
+ARCHIVE_FORMAT = "doc2quiz"
+ARCHIVE_VERSION = 1
+# gzip framing for zlib
+GZIP_WBITS = 31
+
+# Record kind -> collection attribute of Database. Import flushes in this order, so text
+# bodies land before the documents that reference them.
+COLLECTIONS = {
+    "text": "texts",
+    "page": "pages",
+    "document": "documents",
+    "subject": "subjects",
+    "quiz": "quizzes",
+}
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+class ArchiveTooLargeError(ArchiveError):
+    pass
+
+
+class _Writer:
+    '''
+    Encodes records and yields compressed chunks of about ARCHIVE_CHUNK_BYTES
+    '''
+    def __init__(self, chunk_bytes: int):
+        self.chunk_bytes = chunk_bytes
+        self.counts: Dict[str, int] = {kind: 0 for kind in COLLECTIONS}
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        self._pending: List[bytes] = []
+        self._size = 0
+
+    def write(self, kind: str, record: dict):
+        if kind in self.counts:
+            self.counts[kind] += 1
+        data = self._compressor.compress(bson.encode({"kind": kind, "data": record}))
+        if data:
+            self._pending.append(data)
+            self._size += len(data)
+
+    def take(self, final: bool = False) -> bytes | None:
+        if final:
+            self._pending.append(self._compressor.flush())
+        elif self._size < self.chunk_bytes:
+            return None
+        chunk = b"".join(self._pending)
+        self._pending, self._size = [], 0
+        return chunk
+
+
+def _subject_query(subject_ids: List[ObjectId] | None, user_id: str | None) -> dict:
+    query = {}
+    if subject_ids is not None:
+        query["_id"] = {"$in": subject_ids}
+    if user_id is not None:
+        query["user_id"] = user_id
+    return query
+
+
+async def export_archive(
+    db: Database,
+    subject_ids: List[ObjectId] | None = None,
+    user_id: str | None = None,
+    batch_size: int | None = None,
+    chunk_bytes: int | None = None,
+) -> AsyncIterator[bytes]:
+    '''
+    Compressed archive chunks for the given subjects, or a user's subjects, or every subject
+    '''
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    writer = _Writer(chunk_bytes or ARCHIVE_CHUNK_BYTES)
+    writer.write("header", {"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION, "exported_at": datetime.now()})
+
+    async def dump(kind: str, cursor) -> AsyncIterator[bytes]:
+        batch = []
+        async for record in cursor.batch_size(batch_size):
+            batch.append(record)
+            if len(batch) == batch_size:
+                async for chunk in emit(kind, batch):
+                    yield chunk
+                batch = []
+        if batch:
+            async for chunk in emit(kind, batch):
+                yield chunk
+
+    async def emit(kind: str, batch: List[dict]) -> AsyncIterator[bytes]:
+        if kind == "document":
+            # Bodies are copied compressed, as stored, ahead of the documents referencing them
+            text_ids = [document["text_ref"]["id"] for document in batch if document.get("text_ref")]
+            if text_ids:
+                async for chunk in dump("text", db.texts.find({"text_id": {"$in": text_ids}}).sort([("text_id", 1), ("n", 1)])):
+                    yield chunk
+            partial_ids = [document["_id"] for document in batch if document.get("metadata", {}).get("status") == "parsing"]
+            if partial_ids:
+                async for chunk in dump("page", db.pages.find({"document_id": {"$in": partial_ids}}).sort([("document_id", 1), ("start", 1)])):
+                    yield chunk
+        for record in batch:
+            writer.write(kind, record)
+            if (chunk := writer.take()) is not None:
+                yield chunk
+
+    subjects = db.subjects.find(_subject_query(subject_ids, user_id)).sort("_id", 1)
+    async for subject in subjects.batch_size(batch_size):
+        writer.write("subject", subject)
+        # Documents linked from other subjects go along, so the subject is complete on its own
+        linked = [ref["id"] for ref in subject.get("documents", [])]
+        documents = db.documents.find({"$or": [{"subject_id": subject["_id"]}, {"_id": {"$in": linked}}]}).sort("_id", 1)
+        async for chunk in dump("document", documents):
+            yield chunk
+        async for chunk in dump("quiz", db.quizzes.find({"subject_ids": subject["_id"]}).sort("_id", 1)):
+            yield chunk
+    writer.write("end", {"counts": dict(writer.counts)})
+    yield writer.take(final=True)
+
+
+async def _records(chunks: AsyncIterable[bytes]) -> AsyncIterator[dict]:
+    '''
+    Decompress archive chunks and decode the BSON records in them as they complete
+    '''
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    buffer = bytearray()
+    async for chunk in chunks:
+        try:
+            buffer += decompressor.decompress(chunk)
+        except zlib.error as e:
+            raise ArchiveError(f"Not a gzip archive: {e}")
+        offset = 0
+        while len(buffer) - offset >= 4:
+            size = int.from_bytes(buffer[offset:offset + 4], "little")
+            if size < 5 or size > ARCHIVE_MAX_RECORD_BYTES:
+                raise ArchiveError("Corrupt record length")
+            if len(buffer) - offset < size:
+                break
+            try:
+                yield bson.decode(bytes(buffer[offset:offset + size]))
+            except InvalidBSON as e:
+                raise ArchiveError(f"Corrupt record: {e}")
+            offset += size
+        del buffer[:offset]
+    if buffer or not decompressor.eof:
+        raise ArchiveError("The archive is truncated")
+
+
+async def _load(
+    records: AsyncIterator[dict],
+    db: Database | None,
+    user_id: str | None,
+    batch_size: int,
+    max_records: int = 0,
+) -> Dict[str, int]:
+    '''
+    Read the records of an archive, checking its header, record kinds and counts, and write
+    them batch_size at a time when db is given. Returns the number of records per kind.
+    '''
+    pending: Dict[str, List[dict]] = {kind: [] for kind in COLLECTIONS}
+    counts: Dict[str, int] = {kind: 0 for kind in COLLECTIONS}
+    buffered = 0
+    header = end = None
+
+    async def flush():
+        for kind, records in pending.items():
+            if records:
+                await bulk_insert(getattr(db, COLLECTIONS[kind]), records)
+                pending[kind] = []
+
+    async for record in records:
+        kind, data = record.get("kind"), record.get("data")
+        if not isinstance(data, dict):
+            raise ArchiveError(f"Record {kind!r} has no data")
+        if header is None:
+            if kind != "header" or data.get("format") != ARCHIVE_FORMAT:
+                raise ArchiveError("Not a subject archive")
+            if data.get("version", 0) > ARCHIVE_VERSION:
+                raise ArchiveError(f"Unsupported archive version {data['version']}")
+            header = data
+            continue
+        if kind == "end":
+            if not isinstance(data.get("counts"), dict):
+                raise ArchiveError("The end record has no counts")
+            end = data
+            continue
+        if kind not in COLLECTIONS:
+            raise ArchiveError(f"Unknown record kind {kind!r}")
+        counts[kind] += 1
+        if max_records and sum(counts.values()) > max_records:
+            raise ArchiveTooLargeError(f"The archive has more than {max_records} records")
+        if db is None:
+            continue
+        if kind == "subject" and user_id is not None:
+            data["user_id"] = user_id
+        pending[kind].append(data)
+        buffered += 1
+        if buffered >= batch_size:
+            await flush()
+            buffered = 0
+    if end is None:
+        raise ArchiveError("The archive is truncated")
+    if end["counts"] != counts:
+        raise ArchiveError(f"Expected {end['counts']} records, read {counts}")
+    if db is not None:
+        await flush()
+    return counts
+
+
+async def _spooled(spool, chunk_bytes: int) -> AsyncIterator[bytes]:
+    await asyncio.to_thread(spool.seek, 0)
+    while chunk := await asyncio.to_thread(spool.read, chunk_bytes):
+        yield chunk
+
+
+async def import_archive(
+    chunks: AsyncIterable[bytes],
+    db: Database,
+    user_id: str | None = None,
+    batch_size: int | None = None,
+    max_bytes: int = 0,
+    max_records: int = 0,
+) -> Dict[str, int]:
+    '''
+    Write the records of an archive, batch_size at a time. The archive is spooled and read
+    through once to check it, so nothing is written unless it is complete. Pass user_id to
+    give the imported subjects to another user. An archive of more than max_bytes
+    compressed bytes or max_records records raises ArchiveTooLargeError, as soon as it is
+    read that far; 0 allows any size. Returns the number of records read per kind.
+    '''
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES) as spool:
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise ArchiveTooLargeError(f"The archive is larger than {max_bytes} bytes")
+            await asyncio.to_thread(spool.write, chunk)
+        await _load(_records(_spooled(spool, ARCHIVE_CHUNK_BYTES)), None, user_id, batch_size, max_records)
+        return await _load(_records(_spooled(spool, ARCHIVE_CHUNK_BYTES)), db, user_id, batch_size)
+
+
+async def read_file(path: str, chunk_bytes: int | None = None) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, chunk_bytes or ARCHIVE_CHUNK_BYTES):
+            yield chunk
+
+
+async def write_file(path: str, chunks: AsyncIterable[bytes]) -> int:
+    size = 0
+    with open(path, "wb") as f:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+            size += len(chunk)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import subjects with their documents and quizzes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write subjects to an archive")
+    export.add_argument("--subject", action="append", dest="subjects", help="subject id, repeatable; default all")
+    export.add_argument("--user", help="only this user's subjects")
+    export.add_argument("-o", "--output", required=True)
+    export.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    load = commands.add_parser("import", help="load an archive")
+    load.add_argument("archive")
+    load.add_argument("--user", help="give the imported subjects to this user")
+    load.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        db = database.connect()
+        try:
+            if args.command == "export":
+                subject_ids = [ObjectId(subject) for subject in args.subjects] if args.subjects else None
+                size = await write_file(args.output, export_archive(db, subject_ids, args.user, args.batch_size))
+                return {"output": args.output, "bytes": size}
+            return await import_archive(read_file(args.archive), db, args.user, args.batch_size)
+        finally:
+            database.close()
+
+    print(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,235 @@
+'''
+The Mongo client and collections. The client is created by connect() from the app lifespan,
+so importing the app never opens connections, and each uvicorn worker process builds its
+own pool once, after it has started. Until then the module-level collections are None.
+'''
+from app.utils.metrics import METRICS_ENABLED, mongo_command_seconds, registry
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from pymongo.server_api import ServerApi
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict
 import os
+import threading
 
-MONGO_URI = os.getenv("MONGODB_URI")
-MONGODB_DATABASE = os.getenv("MONGODB_DATABASE")
-client = AsyncIOMotorClient(MONGO_URI, server_api=ServerApi('1'))
-db = client[MONGODB_DATABASE]
-documents_collection = db["documents"]
-subjects_collection = db["subjects"]
-quizzes_collection = db["quizzes"]
+MONGO_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "doc2quiz")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+# Connections kept open while idle, so bursts do not pay for new handshakes
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 0)) or None
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 10000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 0)) or None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 0)) or None
+# e.g. "majority" or "1"; empty keeps the server default
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "")
+MONGO_JOURNAL = os.getenv("MONGO_JOURNAL", "")
+# Wire compression, e.g. "zstd,zlib"; zstd needs the zstandard package
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
 
+client = None
+db = None
+documents_collection = None
+subjects_collection = None
+quizzes_collection = None
+parse_cache_collection = None
+jobs_collection = None
+texts_collection = None
+pages_collection = None
 
 
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    '''
+    Connection pool counters per server, fed by pymongo's monitoring events. Events
+    arrive on pymongo's threads, hence the lock.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
 
+    def _count(self, event, **changes):
+        address = "%s:%s" % event.address
+        with self._lock:
+            for name, change in changes.items():
+                self._servers[address][name] += change
 
+    def pool_created(self, event):
+        self._count(event, pools_created=1)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count(event, pools_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(event, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        self._count(event, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._count(event, waiting=-1, checkout_failed=1)
+
+    def connection_checked_out(self, event):
+        self._count(event, waiting=-1, in_use=1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._count(event, in_use=-1)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(counts) for address, counts in self._servers.items()}
+
+
+class CommandMetrics(monitoring.CommandListener):
+    '''
+    Latency of every Mongo command by command name and outcome
+    '''
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6, command=event.command_name, outcome="error")
+
+
+pool_metrics = PoolMetrics()
+command_metrics = CommandMetrics()
+
+
+def _pool_connections() -> dict:
+    return {
+        (server, state): counts.get(state, 0)
+        for server, counts in pool_metrics.snapshot().items()
+        for state in ["open", "in_use", "waiting"]
+    }
+
+
+registry.gauge("doc2quiz_mongo_pool_connections", "Mongo pool connections by server and state", ("server", "state")).set_function(_pool_connections)
+
+
+def client_options() -> Dict[str, Any]:
+    options = {
+        "server_api": ServerApi('1'),
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        # Command timing costs a callback per command, so it is only on with metrics
+        "event_listeners": [pool_metrics, command_metrics] if METRICS_ENABLED else [pool_metrics],
+    }
+    if MONGO_WRITE_CONCERN:
+        options["w"] = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    if MONGO_JOURNAL:
+        options["journal"] = MONGO_JOURNAL.lower() == "true"
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
+
+
+@dataclass
+class Database:
+    '''
+    The collections the app uses, handed to route handlers by get_database
+    '''
+    client: Any
+    db: Any
+    documents: Any
+    subjects: Any
+    quizzes: Any
+    parse_cache: Any
+    jobs: Any
+    texts: Any
+    pages: Any
+
+    @classmethod
+    def of(cls, database, mongo_client=None) -> "Database":
+        return cls(
+            client=mongo_client,
+            db=database,
+            documents=database["documents"],
+            subjects=database["subjects"],
+            quizzes=database["quizzes"],
+            parse_cache=database["parse_cache"],
+            jobs=database["jobs"],
+            texts=database["document_texts"],
+            pages=database["document_pages"],
+        )
+
+
+_database: Database | None = None
+
+
+def use(database, mongo_client=None) -> Database:
+    '''
+    Bind the module to an already created database, e.g. a Motor database or a test double
+    '''
+    global _database, client, db
+    global documents_collection, subjects_collection, quizzes_collection
+    global parse_cache_collection, jobs_collection, texts_collection, pages_collection
+    _database = Database.of(database, mongo_client)
+    client, db = mongo_client, database
+    documents_collection = _database.documents
+    subjects_collection = _database.subjects
+    quizzes_collection = _database.quizzes
+    parse_cache_collection = _database.parse_cache
+    jobs_collection = _database.jobs
+    texts_collection = _database.texts
+    pages_collection = _database.pages
+    return _database
+
+
+def connect(uri: str | None = None, name: str | None = None) -> Database:
+    '''
+    Create the client for this process. Motor connects lazily, so this returns
+    immediately and the pool fills on first use (or up to minPoolSize in the background).
+    '''
+    if _database is not None:
+        return _database
+    mongo_client = AsyncIOMotorClient(uri or MONGO_URI, **client_options())
+    return use(mongo_client[name or MONGODB_DATABASE], mongo_client)
+
+
+def close():
+    global _database, client, db
+    global documents_collection, subjects_collection, quizzes_collection
+    global parse_cache_collection, jobs_collection, texts_collection, pages_collection
+    if _database is not None and _database.client is not None:
+        _database.client.close()
+    _database = client = db = None
+    documents_collection = subjects_collection = quizzes_collection = None
+    parse_cache_collection = jobs_collection = texts_collection = pages_collection = None
+
+
+def get_database() -> Database:
+    '''
+    FastAPI dependency for the process's database
+    '''
+    if _database is None:
+        raise RuntimeError("The database is not connected; call database.connect() first")
+    return _database
+
+
+def pool_stats() -> Dict[str, Any]:
+    return {
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        "min_pool_size": MONGO_MIN_POOL_SIZE,
+        "servers": pool_metrics.snapshot(),
+    }
@@ -0,0 +1,72 @@
+'''
+Indexes the read and cleanup paths rely on, created at startup. create_indexes is a no-op
+for indexes that already exist, so this is safe to run on every start.
+'''
+from app.db import database
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from typing import Dict, List
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    # Listing a subject's documents in upload order, and deleting them all
+    "documents_collection": [
+        IndexModel([("subject_id", ASCENDING), ("_id", ASCENDING)], name="subject_id_id"),
+        # Near-duplicate candidates: LSH band keys within a user's (or subject's) documents
+        IndexModel(
+            [("metadata.fingerprint.scope", ASCENDING), ("metadata.fingerprint.bands", ASCENDING)],
+            name="fingerprint_lsh",
+            partialFilterExpression={"metadata.fingerprint": {"$exists": True}},
+        ),
+    ],
+    # Newest-first subject pages, overall and per user
+    "subjects_collection": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_id_created_at"),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+    ],
+    # Quizzes of a subject (cache invalidation) and quiz cache lookups
+    "quizzes_collection": [
+        IndexModel([("subject_ids", ASCENDING)], name="subject_ids"),
+        IndexModel(
+            [("metadata.cache_key", ASCENDING), ("created_at", DESCENDING)],
+            name="cache_key",
+            partialFilterExpression={"metadata.cache_key": {"$exists": True}},
+        ),
+    ],
+    # Mongo removes expired parse cache entries itself; eviction reads oldest-accessed first
+    "parse_cache_collection": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        IndexModel([("accessed_at", ASCENDING)], name="accessed_at"),
+    ],
+    # Compressed text bodies, read back in chunk order
+    "texts_collection": [
+        IndexModel([("text_id", ASCENDING), ("n", ASCENDING)], name="text_id_n", unique=True),
+    ],
+    # Page ranges of a document being parsed, read back in page order
+    "pages_collection": [
+        IndexModel([("document_id", ASCENDING), ("start", ASCENDING)], name="document_id_start", unique=True),
+    ],
+    "jobs_collection": [
+        IndexModel([("subject_id", ASCENDING)], name="subject_id"),
+    ],
+}
+
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    '''
+    Create the indexes in INDEXES. A collection that fails is logged and skipped, so a
+    missing permission never keeps the server from starting. Returns the index names
+    created per collection.
+    '''
+    created = {}
+    for attribute, indexes in INDEXES.items():
+        collection = getattr(database, attribute)
+        try:
+            created[attribute] = await collection.create_indexes(indexes)
+        except Exception:
+            logger.exception("Creating indexes on %s failed", attribute)
+    return created
@@ -0,0 +1,89 @@
+'''
+Move the inline ocr_text of existing documents above the inline threshold into compressed
+blob storage. Safe to interrupt and re-run: converted documents no longer match, and the
+blobs an interrupted run wrote for documents it did not convert are removed before those
+documents are converted again.
+
+    python -m app.db.migrate_text [--threshold BYTES] [--batch-size N] [--dry-run]
+'''
+from app.db import database
+from app.db.text_store import TEXT_INLINE_MAX_BYTES, needs_offload, store_texts
+import argparse
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate(threshold: int | None = None, batch_size: int = 100, dry_run: bool = False) -> dict:
+    '''
+    Convert documents in batches of batch_size. A document whose update fails keeps its
+    inline text and its new blob is deleted. With dry_run nothing is written and only
+    scanned, converted and bytes_before are counted.
+    '''
+    stats = {"scanned": 0, "converted": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    cursor = database.documents_collection.find(
+        {"ocr_text": {"$type": "string"}, "text_ref": {"$exists": False}}, {"ocr_text": 1}
+    ).batch_size(batch_size)
+
+    async def convert(document) -> bool:
+        try:
+            await database.documents_collection.update_one(
+                {"_id": document["_id"]}, {"$set": {"text_ref": document["text_ref"]}, "$unset": {"ocr_text": ""}}
+            )
+        except Exception:
+            logger.exception("Converting document %s failed", document["_id"])
+            await database.texts_collection.delete_many({"text_id": document["text_ref"]["id"]})
+            return False
+        return True
+
+    async def flush(batch):
+        if dry_run:
+            stored, converted = batch, [True] * len(batch)
+        else:
+            # An unconverted document has no text_ref, so any blob of it is left from an interrupted run
+            await database.texts_collection.delete_many({"document_id": {"$in": [document["_id"] for document in batch]}})
+            stored = await store_texts(batch, threshold)
+            converted = await asyncio.gather(*[convert(document) for document in stored])
+        for original, document, ok in zip(batch, stored, converted):
+            if not ok:
+                stats["failed"] += 1
+                continue
+            stats["converted"] += 1
+            stats["bytes_before"] += len(original["ocr_text"].encode("utf-8"))
+            stats["bytes_after"] += document["text_ref"]["stored_size"] if not dry_run else 0
+        logger.info("Converted %d documents", stats["converted"])
+
+    batch = []
+    async for document in cursor:
+        stats["scanned"] += 1
+        if needs_offload(document, threshold):
+            batch.append(document)
+        if len(batch) == batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move long inline document text to compressed storage")
+    parser.add_argument("--threshold", type=int, default=TEXT_INLINE_MAX_BYTES, help="inline size limit in bytes")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents that would move")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        database.connect()
+        try:
+            return await migrate(args.threshold, args.batch_size, args.dry_run)
+        finally:
+            database.close()
+
+    print(asyncio.run(run()))
+
+
+if __name__ == "__main__":
+    main()
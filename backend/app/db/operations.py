@@ -0,0 +1,49 @@
+'''
+Write helpers shared by the processing pipeline
+'''
+from app.db import database
+from pymongo import InsertOne
+from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout
+from typing import List
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+WRITE_RETRIES = int(os.getenv("MONGO_WRITE_RETRIES", 3))
+WRITE_RETRY_BACKOFF = float(os.getenv("MONGO_WRITE_RETRY_BACKOFF", 0.2))
+DUPLICATE_KEY = 11000
+
+
+async def bulk_insert(collection, documents: List[dict]):
+    '''
+    Insert documents into collection with one unordered bulk write, retrying transient
+    failures. Documents carry their own _id, so a retry that re-inserts an already written
+    document hits a duplicate key error, which counts as success.
+    '''
+    if not documents:
+        return
+    pending = documents
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            await collection.bulk_write([InsertOne(doc) for doc in pending], ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed = [error["index"] for error in errors if error.get("code") != DUPLICATE_KEY]
+            if not failed and not e.details.get("writeConcernErrors"):
+                return
+            if attempt == WRITE_RETRIES:
+                raise
+            # Only the documents that failed for another reason are sent again
+            pending = [pending[index] for index in failed] or pending
+        except (AutoReconnect, NetworkTimeout):
+            if attempt == WRITE_RETRIES:
+                raise
+        logger.warning("Retrying insert of %d documents (attempt %d)", len(pending), attempt + 1)
+        await asyncio.sleep(WRITE_RETRY_BACKOFF * 2 ** attempt)
+
+
+async def insert_documents(documents: List[dict], collection=None):
+    await bulk_insert(collection if collection is not None else database.documents_collection, documents)
@@ -0,0 +1,37 @@
+'''
+Text of the page ranges of a large document, saved as each range is parsed so the pages
+that are done can be read (and quizzed on) before the rest of the document is. A retried
+upload resumes from the ranges already saved. The rows are deleted once the whole
+document is stored. Each helper takes the pages collection of an injected Database, and
+falls back to pages_collection.
+'''
+from app.db import database
+from bson import ObjectId
+from datetime import datetime
+from typing import Dict, Tuple
+
+
+async def save_range(document_id: ObjectId, start: int, end: int, text: str, pages=None):
+    '''
+    Save the text of pages [start, end); saving a range again replaces it
+    '''
+    pages = pages if pages is not None else database.pages_collection
+    await pages.update_one(
+        {"document_id": document_id, "start": start},
+        {"$set": {"end": end, "text": text, "saved_at": datetime.now()}},
+        upsert=True,
+    )
+
+
+async def load_ranges(document_id: ObjectId, pages=None) -> Dict[Tuple[int, int], str]:
+    '''
+    The saved ranges of a document by (start, end), in page order
+    '''
+    pages = pages if pages is not None else database.pages_collection
+    cursor = pages.find({"document_id": document_id}, {"start": 1, "end": 1, "text": 1}).sort("start", 1)
+    return {(row["start"], row["end"]): row["text"] async for row in cursor}
+
+
+async def delete_ranges(document_id: ObjectId, pages=None):
+    pages = pages if pages is not None else database.pages_collection
+    await pages.delete_many({"document_id": document_id})
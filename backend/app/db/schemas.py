@@ -1,43 +1,108 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from pydantic import BaseModel, ConfigDict, Field, GetCoreSchemaHandler, GetJsonSchemaHandler
+from pydantic_core import core_schema
+from typing import Annotated, Any, ClassVar, List, Optional, Dict, get_args
 from bson import ObjectId
 import datetime
 from uuid import UUID, uuid4
 import uuid
 
+
+class _ObjectIdSchema:
+    '''
+    Core schema for ObjectId fields: ObjectId instances pass through untouched, 24-character
+    hex strings are converted. Python dumps keep the ObjectId for BSON, JSON dumps give the hex string.
+    '''
+    @staticmethod
+    def _from_str(value: str) -> ObjectId:
+        if not ObjectId.is_valid(value):
+            raise ValueError("Invalid ObjectId")
+        return ObjectId(value)
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: GetCoreSchemaHandler) -> core_schema.CoreSchema:
+        from_str = core_schema.chain_schema([core_schema.str_schema(), core_schema.no_info_plain_validator_function(cls._from_str)])
+        return core_schema.json_or_python_schema(
+            json_schema=from_str,
+            python_schema=core_schema.union_schema([core_schema.is_instance_schema(ObjectId), from_str]),
+            serialization=core_schema.plain_serializer_function_ser_schema(str, when_used="json"),
+        )
+
+    @classmethod
+    def __get_pydantic_json_schema__(cls, schema: core_schema.CoreSchema, handler: GetJsonSchemaHandler) -> dict:
+        return {"type": "string", "pattern": "^[0-9a-f]{24}$"}
+
+
+PyObjectId = Annotated[ObjectId, _ObjectIdSchema]
+
+
+class MongoModel(BaseModel):
+    '''
+    Base of the stored models. Fields are populated by name or by alias (id/_id).
+    '''
+    model_config = ConfigDict(validate_by_name=True, validate_by_alias=True)
+    # Field name -> stored key, and the fields that can hold nested models, per class
+    _mongo_keys: ClassVar[Dict[str, str]] = {}
+    _mongo_nested: ClassVar[List[str]] = []
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        cls._mongo_keys = {name: field.alias or name for name, field in cls.model_fields.items()}
+        cls._mongo_nested = [name for name, field in cls.model_fields.items() if _holds_models(field.annotation)]
+
+    def to_mongo(self) -> dict:
+        '''
+        The dict to insert, like model_dump(by_alias=True) but without pydantic's serializer:
+        field values are passed by reference (ocr_text and metadata are not copied) and only
+        nested models are converted. For models built by this process, on the write paths.
+        '''
+        keys = self._mongo_keys
+        stored = {keys[name]: value for name, value in self.__dict__.items()}
+        for name in self._mongo_nested:
+            stored[keys[name]] = _mongo_value(stored[keys[name]])
+        return stored
+
+
+def _holds_models(annotation) -> bool:
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return True
+    return any(_holds_models(arg) for arg in get_args(annotation))
+
+
+def _mongo_value(value):
+    if isinstance(value, MongoModel):
+        return value.to_mongo()
+    if isinstance(value, BaseModel):
+        return value.model_dump(by_alias=True)
+    if isinstance(value, list):
+        return [_mongo_value(item) for item in value]
+    return value
+
+
 # Document Schema
-class Document(BaseModel):
-    id: ObjectId = Field(default_factory=ObjectId, alias="_id")
-    subject_id: ObjectId
+class Document(MongoModel):
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
+    subject_id: PyObjectId
     filename: str
-    ocr_text: str
+    ocr_text: str  # long texts are stored compressed as a text_ref, see app/db/text_store.py
     uploaded_at: datetime.datetime
     metadata: dict
-    class Config:
-        arbitrary_types_allowed = True
-        allow_population_by_field_name = True
-        json_encoders = {ObjectId: str}
 
 # Document Reference Schema for denormalization
-class DocumentRef(BaseModel):
-    id: ObjectId
+class DocumentRef(MongoModel):
+    id: PyObjectId
     filename: str
-    class Config:
-        arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
+    # Content version of the document, see quiz_cache.document_version
+    version: str | None = None
 
 # Subject Schema
-class Subject(BaseModel):
-    id: ObjectId = Field(default_factory=ObjectId, alias="_id")
+class Subject(MongoModel):
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
     user_id: str | None = None
     name: str
     created_at: datetime.datetime
     documents: List[DocumentRef]  # Changed from document_ids to documents
     metadata: dict
-    class Config:
-        arbitrary_types_allowed = True
-        allow_population_by_field_name = True
-        json_encoders = {ObjectId: str}
 
 class Question(BaseModel):
     id: UUID = Field(default_factory=uuid.uuid4)
@@ -48,17 +113,39 @@ class Question(BaseModel):
     metadata: dict
 
 
-class Quiz(BaseModel):
-    id: ObjectId = Field(default_factory=ObjectId, alias="_id")
-    subject_ids: List[ObjectId]
+class Quiz(MongoModel):
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
+    subject_ids: List[PyObjectId]
     created_at: datetime.datetime
     updated_at: datetime.datetime
     status: str = Field(default="pending")
     score: float | None = None
     questions: List[Question]
     metadata: dict
-    class Config:
-        arbitrary_types_allowed = True
-        allow_population_by_field_name = True
-        json_encoders = {ObjectId: str}
 
+
+
+# Per-document progress within an upload job
+class DocumentStatus(MongoModel):
+    filename: str
+    state: str = Field(default="queued")  # queued, parsing, stored, linked, duplicate or failed
+    document_id: PyObjectId | None = None
+    error: str | None = None
+    staged_path: str | None = None  # kept until the document is stored, so failures can be retried
+    size: int = 0
+    timings: Dict[str, float] = Field(default_factory=dict)  # seconds spent in each stage
+
+
+# Upload job schema, one per POST /upload
+class UploadJob(MongoModel):
+    id: PyObjectId = Field(default_factory=ObjectId, alias="_id")
+    subject_id: PyObjectId
+    name: str
+    status: str = Field(default="queued")  # queued, running, done or failed
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+    started_at: datetime.datetime | None = None
+    finished_at: datetime.datetime | None = None
+    error: str | None = None
+    documents: List[DocumentStatus]
+    metadata: dict
@@ -0,0 +1,136 @@
+'''
+Storage for document text. Short texts stay inline in ocr_text; longer ones are
+compressed and written to a blob collection in chunks, and the document keeps only a
+text_ref. Readers get a TextHandle and only pay for the text they actually read.
+'''
+from app.db import database
+from bson import Binary, ObjectId
+from typing import List
+import asyncio
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is always available
+    zstandard = None
+
+# Texts up to this many UTF-8 bytes stay inline
+TEXT_INLINE_MAX_BYTES = int(os.getenv("TEXT_INLINE_MAX_BYTES", 16 * 1024))
+# Compressed bodies are split so no blob document nears the 16 MB BSON limit
+TEXT_BLOB_CHUNK_BYTES = int(os.getenv("TEXT_BLOB_CHUNK_BYTES", 4 * 1024 * 1024))
+TEXT_CODEC = os.getenv("TEXT_CODEC") or ("zstd" if zstandard else "zlib")
+
+
+def compress(data: bytes, codec: str = TEXT_CODEC) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    raise ValueError(f"Unknown text codec: {codec}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown text codec: {codec}")
+
+
+class TextHandle:
+    '''
+    The text of one stored document, loaded from the blob collection on first read
+    '''
+    def __init__(self, document: dict, texts=None):
+        self.document_id = document.get("_id")
+        self._text = document.get("ocr_text")
+        self.ref = document.get("text_ref")
+        self.texts = texts
+
+    @property
+    def size(self) -> int:
+        '''
+        Length of the text in UTF-8 bytes, known without loading it
+        '''
+        if self.ref is not None:
+            return self.ref["size"]
+        return len((self._text or "").encode("utf-8"))
+
+    @property
+    def loaded(self) -> bool:
+        return self._text is not None or self.ref is None
+
+    async def read(self) -> str:
+        if self._text is None and self.ref is not None:
+            texts = self.texts if self.texts is not None else database.texts_collection
+            cursor = texts.find({"text_id": self.ref["id"]}, {"data": 1}).sort("n", 1)
+            data = b"".join([bytes(chunk["data"]) async for chunk in cursor])
+            raw = await asyncio.to_thread(decompress, data, self.ref["codec"])
+            self._text = raw.decode("utf-8")
+        return self._text or ""
+
+
+async def load_texts(documents: List[dict], texts=None) -> List[dict]:
+    '''
+    Resolve ocr_text on documents read with a text_ref, in place
+    '''
+    for document in documents:
+        if document.get("text_ref") is not None:
+            document["ocr_text"] = await TextHandle(document, texts).read()
+            del document["text_ref"]
+    return documents
+
+
+def _offload(document: dict, codec: str) -> tuple[dict, List[dict]]:
+    raw = document["ocr_text"].encode("utf-8")
+    data = compress(raw, codec)
+    text_id = ObjectId()
+    blobs = [
+        {"text_id": text_id, "document_id": document["_id"], "n": n, "data": Binary(data[start:start + TEXT_BLOB_CHUNK_BYTES])}
+        for n, start in enumerate(range(0, max(len(data), 1), TEXT_BLOB_CHUNK_BYTES))
+    ]
+    stored = {key: value for key, value in document.items() if key != "ocr_text"}
+    stored["text_ref"] = {"id": text_id, "codec": codec, "size": len(raw), "stored_size": len(data), "chunks": len(blobs)}
+    return stored, blobs
+
+
+def needs_offload(document: dict, threshold: int | None = None) -> bool:
+    threshold = TEXT_INLINE_MAX_BYTES if threshold is None else threshold
+    text = document.get("ocr_text")
+    # Cheap check first: a str never has fewer UTF-8 bytes than characters
+    return isinstance(text, str) and (len(text) > threshold or len(text.encode("utf-8")) > threshold)
+
+
+async def store_texts(documents: List[dict], threshold: int | None = None, codec: str | None = None, texts=None) -> List[dict]:
+    '''
+    Prepare document dicts for insertion: texts above threshold are compressed into the
+    blob collection and replaced by a text_ref. Blobs are written first, so a stored
+    document never references a missing body. The input dicts are not modified.
+    '''
+    prepared, blobs = [], []
+    for document in documents:
+        if needs_offload(document, threshold):
+            stored, document_blobs = await asyncio.to_thread(_offload, document, codec or TEXT_CODEC)
+            prepared.append(stored)
+            blobs.extend(document_blobs)
+        else:
+            prepared.append(document)
+    if blobs:
+        texts = texts if texts is not None else database.texts_collection
+        await texts.insert_many(blobs, ordered=False)
+    return prepared
+
+
+async def delete_texts(document_ids: List, texts=None):
+    '''
+    Remove the blobs of documents that are being deleted or were never stored
+    '''
+    if not document_ids:
+        return
+    texts = texts if texts is not None else database.texts_collection
+    await texts.delete_many({"document_id": {"$in": list(document_ids)}})
@@ -0,0 +1,105 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel, Field
+from app.db.database import Database, get_database
+from app.db.schemas import Quiz
+from app.utils.accounts import job_quotas, job_tenant
+from app.utils.jobs import get_job_queue, QueueFullError, QuotaExceededError
+from app.utils.quiz_cache import get_quiz_cache, quiz_fingerprint
+from app.utils.quiz_generation import generate_quiz, generation_params
+from typing import List
+from datetime import datetime
+from bson import ObjectId
+import os
+
+router = APIRouter(prefix="/quizzes", tags=["quizzes"])
+
+# Scheduling cost of a quiz job per question, in the bytes uploads are costed in, so a
+# quiz takes its account's share of the workers like an upload of similar run time
+QUIZ_JOB_COST_PER_QUESTION = int(os.getenv("QUIZ_JOB_COST_PER_QUESTION", 1024 * 1024))
+
+class QuizRequest(BaseModel):
+    subject_ids: List[str] = Field(min_length=1)
+    num_questions: int = Field(default=10, ge=1, le=100)
+    refresh: bool = False  # generate a new quiz even if an identical one is cached
+    user_id: str | None = None
+
+def serialize_quiz(quiz: dict) -> dict:
+    return {
+        "quiz_id": str(quiz["_id"]),
+        "subject_ids": [str(subject_id) for subject_id in quiz["subject_ids"]],
+        "status": quiz["status"],
+        "created_at": quiz["created_at"].isoformat(),
+        "updated_at": quiz["updated_at"].isoformat(),
+        "score": quiz.get("score"),
+        "questions": quiz["questions"],
+        "metadata": {key: value for key, value in quiz.get("metadata", {}).items() if not isinstance(value, (ObjectId, datetime))},
+    }
+
+@router.post("")
+async def create_quiz(request: QuizRequest, http_request: Request, db: Database = Depends(get_database)):
+    '''
+    Create a pending quiz and queue its generation. Questions are appended to the quiz as
+    they are generated; poll GET /quizzes/{quiz_id} until status is ready.
+
+    A quiz already generated from the same documents with the same settings is returned
+    as is, with cached set, unless refresh is requested.
+    '''
+    if not all(ObjectId.is_valid(subject_id) for subject_id in request.subject_ids):
+        raise HTTPException(status_code=404, detail="Subject not found")
+    subject_ids = list(dict.fromkeys(ObjectId(subject_id) for subject_id in request.subject_ids))
+    # The refs carry their documents' content versions, so this is all the fingerprint needs
+    subjects = await db.subjects.find({"_id": {"$in": subject_ids}}, {"documents.id": 1, "documents.version": 1}).to_list(None)
+    if len(subjects) != len(subject_ids):
+        raise HTTPException(status_code=404, detail="Subject not found")
+
+    cache = get_quiz_cache()
+    cache_key = quiz_fingerprint(subjects, generation_params(request.num_questions))
+    if not request.refresh:
+        cached = await cache.lookup(cache_key, db.quizzes)
+        if cached is not None:
+            return {"quiz_id": str(cached["_id"]), "status": cached["status"], "cached": True}
+
+    time_now = datetime.now()
+    quiz = Quiz(
+        subject_ids=subject_ids,
+        created_at=time_now,
+        updated_at=time_now,
+        questions=[],
+        metadata={"num_questions": request.num_questions, "cache_key": cache_key}
+    )
+    await db.quizzes.insert_one(quiz.to_mongo())
+    try:
+        # Charged to the caller's account like an upload; model calls take far longer than
+        # their cost suggests, so quizzes never take the small-job lane
+        get_job_queue().submit(
+            generate_quiz, quiz.id, subject_ids, request.num_questions, cache_key=cache_key, db=db,
+            tenant=job_tenant(http_request, request.user_id),
+            cost=request.num_questions * QUIZ_JOB_COST_PER_QUESTION,
+            quotas=job_quotas(http_request, request.user_id),
+            small_lane=False,
+        )
+    except QuotaExceededError as e:
+        await db.quizzes.delete_one({"_id": quiz.id})
+        raise HTTPException(
+            status_code=429,
+            detail=f"{e}, try again once your uploads and quizzes finish",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except QueueFullError as e:
+        await db.quizzes.delete_one({"_id": quiz.id})
+        raise HTTPException(
+            status_code=503,
+            detail="Too many quizzes are being generated, try again later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    cache.pending(cache_key, quiz.id)
+    return {"quiz_id": str(quiz.id), "status": quiz.status, "cached": False}
+
+@router.get("/{quiz_id}")
+async def get_quiz(quiz_id: str, db: Database = Depends(get_database)):
+    if not ObjectId.is_valid(quiz_id):
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    quiz = await db.quizzes.find_one({"_id": ObjectId(quiz_id)})
+    if quiz is None:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    return serialize_quiz(quiz)
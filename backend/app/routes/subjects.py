@@ -0,0 +1,175 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.db.database import Database, get_database
+from app.db.text_store import load_texts
+from app.db.archive import (
+    ARCHIVE_IMPORT_MAX_BYTES,
+    ARCHIVE_IMPORT_MAX_RECORDS,
+    ArchiveError,
+    ArchiveTooLargeError,
+    export_archive,
+    import_archive,
+)
+from datetime import datetime
+from bson import ObjectId
+from typing import List
+import base64
+import json
+
+router = APIRouter(prefix="/subjects", tags=["subjects"])
+
+# Fields returned by the list endpoints. ocr_text is only read when asked for, so a page
+# of documents costs the same however large the documents are; the binary duplicate
+# fingerprint is never returned.
+SUBJECT_FIELDS = {"name": 1, "user_id": 1, "created_at": 1, "metadata": 1}
+DOCUMENT_FIELDS = {"ocr_text": 0, "text_ref": 0, "metadata.fingerprint": 0}
+DOCUMENT_TEXT_FIELDS = {"metadata.fingerprint": 0}
+
+def _encode_cursor(values: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _serialize(item: dict) -> dict:
+    '''
+    Make a stored dict JSON-ready in one pass. The list endpoints return it in a
+    JSONResponse, so FastAPI does not walk (and copy) every document again, text included.
+    '''
+    serialized = {}
+    for key, value in item.items():
+        if isinstance(value, ObjectId):
+            value = str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, dict):
+            value = _serialize(value)
+        serialized["id" if key == "_id" else key] = value
+    return serialized
+
+@router.get("")
+async def list_subjects(
+    user_id: str | None = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: str | None = None,
+    db: Database = Depends(get_database),
+):
+    '''
+    Subjects, newest first. Pass next_cursor from a response to get the following page;
+    keyset pagination keeps every page an index range scan however deep it is.
+    '''
+    query = {} if user_id is None else {"user_id": user_id}
+    if cursor:
+        after = _decode_cursor(cursor)
+        try:
+            created_at, last_id = datetime.fromisoformat(after["created_at"]), ObjectId(after["id"])
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}},
+        ]
+    subjects = await (
+        db.subjects.find(query, SUBJECT_FIELDS)
+        .sort([("created_at", -1), ("_id", -1)])
+        .limit(limit + 1)
+        .to_list(None)
+    )
+    next_cursor = None
+    if len(subjects) > limit:
+        subjects = subjects[:limit]
+        last = subjects[-1]
+        next_cursor = _encode_cursor({"created_at": last["created_at"].isoformat(), "id": str(last["_id"])})
+    return JSONResponse({"subjects": [_serialize(subject) for subject in subjects], "next_cursor": next_cursor})
+
+@router.get("/{subject_id}/documents")
+async def list_subject_documents(
+    subject_id: str,
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: str | None = None,
+    include_text: bool = False,
+    db: Database = Depends(get_database),
+):
+    '''
+    Documents of a subject in upload order, without their text unless include_text is set.
+    Documents linked from other subjects as near-duplicates are listed too.
+    '''
+    if not ObjectId.is_valid(subject_id):
+        raise HTTPException(status_code=404, detail="Subject not found")
+    subject_id = ObjectId(subject_id)
+    subject = await db.subjects.find_one({"_id": subject_id}, {"documents.id": 1})
+    if subject is None:
+        raise HTTPException(status_code=404, detail="Subject not found")
+
+    query = {"$or": [{"subject_id": subject_id}, {"_id": {"$in": [ref["id"] for ref in subject.get("documents", [])]}}]}
+    if cursor:
+        after = _decode_cursor(cursor)
+        if not isinstance(after, dict) or not ObjectId.is_valid(after.get("id")):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["_id"] = {"$gt": ObjectId(after["id"])}
+    fields = DOCUMENT_TEXT_FIELDS if include_text else DOCUMENT_FIELDS
+    documents = await (
+        db.documents.find(query, fields)
+        .sort("_id", 1)
+        .limit(limit + 1)
+        .to_list(None)
+    )
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = _encode_cursor({"id": str(documents[-1]["_id"])})
+    if include_text:
+        await load_texts(documents)
+    return JSONResponse({"documents": [_serialize(document) for document in documents], "next_cursor": next_cursor})
+
+@router.get("/export")
+async def export_subjects(
+    subject_id: List[str] | None = Query(default=None),
+    user_id: str | None = None,
+    db: Database = Depends(get_database),
+):
+    '''
+    Stream a gzip archive of the given subjects (repeat subject_id), or of a user's subjects,
+    with their documents, text and quizzes. See app/db/archive.py for the format. Exporting
+    every subject is left to the command line.
+    '''
+    if subject_id is None and user_id is None:
+        raise HTTPException(status_code=400, detail="Pass subject_id or user_id")
+    subject_ids = None
+    if subject_id is not None:
+        if not all(ObjectId.is_valid(value) for value in subject_id):
+            raise HTTPException(status_code=404, detail="Subject not found")
+        subject_ids = list(dict.fromkeys(ObjectId(value) for value in subject_id))
+        if await db.subjects.count_documents({"_id": {"$in": subject_ids}}) != len(subject_ids):
+            raise HTTPException(status_code=404, detail="Subject not found")
+    return StreamingResponse(
+        export_archive(db, subject_ids, user_id),
+        media_type="application/gzip",
+        headers={"Content-Disposition": 'attachment; filename="subjects.bson.gz"'},
+    )
+
+@router.post("/import")
+async def import_subjects(request: Request, user_id: str | None = None, db: Database = Depends(get_database)):
+    '''
+    Load an archive sent as the request body, as it arrives. Pass user_id to give the
+    subjects to another user. Records that already exist are left as they are. A damaged
+    archive is rejected before anything is written, and so is one over
+    ARCHIVE_IMPORT_MAX_BYTES or ARCHIVE_IMPORT_MAX_RECORDS.
+    '''
+    length = request.headers.get("content-length", "")
+    if ARCHIVE_IMPORT_MAX_BYTES and length.isdigit() and int(length) > ARCHIVE_IMPORT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"The archive is larger than {ARCHIVE_IMPORT_MAX_BYTES} bytes")
+    try:
+        counts = await import_archive(
+            request.stream(), db, user_id,
+            max_bytes=ARCHIVE_IMPORT_MAX_BYTES,
+            max_records=ARCHIVE_IMPORT_MAX_RECORDS,
+        )
+    except ArchiveTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ArchiveError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "Subjects imported", "counts": counts}
@@ -1,113 +1,593 @@
-from fastapi import APIRouter, UploadFile, File, BackgroundTasks, Form
-from app.db.database import documents_collection, subjects_collection
+from fastapi import APIRouter, Depends, Request, UploadFile, File, Form, HTTPException
+from fastapi.responses import StreamingResponse
+from app.db.database import Database, get_database
 from app.db.schemas import Subject, Document, DocumentRef
-from app.utils.ocr import parse_document
-from typing import List
+from app.utils.ocr import parse_document, parse_documents, PARSER_SETTINGS
+from app.utils.parse_cache import get_parse_cache
+from app.utils.staging import StagedFile, stage_uploads, release_all
+from app.utils.jobs import get_job_queue, QueueFullError, QuotaExceededError
+from app.utils.accounts import job_quotas, job_tenant
+from app.utils.extract import LocalExtraction, PageRun, count_pages, extract_text, split_missing_pages
+from app.utils.normalize import normalize_file_async, normalize_text_async
+from app.utils.upload_jobs import JobTracker, StageTimer, TERMINAL_STATES, get_job, serialize_job, listen
+from app.db.operations import insert_documents
+from app.db.text_store import delete_texts, load_texts, store_texts
+from app.db.page_store import delete_ranges, load_ranges, save_range
+from app.utils.vector_index import index_documents
+from app.utils.quiz_cache import document_version, get_quiz_cache
+from app.utils.dedupe import Deduper
+from typing import Dict, List
 import asyncio
 from datetime import datetime
 from bson import ObjectId
-import tempfile
+import json
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/upload", tags=["upload"])
 
+TEXT_EXTENSIONS = ['.txt', '.md']
+# Non-text files sent to the parser in one batched job
+PARSE_BATCH_SIZE = int(os.getenv("PARSE_BATCH_SIZE", 10))
+# How often an event stream re-reads the job when no local update wakes it
+JOB_EVENTS_POLL_INTERVAL = float(os.getenv("JOB_EVENTS_POLL_INTERVAL", 1.0))
+
+def _quota_exceeded(e: QuotaExceededError) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"{e}, try again once your uploads finish",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def _queue_full(e: QueueFullError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Too many uploads are being processed, try again later",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+async def _count_pages(staged_files: List[StagedFile]) -> int:
+    return await asyncio.to_thread(lambda: sum(count_pages(staged.path, staged.ext) for staged in staged_files))
+
 @router.post("")
-async def upload_documents(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...), name: str = Form(...)):
-    # Read all file contents first
-    file_contents = []
-    for file in files:
-        content = await file.read()
-        file_contents.append((file.filename, content))
-    
-    background_tasks.add_task(process_subject, file_contents, name)
-    return {"message": "Documents uploaded successfully"}
+async def upload_documents(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    name: str = Form(...),
+    user_id: str | None = Form(None),
+    db: Database = Depends(get_database),
+):
+    queue = get_job_queue()
+    quotas = job_quotas(request, user_id)
+    # An account already at its job limit is turned away before anything is staged
+    try:
+        queue.check_quota(quotas)
+    except QuotaExceededError as e:
+        raise _quota_exceeded(e)
+    # Stream each file to the staging area in chunks instead of reading it into memory
+    with StageTimer("stage_upload"):
+        staged_files = await stage_uploads(files)
+    cost = sum(staged.size for staged in staged_files)
+    pages = await _count_pages(staged_files) if any(quota.pages for quota in quotas.values()) else 0
+    try:
+        queue.check_quota(quotas, cost, pages)
+    except QuotaExceededError as e:
+        release_all(staged_files)
+        raise _quota_exceeded(e)
+    job = await JobTracker.create(name, staged_files, jobs=db.jobs)
+
+    try:
+        # Uploads are queued per account, weighted by their size
+        queue.submit(
+            process_subject, staged_files, name, job=job, user_id=user_id, db=db,
+            tenant=job_tenant(request, user_id), cost=cost, pages=pages, quotas=quotas,
+        )
+    except (QueueFullError, QuotaExceededError) as e:
+        release_all(staged_files)
+        await job.discard()
+        raise _quota_exceeded(e) if isinstance(e, QuotaExceededError) else _queue_full(e)
+    return {
+        "message": "Documents uploaded successfully",
+        "job_id": str(job.job_id),
+        "subject_id": str(job.subject_id),
+    }
 
-async def process_subject(file_contents: List[tuple[str, bytes]], name: str):
+async def _find_job(job_id: str, db: Database) -> dict:
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = await get_job(ObjectId(job_id), db.jobs)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/{job_id}")
+async def get_upload_job(job_id: str, db: Database = Depends(get_database)):
     '''
-    Process a subject by extracting text from each file and creating a list of documents, all in parallel. 
+    Current state of an upload job, with per-document state and stage timings
     '''
-    time_now = datetime.now()
-    subject_id = ObjectId()
-    # Create subject with empty document_ids list
+    return serialize_job(await _find_job(job_id, db))
+
+@router.get("/{job_id}/events")
+async def upload_job_events(job_id: str, db: Database = Depends(get_database)):
+    '''
+    Server-sent events stream that emits the job each time it changes, ending once the job is done or failed
+    '''
+    job = await _find_job(job_id, db)
+
+    async def events():
+        current = job
+        last_update = None
+        async with listen(current["_id"]) as changed:
+            while True:
+                if current["updated_at"] != last_update:
+                    last_update = current["updated_at"]
+                    yield f"data: {json.dumps(serialize_job(current))}\n\n"
+                if current["status"] in TERMINAL_STATES:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), JOB_EVENTS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+                current = await get_job(current["_id"], db.jobs) or current
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/{job_id}/retry")
+async def retry_upload_job(request: Request, job_id: str, db: Database = Depends(get_database)):
+    '''
+    Queue the failed documents of a finished upload job for another attempt
+    '''
+    job = await _find_job(job_id, db)
+    if job["status"] not in TERMINAL_STATES:
+        raise HTTPException(status_code=409, detail="Job is still running")
+    retryable = [
+        document for document in job["documents"]
+        if document["state"] == "failed" and document.get("staged_path") and os.path.exists(document["staged_path"])
+    ]
+    if not retryable:
+        raise HTTPException(status_code=409, detail="Job has no failed documents that can be retried")
+
+    subject = await db.subjects.find_one({"_id": job["subject_id"]}, {"user_id": 1}) or {}
+    quotas = job_quotas(request, subject.get("user_id"))
+    # Only one of several concurrent retries may move the job out of its finished state
+    result = await db.jobs.update_one(
+        {"_id": job["_id"], "status": {"$in": list(TERMINAL_STATES)}}, {"$set": {"status": "queued"}},
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="Job is still running")
     try:
-        # Process all documents in parallel
-        documents = await asyncio.gather(
-            *[process_document(filename, content, time_now, subject_id) for filename, content in file_contents]
+        get_job_queue().submit(
+            retry_failed_documents, job["_id"], db=db,
+            tenant=job_tenant(request, subject.get("user_id")),
+            cost=sum(document.get("size", 0) for document in retryable),
+            quotas=quotas,
         )
-        
-        # Create DocumentRef objects for each document
-        document_refs = [
-            DocumentRef(id=doc.id, filename=doc.filename)
-            for doc in documents
-        ]
-
-        # Convert documents to dictionaries before inserting
-        documents_dict = [doc.model_dump(by_alias=True) for doc in documents]
-        await documents_collection.insert_many(documents_dict)
-        
-        # Create subject document with document refs
-        subject = Subject(
-            _id=subject_id,
-            name=name,
-            created_at=time_now,
-            documents=document_refs,  # Using the new document refs
-            metadata={}
+    except (QueueFullError, QuotaExceededError) as e:
+        await db.jobs.update_one({"_id": job["_id"], "status": "queued"}, {"$set": {"status": job["status"]}})
+        raise _quota_exceeded(e) if isinstance(e, QuotaExceededError) else _queue_full(e)
+    return {"message": "Retry queued", "job_id": job_id, "documents": len(retryable)}
+
+def _batch_items(items: List[tuple], size: int) -> List[List[tuple]]:
+    '''
+    Group OCR work items so each batch sends at most size files to the parser. An item
+    is never split, so every batch fully resolves the documents in it.
+    '''
+    batches, current, count = [], [], 0
+    for item in items:
+        sources = item[2]
+        if current and count + len(sources) > size:
+            batches.append(current)
+            current, count = [], 0
+        current.append(item)
+        count += len(sources)
+    if current:
+        batches.append(current)
+    return batches
+
+async def _parse_ranges(path: str, extraction: LocalExtraction, subject_id: ObjectId, parsed: Dict[tuple, str], on_range) -> List[str]:
+    '''
+    OCR the page ranges of a split PDF concurrently. Each range holds its own slot of the
+    global and per-subject limits, so a large book shares the job's budget range by range
+    instead of holding one slot for the whole file, and early ranges are queued first.
+    Ranges already in parsed, keyed by (start, end), are not sent again. on_range(run, text)
+    is awaited as each range arrives; the texts of all ranges are returned in page order.
+    A range's PDF is only built once its slot is free and is dropped once it is parsed, so
+    at most one range per slot is held in memory.
+    '''
+    limiter = get_job_queue().limiter
+    runs = extraction.missing_runs()
+    pending = [run for run in runs if (run.start, run.end) not in parsed]
+
+    async def parse(run: PageRun):
+        async with limiter.slot(subject_id):
+            buffer = (await split_missing_pages(path, extraction, [run]))[0]
+            try:
+                text = await get_parse_cache().parse(buffer, parse_document, PARSER_SETTINGS)
+            finally:
+                buffer.close()
+        parsed[(run.start, run.end)] = text
+        await on_range(run, text)
+
+    # Every range settles before an error is raised, so the ones that worked are kept
+    results = await asyncio.gather(*[parse(run) for run in pending], return_exceptions=True)
+    error = next((result for result in results if isinstance(result, Exception)), None)
+    if error is not None:
+        raise error
+    return [parsed[(run.start, run.end)] for run in runs]
+
+async def _extract_and_parse(files: List[tuple[int, StagedFile]], subject_id: ObjectId, on_ready, on_split=None):
+    '''
+    Produce the text of every non-text file and hand it to on_ready as soon as it exists.
+    Text layers are extracted locally and stored right away; files without any usable text
+    go to the parser whole, and PDFs with some image-only pages only send those pages, as
+    in-memory PDFs.
+    OCR runs in batches of PARSE_BATCH_SIZE files, each batch holding one slot of the global
+    and per-subject concurrency limits, and each batch's documents are stored together.
+    on_ready receives a list of (index, staged file, text or exception, whether the text
+    is markdown, stage timings): parser output is, text layers extracted locally are not.
+    Large PDFs split into page ranges go to on_split(index, staged file, extraction, timings)
+    instead, which parses and stores them range by range.
+    '''
+    limiter = get_job_queue().limiter
+    # (index, staged file, paths or buffers to OCR, local extraction or None, timings)
+    ocr_items = []
+    split = []
+
+    async def extract(index: int, staged: StagedFile):
+        timings = {}
+        try:
+            with StageTimer("extract") as timer:
+                extraction = await extract_text(staged.path, staged.ext)
+            timings["extract"] = timer.elapsed
+            if extraction is None:
+                ocr_items.append((index, staged, [staged.path], None, timings))
+            elif extraction.complete:
+                await on_ready([(index, staged, extraction.merge([]), False, timings)])
+            elif extraction.split and on_split is not None:
+                split.append((index, staged, extraction, timings))
+            else:
+                page_runs = await split_missing_pages(staged.path, extraction)
+                ocr_items.append((index, staged, page_runs, extraction, timings))
+        except Exception as e:
+            await on_ready([(index, staged, e, False, timings)])
+
+    await asyncio.gather(*[extract(index, staged) for index, staged in files])
+
+    async def parse_batch(batch: List[tuple]):
+        sources = [source for item in batch for source in item[2]]
+        timer = StageTimer("parse")
+        try:
+            async with limiter.slot(subject_id):
+                with timer:
+                    results = await get_parse_cache().parse_many(sources, parse_documents, PARSER_SETTINGS, return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(sources)
+        texts = dict(zip(sources, results))
+
+        ready = []
+        for index, staged, item_sources, extraction, timings in batch:
+            timings["parse"] = timer.elapsed
+            item_results = [texts[source] for source in item_sources]
+            error = next((result for result in item_results if isinstance(result, Exception)), None)
+            if error is not None:
+                ready.append((index, staged, error, False, timings))
+            elif extraction is None:
+                ready.append((index, staged, item_results[0], True, timings))
+            else:
+                ready.append((index, staged, extraction.merge(item_results), True, timings))
+        await on_ready(ready)
+
+    await asyncio.gather(
+        *[parse_batch(batch) for batch in _batch_items(ocr_items, PARSE_BATCH_SIZE)],
+        *[on_split(*item) for item in split],
+    )
+
+async def process_subject(staged_files: List[StagedFile], name: str, job: JobTracker | None = None, user_id: str | None = None, db: Database | None = None):
+    '''
+    Process a subject by extracting text from each file and storing each document as soon as its text is ready.
+    The subject is created up front and gains a document reference as each document lands.
+    Progress is recorded on the upload job, which is created here when the caller has none.
+    This runs on the job queue outside the request, so the route hands over its injected
+    Database, which every write of the pipeline goes through.
+    '''
+    db = db or get_database()
+    time_now = datetime.now()
+    if job is None:
+        job = await JobTracker.create(name, staged_files, subject_id=ObjectId(), jobs=db.jobs)
+    subject = Subject(
+        _id=job.subject_id,
+        user_id=user_id,
+        name=name,
+        created_at=time_now,
+        documents=[],
+        metadata={"status": "processing"}
+    )
+    await db.subjects.insert_one(subject.to_mongo())
+    await job.started()
+    return await process_files(list(enumerate(staged_files)), job, time_now, db)
+
+async def process_files(files: List[tuple[int, StagedFile]], job: JobTracker, time_now: datetime, db: Database | None = None):
+    '''
+    Run (index, staged file) pairs of an upload job through the pipeline, in parallel.
+    Stored files are released; files that fail stay staged so a retry can pick them up,
+    but no longer count against the staging budget.
+    One document failing no longer discards the others. Near-duplicates of documents the
+    user already has are linked or dropped instead of stored again. Large PDFs are stored
+    as they are parsed, range by range, see store_split.
+    '''
+    db = db or get_database()
+    subject_id = job.subject_id
+    limiter = get_job_queue().limiter
+    subject = await db.subjects.find_one({"_id": subject_id}, {"user_id": 1})
+    deduper = Deduper(subject_id, (subject or {}).get("user_id"), documents=db.documents)
+    await job.document_state([index for index, _ in files], "parsing")
+
+    async def build(index: int, staged: StagedFile, text, markdown: bool):
+        if isinstance(text, Exception):
+            raise text
+        async with limiter.slot(subject_id):
+            with StageTimer("document"):
+                return await process_document(staged.filename, staged.path, time_now, subject_id, ocr_text=text, markdown=markdown)
+
+    async def store(ready: List[tuple]):
+        '''
+        Write a group of documents whose text is ready with one unordered bulk write
+        '''
+        built = await asyncio.gather(*[build(index, staged, text, markdown) for index, staged, text, markdown, _ in ready], return_exceptions=True)
+        stored = []
+        for (index, staged, _, _, timings), document in zip(ready, built):
+            if isinstance(document, Exception):
+                logger.warning("Processing %s failed: %s", staged.filename, document)
+                await job.document_state([index], "failed", timings, error=str(document))
+                staged.unreserve()
+            else:
+                stored.append((index, staged, timings, document))
+        if not stored:
+            return
+        dumped = [document.to_mongo() for _, _, _, document in stored]
+        try:
+            with StageTimer("dedupe"):
+                matches = await deduper.check(dumped)
+        except Exception:
+            logger.exception("Duplicate detection for subject %s failed", subject_id)
+            matches = [None] * len(stored)
+        new = [(item, document) for item, document, match in zip(stored, dumped, matches) if match is None]
+        duplicates = [(item, match) for item, match in zip(stored, matches) if match is not None]
+        linked = [(item, match) for item, match in duplicates if deduper.links(match)]
+        try:
+            with StageTimer("store") as store_timer:
+                await insert_documents(await store_texts([document for _, document in new], texts=db.texts), db.documents)
+                refs = [DocumentRef(id=document["_id"], filename=document["filename"]).to_mongo() for _, document in new]
+                refs += [DocumentRef(id=match.document_id, filename=staged.filename).to_mongo() for (_, staged, _, _), match in linked]
+                if refs:
+                    await db.subjects.update_one({"_id": subject_id}, {"$push": {"documents": {"$each": refs}}})
+        except Exception as e:
+            logger.exception("Storing documents for subject %s failed", subject_id)
+            new_ids = [document["_id"] for _, document in new]
+            # Whatever part of the group was written goes again: a retry would otherwise find
+            # the unreferenced documents as duplicates of its own and drop them
+            try:
+                await db.documents.delete_many({"_id": {"$in": new_ids}})
+                await delete_texts(new_ids, db.texts)
+                await db.subjects.update_one({"_id": subject_id}, {"$pull": {"documents": {"id": {"$in": new_ids}}}})
+            except Exception:
+                logger.exception("Removing the partly stored documents of subject %s failed", subject_id)
+            deduper.forget(new_ids)
+            for index, staged, timings, _ in stored:
+                await job.document_state([index], "failed", timings, error=str(e))
+                staged.unreserve()
+            return
+        deduper.stored([document["_id"] for _, document in new])
+        # Chunk and embed the new documents for quiz retrieval; a failure here leaves them stored.
+        # Linked documents are indexed from their stored text, so quizzes on this subject cover them.
+        index_timer = StageTimer("index")
+        try:
+            with index_timer:
+                originals = await load_linked([match.document_id for _, match in linked], db)
+                await index_documents(subject_id, [document for _, document in new] + originals)
+        except Exception:
+            logger.exception("Indexing documents for subject %s failed", subject_id)
+        # Quizzes cached for the subject were generated from its old documents
+        if new or linked:
+            try:
+                await get_quiz_cache().invalidate_subject(subject_id, db.quizzes)
+            except Exception:
+                logger.exception("Invalidating cached quizzes for subject %s failed", subject_id)
+        for (index, staged, timings, _), document in new:
+            await job.document_state(
+                [index], "stored", {**timings, "store": store_timer.elapsed, "index": index_timer.elapsed},
+                document_id=document["_id"], error=None, staged_path=None
+            )
+            staged.release()
+        for (index, staged, timings, _), match in duplicates:
+            # A copy of a document of this job is only dropped once that original is stored
+            if not await deduper.original_stored(match):
+                await job.document_state([index], "failed", timings, error="The document it duplicates could not be stored")
+                staged.unreserve()
+                continue
+            logger.info("%s duplicates document %s (similarity %.2f)", staged.filename, match.document_id, match.similarity)
+            await job.document_state(
+                [index], "linked" if deduper.links(match) else "duplicate", timings,
+                document_id=match.document_id, error=None, staged_path=None
+            )
+            staged.release()
+
+    async def store_split(index: int, staged: StagedFile, extraction: LocalExtraction, timings: Dict[str, float]):
+        '''
+        Store a large PDF while it is parsed. The document is created up front with empty
+        text and referenced from the subject; each page range is saved to the page store and
+        indexed as soon as its text exists, so quizzes can use the first chapters while the
+        rest is still parsing. Once every range is in, the text is assembled in page order
+        and the document completed. A failed document keeps its saved ranges, and a retry
+        only parses the ranges that are missing.
+        '''
+        document_id = None
+        try:
+            record = await get_job(job.job_id, job.jobs)
+            document_id = record["documents"][index].get("document_id")
+            resumed = document_id is not None and await db.documents.find_one(
+                {"_id": document_id, "metadata.status": "parsing"}, {"_id": 1}
+            )
+            if resumed:
+                parsed = await load_ranges(document_id, db.pages)
+            else:
+                document_id, parsed = ObjectId(), {}
+                partial = Document(
+                    _id=document_id,
+                    subject_id=subject_id,
+                    filename=staged.filename,
+                    ocr_text="",
+                    uploaded_at=time_now,
+                    metadata={"status": "parsing", "pages": len(extraction.pages)},
+                )
+                await insert_documents([partial.to_mongo()], db.documents)
+                ref = DocumentRef(id=document_id, filename=staged.filename, version=document_version(partial.to_mongo())).to_mongo()
+                await db.subjects.update_one({"_id": subject_id}, {"$push": {"documents": ref}})
+                await get_quiz_cache().invalidate_subject(subject_id, db.quizzes)
+            pages_parsed = sum(end - start for start, end in parsed)
+            await job.document_state([index], "parsing", document_id=document_id, pages=len(extraction.pages), pages_parsed=pages_parsed)
+
+            async def save(run: PageRun, text: str, markdown: bool = True):
+                nonlocal pages_parsed
+                normalized = await normalize_text_async(text, markdown)
+                await save_range(document_id, run.start, run.end, normalized.text, db.pages)
+                try:
+                    await index_documents(subject_id, [{"_id": document_id, "filename": staged.filename, "ocr_text": normalized.text}])
+                except Exception:
+                    logger.exception("Indexing pages %d-%d of %s failed", run.start, run.end, staged.filename)
+                pages_parsed += run.end - run.start
+                # Part of the document's content version, so quizzes over fewer pages stop matching
+                await _set_ref_version(db, document_id, document_version({"metadata": {"status": "parsing", "pages_parsed": pages_parsed}}))
+                await job.document_state([index], "parsing", pages_parsed=pages_parsed)
+
+            # Pages with a text layer are saved right away, then the rest as the parser returns them
+            for run in extraction.text_runs():
+                if (run.start, run.end) not in parsed:
+                    parsed[(run.start, run.end)] = extraction.text_of(run)
+                    await save(run, parsed[(run.start, run.end)], markdown=False)
+            with StageTimer("parse") as parse_timer:
+                ocr_texts = await _parse_ranges(staged.path, extraction, subject_id, parsed, save)
+            timings["parse"] = parse_timer.elapsed
+
+            with StageTimer("document"):
+                document = await process_document(
+                    staged.filename, staged.path, time_now, subject_id, ocr_text=extraction.merge(ocr_texts), document_id=document_id
+                )
+            dumped = document.to_mongo()
+            try:
+                # Only fingerprinted, for later uploads: the document is already referenced and indexed
+                await deduper.check([dumped])
+            except Exception:
+                logger.exception("Fingerprinting %s failed", staged.filename)
+            with StageTimer("store") as store_timer:
+                stored = (await store_texts([dumped], texts=db.texts))[0]
+                await db.documents.replace_one({"_id": document_id}, stored)
+                await _set_ref_version(db, document_id, None)
+                await delete_ranges(document_id, db.pages)
+            deduper.stored([document_id])
+            await get_quiz_cache().invalidate_subject(subject_id, db.quizzes)
+        except Exception as e:
+            logger.warning("Processing %s failed: %s", staged.filename, e)
+            if document_id is not None:
+                deduper.forget([document_id])
+            await job.document_state([index], "failed", timings, error=str(e))
+            staged.unreserve()
+            return
+        await job.document_state(
+            [index], "stored", {**timings, "store": store_timer.elapsed},
+            document_id=document_id, error=None, staged_path=None
         )
-        await subjects_collection.insert_one(subject.model_dump(by_alias=True))
-        return {"message": "Subject uploaded successfully"}
-        
-    except Exception as e:
-        # In case of failure, attempt to cleanup
-        await documents_collection.delete_many({"subject_id": subject_id})
-        await subjects_collection.delete_one({"_id": subject_id})
-        raise e
+        staged.release()
+
+    text_files = [(index, staged) for index, staged in files if staged.ext in TEXT_EXTENSIONS]
+    parse_files = [(index, staged) for index, staged in files if staged.ext not in TEXT_EXTENSIONS]
+    await asyncio.gather(
+        store([(index, staged, None, True, {}) for index, staged in text_files]),
+        _extract_and_parse(parse_files, subject_id, store, store_split),
+    )
+
+    # The outcome covers the whole job, including documents stored by earlier attempts
+    states = [document["state"] for document in (await get_job(job.job_id, job.jobs))["documents"]]
+    failed = states.count("failed")
+    status = "ready" if not failed else "failed" if failed == len(states) else "partial"
+    await db.subjects.update_one({"_id": subject_id}, {"$set": {"metadata.status": status}})
+    await job.finished(error=RuntimeError(f"{failed} of {len(states)} documents failed") if failed else None)
+    return {"message": "Subject uploaded successfully" if not failed else f"Subject uploaded with {failed} failed documents"}
+
+async def _set_ref_version(db: Database, document_id: ObjectId, version: str | None):
+    '''
+    Record a document's content version on the refs to it; complete documents have none
+    '''
+    await db.subjects.update_many({"documents.id": document_id}, {"$set": {"documents.$.version": version}})
+
+async def load_linked(document_ids: List[ObjectId], db: Database) -> List[dict]:
+    '''
+    Stored documents referenced by a subject other than their own, with their text
+    '''
+    if not document_ids:
+        return []
+    cursor = db.documents.find({"_id": {"$in": document_ids}}, {"filename": 1, "ocr_text": 1, "text_ref": 1})
+    return await load_texts([document async for document in cursor], db.texts)
 
-async def process_document(filename: str, content: bytes, time_now: datetime, subject_id: ObjectId) -> Document:
+async def retry_failed_documents(job_id: ObjectId, db: Database | None = None):
+    '''
+    Re-process only the failed documents of an upload job, using their retained staged files
+    '''
+    db = db or get_database()
+    record = await get_job(job_id, db.jobs)
+    job = JobTracker(record["_id"], record["subject_id"], [document["filename"] for document in record["documents"]], db.jobs)
+    files = [
+        # Their bytes went back to the staging budget when they failed
+        (index, StagedFile(filename=document["filename"], path=document["staged_path"], size=document.get("size", 0), reserved=False))
+        for index, document in enumerate(record["documents"])
+        if document["state"] == "failed" and document.get("staged_path") and os.path.exists(document["staged_path"])
+    ]
+    await job.started()
+    return await process_files(files, job, record["created_at"], db)
+
+async def process_document(
+    filename: str,
+    path: str,
+    time_now: datetime,
+    subject_id: ObjectId,
+    ocr_text: str | None = None,
+    document_id: ObjectId | None = None,
+    markdown: bool = True,
+) -> Document:
     '''
     Process a document by extracting text from the image and creating a document object.
-    If the file is a text or markdown file, return its contents directly.
+    Text and markdown files are decoded and normalized off the event loop instead.
+    The file is read from its staged path, so non-text files go to the parser without another copy.
+    Pass ocr_text when the file was already parsed as part of a batch, with markdown=False
+    when it is a text layer extracted locally rather than parser output.
+    Parsed text is normalized too, and the detected encoding and language go in metadata.
+    Pass document_id to complete a document that was stored while it was being parsed.
     '''
     # Get file extension
     _, ext = os.path.splitext(filename)
     ext = ext.lower()
 
-    # For text and markdown files, return content directly
-    if ext in ['.txt', '.md']:
-        try:
-            text = content.decode('utf-8')
-        except UnicodeDecodeError:
-            # Fallback to a more lenient encoding if UTF-8 fails
-            text = content.decode('latin-1')
-        
-        document = Document(
-            _id=ObjectId(),
-            subject_id=subject_id,
-            filename=filename,
-            ocr_text=text,
-            uploaded_at=time_now,
-            metadata={}
-        )
-        return document
-
-    # For other files, use LlamaParse
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-        # Write the contents to the temporary file
-        tmp_file.write(content)
-        tmp_file.flush()
-        
-        try:
-            # Process with LlamaParse
-            text = await parse_document(tmp_file.name)
-            
-            document = Document(
-                _id=ObjectId(),
-                subject_id=subject_id,
-                filename=filename,
-                ocr_text=text,
-                uploaded_at=time_now,
-                metadata={}
-            )
-            return document
-        finally:
-            # Clean up the temporary file
-            os.unlink(tmp_file.name)
\ No newline at end of file
+    if ext in TEXT_EXTENSIONS:
+        with StageTimer("normalize"):
+            normalized = await normalize_file_async(path, markdown=ext == ".md")
+    else:
+        # For other files, hand the staged file straight to LlamaParse unless the same bytes were parsed before
+        text = ocr_text
+        if text is None:
+            text = await get_parse_cache().parse(path, parse_document, PARSER_SETTINGS)
+        # Parser output is markdown, a locally extracted text layer is not
+        with StageTimer("normalize"):
+            normalized = await normalize_text_async(text, markdown)
+
+    document = Document(
+        _id=document_id or ObjectId(),
+        subject_id=subject_id,
+        filename=filename,
+        ocr_text=normalized.text,
+        uploaded_at=time_now,
+        metadata=normalized.document_metadata()
+    )
+    return document
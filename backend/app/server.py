@@ -1,12 +1,75 @@
-from fastapi import FastAPI, APIRouter
-from .routes import upload
+from fastapi import FastAPI, APIRouter, Request
+from fastapi.responses import PlainTextResponse
+from contextlib import asynccontextmanager
+from .routes import upload, quizzes, subjects
+from .db import database
+from .db.indexes import ensure_indexes, MONGO_ENSURE_INDEXES
+from .utils.ocr import preload_parser, stop_parser_service
+from .utils.jobs import get_job_queue, stop_job_queue
+from .utils.extract import shutdown_executor
+from .utils.staging import sweep_periodically, sweep_staging_area
+from .utils import metrics
+import asyncio
 import uvicorn
 import os
-app = FastAPI()
+import time
+
+PARSER_PRELOAD = os.getenv("PARSER_PRELOAD", "true").lower() == "true"
+# Send pipeline spans to OpenTelemetry; needs opentelemetry-api and a configured SDK
+METRICS_OTEL = os.getenv("METRICS_OTEL", "false").lower() == "true"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One Mongo client and one parser client with pooled connections for the life of the worker;
+    # the parser service is created on first use and its library imported in the background
+    database.connect()
+    if METRICS_OTEL:
+        metrics.add_span_hook(metrics.opentelemetry_hook())
+    preload_task = asyncio.create_task(asyncio.to_thread(preload_parser)) if PARSER_PRELOAD else None
+    # Built in the background so startup never waits on the database
+    index_task = asyncio.create_task(ensure_indexes()) if MONGO_ENSURE_INDEXES else None
+    await asyncio.to_thread(sweep_staging_area)
+    # Files of failed documents nobody retries are swept while the server runs, not only at startup
+    sweep_task = asyncio.create_task(sweep_periodically())
+    # Document processing runs on queue workers, not inside request handlers
+    get_job_queue().start()
+    yield
+    await stop_job_queue()
+    await stop_parser_service()
+    shutdown_executor()
+    for task in [index_task, preload_task, sweep_task]:
+        if task is not None:
+            task.cancel()
+    database.close()
+
+app = FastAPI(lifespan=lifespan)
+
+if metrics.METRICS_ENABLED:
+    @app.middleware("http")
+    async def time_requests(request: Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        # The route template keeps label cardinality bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - start, method=request.method, route=route, status=response.status_code
+        )
+        return response
+
 app.include_router(upload.router, prefix="/api")
+app.include_router(quizzes.router, prefix="/api")
+app.include_router(subjects.router, prefix="/api")
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "mongo_pool": database.pool_stats()}
+
 def run_server():
     uvicorn.run("app.server:app", host="0.0.0.0", port=8000, reload=os.getenv("FASTAPI_DEV_MODE", False))
\ No newline at end of file
@@ -0,0 +1,56 @@
+'''
+The accounts background jobs are scheduled and limited by. Each job is charged to its
+client address and to its user or, without one, the shared anonymous account. It is
+queued as one tenant per account: the user's, or its client address's.
+'''
+from app.utils.jobs import Quota
+from fastapi import Request
+from typing import Dict
+import os
+
+# Limits on the jobs queued or running, per account; 0 disables a limit.
+# Per client address, so sending a new user_id with every request does not get around them
+CLIENT_QUOTA = Quota(
+    jobs=int(os.getenv("UPLOAD_CLIENT_MAX_JOBS", 50)),
+    bytes=int(os.getenv("UPLOAD_CLIENT_MAX_BYTES", 2 * 1024 * 1024 * 1024)),
+    pages=int(os.getenv("UPLOAD_CLIENT_MAX_PAGES", 20000)),
+)
+# Per user_id, for clients that send one
+USER_QUOTA = Quota(
+    jobs=int(os.getenv("UPLOAD_USER_MAX_JOBS", 10)),
+    bytes=int(os.getenv("UPLOAD_USER_MAX_BYTES", 1024 * 1024 * 1024)),
+    pages=int(os.getenv("UPLOAD_USER_MAX_PAGES", 10000)),
+)
+# All requests without a user_id together, which is every request of the web client
+ANONYMOUS_ACCOUNT = "anonymous"
+ANONYMOUS_QUOTA = Quota(
+    jobs=int(os.getenv("UPLOAD_ANONYMOUS_MAX_JOBS", 100)),
+    bytes=int(os.getenv("UPLOAD_ANONYMOUS_MAX_BYTES", 4 * 1024 * 1024 * 1024)),
+    pages=int(os.getenv("UPLOAD_ANONYMOUS_MAX_PAGES", 100000)),
+)
+
+
+def client_account(request: Request) -> str:
+    return f"client:{request.client.host if request.client else 'unknown'}"
+
+
+def job_quotas(request: Request, user_id: str | None) -> Dict[str, Quota]:
+    '''
+    The quota accounts a job counts against: its client address, and its user or,
+    without one, the shared anonymous account
+    '''
+    quotas = {client_account(request): CLIENT_QUOTA}
+    if user_id:
+        quotas[f"user:{user_id}"] = USER_QUOTA
+    else:
+        quotas[ANONYMOUS_ACCOUNT] = ANONYMOUS_QUOTA
+    return quotas
+
+
+def job_tenant(request: Request, user_id: str | None) -> str:
+    '''
+    The tenant a job is scheduled as: its user, or its client address without one, so
+    every upload of an account shares that account's share of the workers and running
+    limit, and weights can be given per account, e.g. "user:alice=2"
+    '''
+    return f"user:{user_id}" if user_id else client_account(request)
@@ -0,0 +1,261 @@
+'''
+Near-duplicate detection for document text. Each document gets a MinHash signature over
+its word shingles, computed with numpy, and LSH band keys; both are kept in
+metadata.fingerprint and the band keys are indexed per user, so a re-upload of the same
+notes (renamed or lightly edited) is found with one indexed query.
+'''
+from app.db import database
+from bson import Binary, ObjectId
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional
+import asyncio
+import hashlib
+import logging
+import numpy as np
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# link: a copy of a document in another of the user's subjects is referenced instead of
+# stored again; skip: it is dropped; off: no detection. Copies within a subject are always dropped.
+DEDUPE_MODE = os.getenv("DEDUPE_MODE", "link")
+# Estimated Jaccard similarity of the shingle sets from which a document counts as a copy
+DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", 0.85))
+DEDUPE_SHINGLE_WORDS = int(os.getenv("DEDUPE_SHINGLE_WORDS", 5))
+# Shorter documents are cheap to keep and too generic to compare
+DEDUPE_MIN_WORDS = int(os.getenv("DEDUPE_MIN_WORDS", 50))
+
+NUM_PERM = 128
+# 16 bands of 8 rows: documents with similarity ~0.7 and up collide in at least one band
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_BLOCK = 4096
+MAX_CANDIDATES = 50
+
+_WORD = re.compile(r"\w+")
+_PRIME = np.uint64(1099511628211)
+_rng = np.random.default_rng(20240601)
+# Multiply-shift hash family; odd multipliers keep each one a bijection on 64-bit ints
+_A = _rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+
+
+class DuplicateMatch(NamedTuple):
+    document_id: ObjectId
+    subject_id: ObjectId
+    similarity: float
+
+
+@dataclass
+class Fingerprint:
+    signature: np.ndarray  # NUM_PERM uint32 minimums
+    bands: List[int]
+    content_hash: str
+    words: int
+
+    def similarity(self, other: "Fingerprint") -> float:
+        if self.content_hash == other.content_hash:
+            return 1.0
+        return float(np.mean(self.signature == other.signature))
+
+    def to_metadata(self, scope: str) -> dict:
+        return {
+            "scope": scope,
+            "bands": self.bands,
+            "minhash": Binary(self.signature.astype("<u4").tobytes()),
+            "content_hash": self.content_hash,
+            "words": self.words,
+        }
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> "Fingerprint":
+        return cls(
+            signature=np.frombuffer(bytes(metadata["minhash"]), dtype="<u4"),
+            bands=list(metadata["bands"]),
+            content_hash=metadata["content_hash"],
+            words=metadata["words"],
+        )
+
+
+def _token_hashes(tokens: List[str]) -> np.ndarray:
+    # Each distinct word is hashed once, then looked up for every occurrence
+    vocab: Dict[str, int] = {}
+    ids = np.fromiter((vocab.setdefault(token, len(vocab)) for token in tokens), dtype=np.int64, count=len(tokens))
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little") for token in vocab),
+        dtype=np.uint64,
+        count=len(vocab),
+    )
+    return hashes[ids]
+
+
+def shingle_hashes(tokens: List[str], size: int = DEDUPE_SHINGLE_WORDS) -> np.ndarray:
+    '''
+    Distinct 64-bit hashes of every run of size consecutive words
+    '''
+    words = _token_hashes(tokens)
+    count = max(1, len(words) - size + 1)
+    shingles = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for offset in range(min(size, len(words))):
+            shingles = shingles * _PRIME + words[offset:offset + count]
+    return np.unique(shingles)
+
+
+def minhash(shingles: np.ndarray) -> np.ndarray:
+    signature = np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        # Blocks keep the shingles x permutations matrix small for long documents
+        for start in range(0, len(shingles), SHINGLE_BLOCK):
+            block = shingles[start:start + SHINGLE_BLOCK, None]
+            np.minimum(signature, ((block * _A + _B) >> np.uint64(32)).min(axis=0), out=signature)
+    return signature.astype(np.uint32)
+
+
+def band_keys(signature: np.ndarray) -> List[int]:
+    '''
+    One signed 64-bit key per band; two documents sharing any key are candidates
+    '''
+    keys = []
+    for band, rows in enumerate(signature.astype("<u4").reshape(BANDS, ROWS)):
+        digest = hashlib.blake2b(bytes([band]) + rows.tobytes(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+
+def fingerprint(text: str, min_words: int | None = None) -> Optional[Fingerprint]:
+    '''
+    Fingerprint of a document's text, or None when it is too short to compare
+    '''
+    min_words = DEDUPE_MIN_WORDS if min_words is None else min_words
+    tokens = _WORD.findall(text.lower())
+    if not tokens or len(tokens) < min_words:
+        return None
+    signature = minhash(shingle_hashes(tokens))
+    content_hash = hashlib.sha256(" ".join(tokens).encode("utf-8")).hexdigest()
+    return Fingerprint(signature, band_keys(signature), content_hash, len(tokens))
+
+
+class LSHIndex:
+    '''
+    In-memory band index, for documents not yet stored
+    '''
+    def __init__(self):
+        self._buckets: Dict[int, List[tuple]] = {}
+
+    def add(self, key, fingerprint: Fingerprint):
+        for band in fingerprint.bands:
+            self._buckets.setdefault(band, []).append((key, fingerprint))
+
+    def remove(self, key):
+        for band, entries in list(self._buckets.items()):
+            self._buckets[band] = [entry for entry in entries if entry[0] != key]
+
+    def query(self, fingerprint: Fingerprint, threshold: float) -> Optional[tuple]:
+        best = None
+        for band in fingerprint.bands:
+            for key, candidate in self._buckets.get(band, []):
+                similarity = fingerprint.similarity(candidate)
+                if similarity >= threshold and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+        return best
+
+
+def scope_for(subject_id: ObjectId, user_id: str | None) -> str:
+    '''
+    Documents are compared across all of a user's subjects; without a user, within the subject
+    '''
+    return f"user:{user_id}" if user_id else f"subject:{subject_id}"
+
+
+class Deduper:
+    '''
+    Finds near-duplicates for the documents of one upload job, among the stored documents
+    in the job's scope and the documents of the job checked so far. A copy of a document of
+    the job may be checked before that original is stored; original_stored() tells whether
+    the original made it, so the copy is only dropped once it has.
+    '''
+    def __init__(self, subject_id: ObjectId, user_id: str | None = None, mode: str | None = None, threshold: float | None = None, documents=None):
+        self.subject_id = subject_id
+        self.documents = documents if documents is not None else database.documents_collection
+        self.scope = scope_for(subject_id, user_id)
+        self.mode = mode or DEDUPE_MODE
+        self.threshold = DEDUPE_THRESHOLD if threshold is None else threshold
+        self._pending = LSHIndex()
+        # Documents of this job expected to be stored -> whether they were
+        self._outcomes: Dict[ObjectId, asyncio.Future] = {}
+
+    async def _find_stored(self, fingerprint: Fingerprint) -> Optional[DuplicateMatch]:
+        cursor = self.documents.find(
+            {"metadata.fingerprint.scope": self.scope, "metadata.fingerprint.bands": {"$in": fingerprint.bands}},
+            {"subject_id": 1, "metadata.fingerprint": 1},
+        ).limit(MAX_CANDIDATES)
+        best = None
+        async for candidate in cursor:
+            similarity = fingerprint.similarity(Fingerprint.from_metadata(candidate["metadata"]["fingerprint"]))
+            if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                best = DuplicateMatch(candidate["_id"], candidate["subject_id"], similarity)
+        return best
+
+    async def check(self, documents: List[dict]) -> List[Optional[DuplicateMatch]]:
+        '''
+        Fingerprint document dicts in place and return, for each, the document it
+        duplicates or None. Documents returned as None are expected to be stored.
+        '''
+        if self.mode == "off":
+            return [None] * len(documents)
+        fingerprints = await asyncio.to_thread(lambda: [fingerprint(document["ocr_text"]) for document in documents])
+        matches = []
+        for document, document_fingerprint in zip(documents, fingerprints):
+            if document_fingerprint is None:
+                matches.append(None)
+                continue
+            document["metadata"]["fingerprint"] = document_fingerprint.to_metadata(self.scope)
+            match = await self._find_stored(document_fingerprint)
+            # Copies within this job are caught before either is stored
+            pending = self._pending.query(document_fingerprint, self.threshold)
+            if pending is not None and (match is None or pending[1] > match.similarity):
+                match = DuplicateMatch(pending[0], self.subject_id, pending[1])
+            if match is None:
+                self._pending.add(document["_id"], document_fingerprint)
+                self._outcomes[document["_id"]] = asyncio.get_running_loop().create_future()
+            elif match.subject_id != self.subject_id:
+                # A second copy in this job then resolves to the same linked document
+                self._pending.add(match.document_id, document_fingerprint)
+            matches.append(match)
+        return matches
+
+    def stored(self, document_ids: List[ObjectId]):
+        '''
+        Record that documents returned as None by check() are stored
+        '''
+        for document_id in document_ids:
+            self._settle(document_id, True)
+
+    def forget(self, document_ids: List[ObjectId]):
+        '''
+        Drop documents that were checked but could not be stored
+        '''
+        for document_id in document_ids:
+            self._pending.remove(document_id)
+            self._settle(document_id, False)
+
+    def _settle(self, document_id: ObjectId, stored: bool):
+        outcome = self._outcomes.get(document_id)
+        if outcome is not None and not outcome.done():
+            outcome.set_result(stored)
+
+    async def original_stored(self, match: DuplicateMatch) -> bool:
+        '''
+        Whether the document a match points at exists, waiting for it when it is a document
+        of this job that is still being stored
+        '''
+        outcome = self._outcomes.get(match.document_id)
+        return True if outcome is None else await outcome
+
+    def links(self, match: DuplicateMatch) -> bool:
+        '''
+        Whether a duplicate is referenced from this subject rather than dropped
+        '''
+        return self.mode == "link" and match.subject_id != self.subject_id
@@ -0,0 +1,121 @@
+'''
+Splits document text into chunks and embeds them in batches
+'''
+from typing import List
+import asyncio
+import hashlib
+import os
+import re
+
+import numpy as np
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hashing")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", 1200))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    '''
+    Pack paragraphs into chunks of about chunk_chars characters. Paragraphs longer than a
+    chunk are cut on whitespace. Consecutive chunks share up to overlap trailing characters
+    so a sentence on a boundary is retrievable from either side.
+    '''
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_chars:
+            cut = paragraph.rfind(" ", 0, chunk_chars)
+            cut = cut if cut > chunk_chars // 2 else chunk_chars
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > chunk_chars:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap else ""
+            # Start the overlap on a word boundary
+            tail = tail[tail.find(" ") + 1:] if " " in tail else tail
+            current = f"{tail}\n\n{piece}" if tail else piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class HashingEmbedder:
+    '''
+    Deterministic local embedder: hashed bag of words (unigrams and bigrams) with
+    sublinear term frequency, L2-normalised. Needs no network or model weights, so it is
+    the default for development and tests.
+    '''
+    name = "hashing"
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _bucket(self, token: str) -> int:
+        return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little") % self.dim
+
+    def embed_sync(self, texts: List[str]) -> np.ndarray:
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            tokens = TOKEN_PATTERN.findall(text.lower())
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            rows.extend([row] * len(features))
+            cols.extend(self._bucket(feature) for feature in features)
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(matrix, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), 1.0)
+        np.log1p(matrix, out=matrix)
+        return normalize(matrix)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return await asyncio.to_thread(self.embed_sync, texts)
+
+
+class OpenAIEmbedder:
+    '''
+    Remote embeddings through llama-index's OpenAI integration, imported on first use
+    '''
+    def __init__(self, model: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        # Vectors of different models do not compare, so the model is part of the name
+        self.name = f"openai:{model}"
+        self.model = OpenAIEmbedding(model=model, embed_batch_size=batch_size)
+        self.batch_size = batch_size
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results = await asyncio.gather(*[self.model.aget_text_embedding_batch(batch) for batch in batches])
+        vectors = [vector for batch in results for vector in batch]
+        return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+_embedder = None
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        if EMBEDDING_BACKEND == "hashing":
+            _embedder = HashingEmbedder()
+        elif EMBEDDING_BACKEND == "openai":
+            _embedder = OpenAIEmbedder()
+        else:
+            raise ValueError(f"Unknown embedding backend: {EMBEDDING_BACKEND}")
+    return _embedder
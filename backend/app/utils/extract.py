@@ -0,0 +1,243 @@
+'''
+Local text extraction for born-digital documents. PDFs with a text layer, DOCX and PPTX
+files are extracted on a process pool; only PDF pages without usable text go to OCR.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+from xml.etree import ElementTree
+import asyncio
+import io
+import logging
+import os
+import re
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+LOCAL_EXTRACTION_WORKERS = int(os.getenv("LOCAL_EXTRACTION_WORKERS", os.cpu_count() or 2))
+# Pages with fewer extracted characters than this are treated as scanned images
+MIN_PAGE_CHARS = int(os.getenv("LOCAL_EXTRACTION_MIN_PAGE_CHARS", 32))
+LOCAL_EXTENSIONS = ['.pdf', '.docx', '.pptx']
+# PDFs with at least this many pages to OCR are parsed in page ranges of PARSE_RANGE_PAGES,
+# concurrently, and each range is stored as soon as it is parsed
+PARSE_SPLIT_MIN_PAGES = int(os.getenv("PARSE_SPLIT_MIN_PAGES", 40))
+PARSE_RANGE_PAGES = int(os.getenv("PARSE_RANGE_PAGES", 10))
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DRAWING_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+
+@dataclass
+class PageRun:
+    '''
+    A contiguous run of pages [start, end) that has no text layer and needs OCR
+    '''
+    start: int
+    end: int
+
+
+@dataclass
+class LocalExtraction:
+    # One entry per page (or one entry for DOCX/PPTX); None marks a page that needs OCR
+    pages: List[Optional[str]]
+    # Set for large PDFs: runs longer than this many pages are split into several ranges
+    range_pages: Optional[int] = None
+
+    @property
+    def complete(self) -> bool:
+        return all(page is not None for page in self.pages)
+
+    @property
+    def usable(self) -> bool:
+        return any(page is not None for page in self.pages)
+
+    @property
+    def split(self) -> bool:
+        return self.range_pages is not None
+
+    def _runs(self, missing: bool) -> List[PageRun]:
+        runs = []
+        for index, page in enumerate(self.pages):
+            if (page is None) != missing:
+                continue
+            if runs and runs[-1].end == index and (not self.range_pages or index - runs[-1].start < self.range_pages):
+                runs[-1].end = index + 1
+            else:
+                runs.append(PageRun(index, index + 1))
+        return runs
+
+    def missing_runs(self) -> List[PageRun]:
+        return self._runs(missing=True)
+
+    def text_runs(self) -> List[PageRun]:
+        '''
+        Runs of pages with a text layer, split like the missing runs
+        '''
+        return self._runs(missing=False)
+
+    def text_of(self, run: PageRun) -> str:
+        return "\n\n".join(page for page in self.pages[run.start:run.end] if page)
+
+    def merge(self, ocr_texts: List[str]) -> str:
+        '''
+        Join the local pages with the OCR text of each missing run, in page order
+        '''
+        pages = list(self.pages)
+        for run, text in zip(self.missing_runs(), ocr_texts):
+            pages[run.start] = text
+            for index in range(run.start + 1, run.end):
+                pages[index] = ""
+        return "\n\n".join(page for page in pages if page)
+
+
+def _clean_page(text: str) -> str:
+    # Collapse the runs of spaces PDF text layers produce, keep line structure
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in text.splitlines()]
+    return "\n".join(lines).strip()
+
+
+def extract_pdf(path: str) -> LocalExtraction:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    pages: List[Optional[str]] = []
+    for page in reader.pages:
+        text = _clean_page(page.extract_text() or "")
+        pages.append(text if len(text) >= MIN_PAGE_CHARS else None)
+    return LocalExtraction(pages=pages)
+
+
+def extract_docx(path: str) -> LocalExtraction:
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{WORD_NS}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{WORD_NS}t")).strip()
+        if not text:
+            continue
+        style = paragraph.find(f"{WORD_NS}pPr/{WORD_NS}pStyle")
+        style_name = style.get(f"{WORD_NS}val", "") if style is not None else ""
+        match = re.match(r"Heading(\d)", style_name)
+        if match:
+            text = "#" * int(match.group(1)) + " " + text
+        paragraphs.append(text)
+    text = "\n\n".join(paragraphs)
+    return LocalExtraction(pages=[text if len(text) >= MIN_PAGE_CHARS else None])
+
+
+def extract_pptx(path: str) -> LocalExtraction:
+    with zipfile.ZipFile(path) as archive:
+        slide_names = [name for name in archive.namelist() if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)]
+        slide_names.sort(key=lambda name: int(re.search(r"(\d+)\.xml$", name).group(1)))
+        slides = []
+        for number, name in enumerate(slide_names, start=1):
+            root = ElementTree.fromstring(archive.read(name))
+            lines = []
+            for paragraph in root.iter(f"{DRAWING_NS}p"):
+                line = "".join(node.text or "" for node in paragraph.iter(f"{DRAWING_NS}t")).strip()
+                if line:
+                    lines.append(line)
+            slides.append(f"## Slide {number}\n\n" + "\n".join(lines))
+    text = "\n\n".join(slides)
+    return LocalExtraction(pages=[text if sum(len(s) for s in slides) >= MIN_PAGE_CHARS else None])
+
+
+def extract_local(path: str, ext: str) -> Optional[LocalExtraction]:
+    '''
+    Runs in a pool worker. Returns None when the file cannot be read locally.
+    '''
+    try:
+        if ext == ".pdf":
+            return extract_pdf(path)
+        if ext == ".docx":
+            return extract_docx(path)
+        if ext == ".pptx":
+            return extract_pptx(path)
+    except Exception:
+        logger.exception("Local extraction failed for %s", path)
+    return None
+
+
+def count_pages(path: str, ext: str) -> int:
+    '''
+    Pages of a PDF, for quotas; any other file, or a PDF that cannot be read, counts as one
+    '''
+    if ext != ".pdf":
+        return 1
+    from pypdf import PdfReader
+
+    try:
+        return len(PdfReader(path).pages)
+    except Exception:
+        return 1
+
+
+def page_bytes(path: str, run: PageRun) -> bytes:
+    '''
+    Copy the pages of one run into a new PDF in memory, so only those pages are sent to OCR
+    '''
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(path)
+    writer = PdfWriter()
+    for index in range(run.start, run.end):
+        writer.add_page(reader.pages[index])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=LOCAL_EXTRACTION_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def extract_text(path: str, ext: str) -> Optional[LocalExtraction]:
+    '''
+    Extract a document's text layer on the process pool. None means the whole file needs OCR,
+    except for PDFs with at least PARSE_SPLIT_MIN_PAGES pages to OCR: those are returned
+    split into page ranges even when no page has text.
+    '''
+    if ext not in LOCAL_EXTENSIONS:
+        return None
+    loop = asyncio.get_running_loop()
+    extraction = await loop.run_in_executor(get_executor(), extract_local, path, ext)
+    if extraction is None:
+        return None
+    if ext == ".pdf" and len(extraction.pages) - sum(page is not None for page in extraction.pages) >= PARSE_SPLIT_MIN_PAGES:
+        extraction.range_pages = PARSE_RANGE_PAGES
+        return extraction
+    if not extraction.usable:
+        return None
+    return extraction
+
+
+async def split_missing_pages(path: str, extraction: LocalExtraction, runs: List[PageRun] | None = None) -> List[io.BytesIO]:
+    '''
+    Build a PDF of each run of image-only pages (or of the given runs) on the process pool.
+    Each comes back as an in-memory buffer named after its pages, ready for the parser, so
+    no scratch files are written or cleaned up.
+    '''
+    loop = asyncio.get_running_loop()
+    base, ext = os.path.splitext(os.path.basename(path))
+    runs = extraction.missing_runs() if runs is None else runs
+    contents = await asyncio.gather(*[loop.run_in_executor(get_executor(), page_bytes, path, run) for run in runs])
+    buffers = []
+    for run, content in zip(runs, contents):
+        buffer = io.BytesIO(content)
+        buffer.name = f"{base}.pages-{run.start}-{run.end}{ext}"
+        buffers.append(buffer)
+    return buffers
@@ -0,0 +1,387 @@
+'''
+Bounded job queue and concurrency limits for document processing. Work submitted by
+request handlers is run by a fixed set of worker coroutines, separate from the handlers.
+Jobs are scheduled fairly across tenants (the accounts of app.utils.accounts), not first
+come, first served: a 200-file upload queued cannot hold back everyone else's small
+uploads. Quotas are charged to accounts too, a job possibly to several of them.
+'''
+from app.utils.metrics import registry
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))
+PARSE_MAX_CONCURRENCY = int(os.getenv("PARSE_MAX_CONCURRENCY", 8))
+PARSE_MAX_CONCURRENCY_PER_SUBJECT = int(os.getenv("PARSE_MAX_CONCURRENCY_PER_SUBJECT", 2))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", 30))
+# Jobs of one tenant running at once; the rest wait even when workers are free
+JOB_MAX_RUNNING_PER_TENANT = int(os.getenv("JOB_MAX_RUNNING_PER_TENANT", 2))
+# Jobs costing at most this much (bytes, for uploads) also go to the small-job lane
+JOB_SMALL_MAX_COST = float(os.getenv("JOB_SMALL_MAX_COST", 4 * 1024 * 1024))
+# Workers that only take small jobs, always leaving at least one worker for everything else
+JOB_SMALL_LANE_WORKERS = int(os.getenv("JOB_SMALL_LANE_WORKERS", 1))
+# Fair-share weights, e.g. "user:<id>=2"; tenants not listed weigh 1
+JOB_TENANT_WEIGHTS = os.getenv("JOB_TENANT_WEIGHTS", "")
+
+job_wait_seconds = registry.histogram("doc2quiz_job_wait_seconds", "Seconds jobs spent queued before a worker took them")
+job_run_seconds = registry.histogram("doc2quiz_job_run_seconds", "Seconds jobs spent running", ("outcome",))
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int = JOB_RETRY_AFTER):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class QuotaExceededError(Exception):
+    '''
+    An account already has as much work queued or running as its quota allows
+    '''
+    def __init__(self, resource: str, retry_after: int = JOB_RETRY_AFTER):
+        super().__init__(f"Too many {resource} in progress")
+        self.resource = resource
+        self.retry_after = retry_after
+
+
+@dataclass
+class Quota:
+    # Limits on an account's queued and running work; 0 means unlimited
+    jobs: int = 0
+    bytes: int = 0
+    pages: int = 0
+
+
+def parse_weights(value: str) -> Dict[str, float]:
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        tenant, _, weight = item.rpartition("=")
+        weights[tenant] = float(weight)
+    return weights
+
+
+@dataclass
+class Job:
+    func: Callable[..., Awaitable[Any]]
+    args: tuple
+    kwargs: dict
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # Jobs without a tenant are their own tenant
+    tenant: str | None = None
+    cost: float = 1.0
+    pages: int = 0
+    # Quota accounts the job's jobs, cost and pages count against while queued or running
+    accounts: List[str] = field(default_factory=list)
+    # Whether the small-job lane may take the job when its cost is small enough
+    small_lane: bool = True
+    # Virtual finish time under fair queuing, set when the job is queued
+    tag: float = 0.0
+    state: str = "queued"
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+
+
+class MemoryJobBackend:
+    '''
+    In-process bounded queue with weighted fair queuing across tenants. Each job gets a
+    virtual finish time of max(now, the tenant's last finish) + cost / weight, and get()
+    serves the lowest one, so every tenant with work queued gets its weighted share of
+    workers whatever the others have queued, and small jobs finish ahead of large ones.
+    A tenant never has more than max_running jobs running. Jobs do not survive a restart.
+    '''
+    def __init__(
+        self,
+        maxsize: int = JOB_QUEUE_SIZE,
+        max_running: int = JOB_MAX_RUNNING_PER_TENANT,
+        weights: Dict[str, float] | None = None,
+        small_max_cost: float = JOB_SMALL_MAX_COST,
+    ):
+        self.maxsize = maxsize
+        self.max_running = max_running
+        self.weights = parse_weights(JOB_TENANT_WEIGHTS) if weights is None else weights
+        self.small_max_cost = small_max_cost
+        self._queues: Dict[str, deque[Job]] = {}
+        self._finish: Dict[str, float] = {}
+        self._running: Dict[str, int] = defaultdict(int)
+        # Work of each account queued or running, for quotas
+        self._usage: Dict[str, Dict[str, float]] = defaultdict(lambda: {"jobs": 0, "bytes": 0, "pages": 0})
+        self._vtime = 0.0
+        self._size = 0
+        self._unfinished = 0
+        self._changed = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def _tenant(self, job: Job) -> str:
+        return job.tenant or f"job:{job.id}"
+
+    def usage(self, account: str) -> Dict[str, float]:
+        return dict(self._usage.get(account, {"jobs": 0, "bytes": 0, "pages": 0}))
+
+    def put_nowait(self, job: Job):
+        if self._size >= self.maxsize:
+            raise QueueFullError()
+        tenant = self._tenant(job)
+        start = max(self._vtime, self._finish.get(tenant, 0.0))
+        job.tag = start + max(job.cost, 1.0) / self.weights.get(tenant, 1.0)
+        self._finish[tenant] = job.tag
+        self._queues.setdefault(tenant, deque()).append(job)
+        for account in job.accounts:
+            usage = self._usage[account]
+            usage["jobs"] += 1
+            usage["bytes"] += job.cost
+            usage["pages"] += job.pages
+        self._size += 1
+        self._unfinished += 1
+        self._idle.clear()
+        self._changed.set()
+
+    def _next(self, small_only: bool) -> Job | None:
+        best = None
+        for tenant, queue in self._queues.items():
+            if self._running[tenant] >= self.max_running:
+                continue
+            for job in queue:
+                # A tenant's jobs are in tag order; the small lane looks past its large ones
+                if small_only and (not job.small_lane or job.cost > self.small_max_cost):
+                    continue
+                if best is None or job.tag < best.tag:
+                    best = job
+                break
+        return best
+
+    async def get(self, small_only: bool = False) -> Job:
+        '''
+        The queued job with the earliest virtual finish time among tenants below their
+        running limit; with small_only, among jobs costing at most small_max_cost
+        '''
+        while True:
+            job = self._next(small_only)
+            if job is not None:
+                break
+            self._changed.clear()
+            await self._changed.wait()
+        tenant = self._tenant(job)
+        queue = self._queues[tenant]
+        queue.remove(job)
+        if not queue:
+            del self._queues[tenant]
+        self._running[tenant] += 1
+        self._vtime = max(self._vtime, job.tag - max(job.cost, 1.0) / self.weights.get(tenant, 1.0))
+        self._size -= 1
+        return job
+
+    def task_done(self, job: Job):
+        tenant = self._tenant(job)
+        self._running[tenant] -= 1
+        if not self._running[tenant]:
+            del self._running[tenant]
+        if tenant not in self._running and tenant not in self._queues:
+            self._finish.pop(tenant, None)
+        for account in job.accounts:
+            usage = self._usage[account]
+            usage["jobs"] -= 1
+            usage["bytes"] -= job.cost
+            usage["pages"] -= job.pages
+            if usage["jobs"] == 0:
+                del self._usage[account]
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._idle.set()
+        # A tenant at its running limit may have become eligible
+        self._changed.set()
+
+    async def join(self):
+        await self._idle.wait()
+
+    def qsize(self) -> int:
+        return self._size
+
+
+class ConcurrencyLimiter:
+    '''
+    A global semaphore plus one semaphore per key (subject). A slot is one unit of
+    parse work in flight: a single file or one batched parse job.
+    '''
+    def __init__(self, max_concurrency: int = PARSE_MAX_CONCURRENCY, per_key: int = PARSE_MAX_CONCURRENCY_PER_SUBJECT):
+        self.max_concurrency = max_concurrency
+        self.per_key = per_key
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._keyed: Dict[Any, asyncio.Semaphore] = {}
+        self._holders: Dict[Any, int] = defaultdict(int)
+
+    @property
+    def in_use(self) -> int:
+        return sum(self._holders.values())
+
+    @asynccontextmanager
+    async def slot(self, key: Any):
+        semaphore = self._keyed.setdefault(key, asyncio.Semaphore(self.per_key))
+        self._holders[key] += 1
+        try:
+            # Take the subject's slot first so one subject cannot hold global slots while it waits
+            async with semaphore:
+                async with self._global:
+                    yield
+        finally:
+            self._holders[key] -= 1
+            if self._holders[key] == 0:
+                del self._holders[key]
+                self._keyed.pop(key, None)
+
+
+class JobQueue:
+    '''
+    Runs submitted coroutine functions on JOB_WORKERS worker tasks. submit() never waits:
+    it raises QueueFullError when the backend is at capacity, or QuotaExceededError when
+    an account is over its quota, so the caller can shed load. Up to JOB_SMALL_LANE_WORKERS
+    of the workers only take small jobs, so small uploads never wait behind large ones
+    for a worker.
+    '''
+    def __init__(
+        self,
+        backend=None,
+        workers: int = JOB_WORKERS,
+        limiter: ConcurrencyLimiter | None = None,
+        small_lane_workers: int = JOB_SMALL_LANE_WORKERS,
+    ):
+        self.backend = backend or MemoryJobBackend()
+        self.workers = workers
+        self.small_lane_workers = max(0, min(small_lane_workers, workers - 1))
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "queued": self.backend.qsize(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "parse_slots_in_use": self.limiter.in_use,
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._worker(small_only=i < self.small_lane_workers), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self):
+        '''
+        Wait until every submitted job has finished. Mostly useful in tests.
+        '''
+        await self.backend.join()
+
+    def check_quota(self, quotas: Dict[str, Quota] | None, cost: float = 0, pages: int = 0):
+        '''
+        Raise QuotaExceededError when adding a job of this cost would take any of the
+        accounts in quotas over its quota
+        '''
+        for account, quota in (quotas or {}).items():
+            usage = self.backend.usage(account)
+            for resource, limit, added in [("jobs", quota.jobs, 1), ("bytes", quota.bytes, cost), ("pages", quota.pages, pages)]:
+                if limit and usage[resource] + added > limit:
+                    raise QuotaExceededError(resource)
+
+    def submit(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        tenant: str | None = None,
+        cost: float = 1.0,
+        pages: int = 0,
+        quotas: Dict[str, Quota] | None = None,
+        small_lane: bool = True,
+        **kwargs,
+    ) -> Job:
+        '''
+        Queue func(*args, **kwargs) for tenant. cost (bytes, for uploads) sets the job's
+        fair share and lane; the job, its pages and its cost count against the quota of
+        each account in quotas. Jobs whose run time their cost does not reflect pass
+        small_lane=False to stay out of the small-job lane.
+        '''
+        self.check_quota(quotas, cost, pages)
+        job = Job(
+            func=func, args=args, kwargs=kwargs, tenant=tenant, cost=cost, pages=pages,
+            accounts=list(quotas or {}), small_lane=small_lane,
+        )
+        self.backend.put_nowait(job)
+        # Workers start lazily when the app lifespan did not start them
+        self.start()
+        return job
+
+    async def _worker(self, small_only: bool = False):
+        while True:
+            job = await self.backend.get(small_only=small_only)
+            job.state = "running"
+            job.started_at = time.monotonic()
+            job_wait_seconds.observe(job.started_at - job.enqueued_at)
+            self.running += 1
+            try:
+                await job.func(*job.args, **job.kwargs)
+                job.state = "done"
+                self.completed += 1
+            except Exception as e:
+                job.state = "failed"
+                job.error = str(e)
+                self.failed += 1
+                logger.exception("Job %s failed", job.id)
+            finally:
+                job.finished_at = time.monotonic()
+                job_run_seconds.observe(job.finished_at - job.started_at, outcome=job.state)
+                self.running -= 1
+                self.backend.task_done(job)
+
+
+_job_queue: JobQueue | None = None
+
+
+def get_job_queue() -> JobQueue:
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue()
+    return _job_queue
+
+
+async def stop_job_queue():
+    global _job_queue
+    if _job_queue is not None:
+        await _job_queue.stop()
+        _job_queue = None
+
+
+def _queue_stats(states: List[str]) -> dict:
+    if _job_queue is None:
+        return {}
+    stats = _job_queue.stats
+    return {(state,): stats[state] for state in states}
+
+
+registry.gauge("doc2quiz_job_queue_jobs", "Jobs queued or running, and parse slots in use", ("state",)).set_function(
+    lambda: _queue_stats(["queued", "running", "parse_slots_in_use"])
+)
+registry.counter("doc2quiz_jobs_total", "Jobs finished by outcome", ("state",)).set_function(
+    lambda: _queue_stats(["completed", "failed"])
+)
@@ -0,0 +1,300 @@
+'''
+In-process counters, gauges and histograms, rendered in the Prometheus text format at
+/metrics, plus span hooks for tracing. With METRICS_ENABLED=false every update returns
+after one flag check and span() hands back a shared no-op context.
+'''
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Tuple
+import functools
+import inspect
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Seconds; covers fast Mongo calls up to multi-minute remote parses
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    '''
+    Base for counters and gauges. set_function makes a metric read its values at scrape
+    time from state kept elsewhere, either one number or a dict of label value tuples to
+    numbers.
+    '''
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Callable | None = None
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def set_function(self, function: Callable):
+        self._function = function
+
+    def samples(self) -> List[Tuple[str, dict, float]]:
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception:
+                logger.exception("Reading metric %s failed", self.name)
+                result = {}
+            values.update(result if isinstance(result, dict) else {(): result})
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket, sum, count]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def time(self, **labels) -> "Timer":
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", {**labels, "le": _format(bound)}, cumulative))
+                samples.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Timer:
+    '''
+    Observes the seconds spent in a block into a histogram. Works as a context manager
+    (sync or async) and as a decorator for sync and async functions.
+    '''
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with Timer(self.histogram, self.labels):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with Timer(self.histogram, self.labels):
+                    return function(*args, **kwargs)
+        return wrapper
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else f"{value:.1f}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Tuple[str, ...], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self) -> str:
+        '''
+        All metrics in the Prometheus text exposition format, version 0.0.4
+        '''
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda metric: metric.name):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}" if label_text else f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+registry = Registry()
+
+# Metrics shared by the pipeline
+stage_seconds = registry.histogram(
+    "doc2quiz_stage_seconds", "Seconds spent in each document pipeline stage", ("stage",)
+)
+stage_errors = registry.counter(
+    "doc2quiz_stage_errors_total", "Documents that failed in each pipeline stage", ("stage",)
+)
+upload_bytes = registry.counter("doc2quiz_upload_bytes_total", "Bytes staged from uploads")
+parser_request_seconds = registry.histogram(
+    "doc2quiz_parser_request_seconds", "Seconds per request to the remote parser", ("operation", "outcome")
+)
+mongo_command_seconds = registry.histogram(
+    "doc2quiz_mongo_command_seconds", "Seconds per Mongo command", ("command", "outcome")
+)
+http_request_seconds = registry.histogram(
+    "doc2quiz_http_request_seconds", "Seconds per HTTP request", ("method", "route", "status")
+)
+
+
+# Span hooks: callables taking (name, attributes) and returning a context manager
+_span_hooks: List[Callable[[str, dict], object]] = []
+
+
+def add_span_hook(hook: Callable[[str, dict], object]):
+    _span_hooks.append(hook)
+
+
+def remove_span_hook(hook: Callable[[str, dict], object]):
+    _span_hooks.remove(hook)
+
+
+_NO_SPAN = nullcontext()
+
+
+def span(name: str, **attributes):
+    '''
+    Open a span with every registered hook, e.g. an OpenTelemetry tracer. Without hooks
+    this is a shared no-op context.
+    '''
+    if not _span_hooks:
+        return _NO_SPAN
+    return _spans(name, attributes)
+
+
+@contextmanager
+def _spans(name: str, attributes: dict):
+    contexts = []
+    try:
+        for hook in list(_span_hooks):
+            context = hook(name, attributes)
+            context.__enter__()
+            contexts.append(context)
+        yield
+    except BaseException as e:
+        for context in reversed(contexts):
+            context.__exit__(type(e), e, e.__traceback__)
+        raise
+    else:
+        for context in reversed(contexts):
+            context.__exit__(None, None, None)
+
+
+def opentelemetry_hook(tracer_name: str = "doc2quiz"):
+    '''
+    A span hook backed by the OpenTelemetry API, which must be installed
+    '''
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer(tracer_name)
+
+    def hook(name: str, attributes: dict):
+        return tracer.start_as_current_span(name, attributes={key: str(value) for key, value in attributes.items()})
+    return hook
@@ -0,0 +1,285 @@
+'''
+Decoding and normalization of plain text and markdown before it is stored. Files are
+decoded incrementally in chunks, off the event loop: small ones on a thread, large ones on
+the local extraction process pool so decoding never holds the server's GIL.
+'''
+from app.utils.extract import get_executor
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
+import asyncio
+import codecs
+import os
+import re
+import unicodedata
+
+try:
+    import charset_normalizer
+except ImportError:  # optional, detection falls back to cp1252
+    charset_normalizer = None
+
+# Bytes decoded per step
+NORMALIZE_CHUNK_BYTES = int(os.getenv("NORMALIZE_CHUNK_BYTES", 1024 * 1024))
+# Files at least this large are normalized on the process pool instead of a thread
+NORMALIZE_PROCESS_MIN_BYTES = int(os.getenv("NORMALIZE_PROCESS_MIN_BYTES", 256 * 1024))
+# Characters sampled from the start of the text for language detection
+LANGUAGE_SAMPLE_CHARS = 20000
+
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# Control characters other than tab and newline, zero-width characters and stray BOMs
+_INVISIBLE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\u200b-\u200d\u2060\ufeff]")
+# No-break and other fixed-width spaces
+_SPACES = re.compile("[\u00a0\u2000-\u200a\u202f\u205f\u3000]")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+# Hashes run into a letter, e.g. "#Title" or "##Methods"; "#123" is never a heading
+_ATX_HEADING = re.compile(r"^(#{1,6})(?=[^\W\d_])")
+_HASHTAG = re.compile(r"\s#[^\W_]")
+_BULLET = re.compile(r"^(\s*)[*+•](?=\s)")
+_WORD = re.compile(r"[^\W\d_]+")
+
+# The most frequent words of each language, enough to tell them apart on a paragraph
+STOPWORDS = {
+    "en": "the of and to in is that for it as was with be by on are this which or from".split(),
+    "es": "de la que el en los del las por un para con una es su al como más pero".split(),
+    "fr": "de la le et les des en du un une est que pour dans qui par sur pas au".split(),
+    "de": "der die und in den von zu das mit sich des auf für ist im dem nicht ein eine".split(),
+    "it": "di che la il un per è non una in sono del della le con si da gli".split(),
+    "pt": "de que o a do da em um para é com não uma os no se na por mais".split(),
+    "nl": "de van het een en in is dat op te zijn voor met die niet aan er".split(),
+}
+# Unicode script of a character (by name prefix) -> language code
+SCRIPTS = [
+    ("CJK UNIFIED", "zh"),
+    ("HIRAGANA", "ja"),
+    ("KATAKANA", "ja"),
+    ("HANGUL", "ko"),
+    ("CYRILLIC", "ru"),
+    ("GREEK", "el"),
+    ("ARABIC", "ar"),
+    ("HEBREW", "he"),
+    ("DEVANAGARI", "hi"),
+    ("THAI", "th"),
+]
+
+
+@dataclass
+class NormalizedText:
+    text: str
+    encoding: str
+    language: Optional[str] = None
+    language_confidence: float = 0.0
+    # Bytes (or characters, for decoded input) before normalization
+    size: int = 0
+
+    def document_metadata(self) -> dict:
+        '''
+        What is kept in Document.metadata
+        '''
+        return {
+            "encoding": self.encoding,
+            "language": self.language,
+            "language_confidence": round(self.language_confidence, 3),
+            "normalized": True,
+        }
+
+
+def detect_encoding(sample: bytes) -> str:
+    '''
+    Guess the encoding from the first chunk: a BOM wins, then UTF-8 if the sample decodes
+    as UTF-8 (ignoring a character cut off at the end), then charset_normalizer if it is
+    installed, then cp1252
+    '''
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if charset_normalizer is not None:
+        match = charset_normalizer.from_bytes(sample).best()
+        if match is not None:
+            return match.encoding
+    return "cp1252"
+
+
+def decode_chunks(chunks: Iterable[bytes], encoding: str, errors: str = "strict") -> Iterator[str]:
+    '''
+    Incrementally decode a stream of byte chunks, so a multi-byte character split across
+    chunks is decoded once both halves arrive
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def split_lines(pieces: Iterable[str]) -> Iterator[str]:
+    '''
+    Lines of a stream of text pieces, with \\r\\n and \\r line endings folded into \\n
+    '''
+    # Pieces of the line still open, joined only once a line break ends it, so a long
+    # line without breaks is not copied again for every piece
+    parts: List[str] = []
+    for piece in pieces:
+        # A trailing \r may be the first half of \r\n
+        if "\n" not in piece and "\r" not in piece and not (parts and parts[-1].endswith("\r")):
+            parts.append(piece)
+            continue
+        pending = "".join(parts) + piece
+        cut = len(pending) - 1 if pending.endswith("\r") else len(pending)
+        lines = pending[:cut].replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        rest = lines.pop() + pending[cut:]
+        parts = [rest] if rest else []
+        yield from lines
+    pending = "".join(parts)
+    if pending:
+        yield from pending.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+
+
+def _heading(line: str) -> str:
+    '''
+    Give a heading written without a space after its hashes the space. Only heading-like
+    lines count: "#word", "#include" and lines of hashtags stay as they are, so one hash
+    needs a capital after it.
+    '''
+    match = _ATX_HEADING.match(line)
+    if match is None:
+        return line
+    hashes = match.group(1)
+    if (len(hashes) == 1 and not line[1].isupper()) or _HASHTAG.search(line):
+        return line
+    return f"{hashes} {line[len(hashes):]}"
+
+
+def normalize_lines(lines: Iterable[str], markdown: bool = True) -> str:
+    '''
+    NFC-normalize each line, drop invisible characters, fold odd spaces, strip trailing
+    whitespace and collapse runs of blank lines. In markdown, headings get their space
+    after the hashes and bullets use "-"; fenced code blocks are kept verbatim.
+    '''
+    out: List[str] = []
+    blank = 0
+    in_fence = False
+    for line in lines:
+        line = unicodedata.normalize("NFC", _INVISIBLE.sub("", line))
+        if markdown and _FENCE.match(line):
+            in_fence = not in_fence
+            out.append(line.rstrip())
+            blank = 0
+            continue
+        if in_fence:
+            out.append(line)
+            continue
+        line = _SPACES.sub(" ", line).rstrip()
+        if not line:
+            blank += 1
+            if blank > 1 or not out:
+                continue
+            out.append("")
+            continue
+        blank = 0
+        if markdown:
+            line = _BULLET.sub(r"\1-", _heading(line))
+        out.append(line)
+    while out and not out[-1]:
+        out.pop()
+    return "\n".join(out)
+
+
+def detect_language(text: str) -> tuple[Optional[str], float]:
+    '''
+    Language of the start of the text, with a rough confidence: by script for non-Latin
+    text, otherwise by the share of each language's most common words
+    '''
+    sample = text[:LANGUAGE_SAMPLE_CHARS]
+    letters = [char for char in sample if char.isalpha()]
+    if not letters:
+        return None, 0.0
+    scripts: Counter = Counter()
+    for char in letters[:5000]:
+        if char.isascii():
+            continue
+        name = unicodedata.name(char, "")
+        for prefix, language in SCRIPTS:
+            if name.startswith(prefix):
+                scripts[language] += 1
+                break
+    checked = min(len(letters), 5000)
+    if scripts:
+        language, count = scripts.most_common(1)[0]
+        # Kana mixed with kanji is Japanese, not Chinese
+        if language == "zh" and scripts["ja"]:
+            language, count = "ja", count + scripts["ja"]
+        if count / checked > 0.3:
+            return language, count / checked
+    words = [word.lower() for word in _WORD.findall(sample)]
+    if not words:
+        return None, 0.0
+    counts = Counter(words)
+    scores = {language: sum(counts[word] for word in stopwords) for language, stopwords in STOPWORDS.items()}
+    language, score = max(scores.items(), key=lambda item: item[1])
+    if score == 0:
+        return None, 0.0
+    runner_up = max(value for key, value in scores.items() if key != language)
+    return language, (score - runner_up) / score
+
+
+def _read_chunks(path: str, chunk_size: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def normalize_file(path: str, markdown: bool = True, chunk_size: int | None = None) -> NormalizedText:
+    '''
+    Decode and normalize a text file. Blocking; runs on a thread or a pool process.
+    '''
+    chunk_size = chunk_size or NORMALIZE_CHUNK_BYTES
+    with open(path, "rb") as f:
+        sample = f.read(min(chunk_size, 64 * 1024))
+    encoding = detect_encoding(sample)
+    try:
+        text = normalize_lines(split_lines(decode_chunks(_read_chunks(path, chunk_size), encoding)), markdown)
+    except (UnicodeDecodeError, LookupError):
+        # The sample decoded but a later chunk does not; cp1252 covers nearly every byte
+        encoding = "cp1252"
+        text = normalize_lines(split_lines(decode_chunks(_read_chunks(path, chunk_size), encoding, "replace")), markdown)
+    language, confidence = detect_language(text)
+    return NormalizedText(text, encoding, language, confidence, size=os.path.getsize(path))
+
+
+def normalize_text(text: str, markdown: bool = True) -> NormalizedText:
+    '''
+    Normalize text that is already decoded, e.g. parser output
+    '''
+    normalized = normalize_lines(split_lines([text]), markdown)
+    language, confidence = detect_language(normalized)
+    return NormalizedText(normalized, "utf-8", language, confidence, size=len(text))
+
+
+async def normalize_file_async(path: str, markdown: bool = True) -> NormalizedText:
+    size = await asyncio.to_thread(os.path.getsize, path)
+    if size >= NORMALIZE_PROCESS_MIN_BYTES:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), normalize_file, path, markdown)
+    return await asyncio.to_thread(normalize_file, path, markdown)
+
+
+async def normalize_text_async(text: str, markdown: bool = True) -> NormalizedText:
+    if len(text) >= NORMALIZE_PROCESS_MIN_BYTES:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), normalize_text, text, markdown)
+    return await asyncio.to_thread(normalize_text, text, markdown)
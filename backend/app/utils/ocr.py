@@ -1,41 +1,246 @@
 '''
-Handles OCR of uploaded documents
+Handles OCR of uploaded documents. llama_parse pulls in most of llama-index, so it is
+imported when the parser service is first created rather than with this module.
 '''
-import nest_asyncio
+from app.utils.metrics import parser_request_seconds, span
+from app.utils.staging import remove_spooled, spool_to_file
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import BinaryIO, Dict, List, Optional, Union
+import asyncio
+import httpx
+import io
+import logging
+import os
+import time
 
-nest_asyncio.apply()
+logger = logging.getLogger(__name__)
 
-from llama_parse import LlamaParse
-from typing import Union, List
-import os
+# Settings that change the parser output; part of the parse cache key
+PARSER_SETTINGS = {
+    "result_type": "markdown",
+    # One document per file, so batch results line up with their inputs
+    "split_by_page": False,
+}
+
+LLAMA_CLOUD_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY", "")
+PARSER_MAX_CONNECTIONS = int(os.getenv("PARSER_MAX_CONNECTIONS", 20))
+PARSER_NUM_WORKERS = int(os.getenv("PARSER_NUM_WORKERS", 4))
+PARSER_TIMEOUT = float(os.getenv("PARSER_TIMEOUT", 2000))
+
+
+# A path, raw bytes, or a binary file-like object. In-memory content needs a file name,
+# given explicitly or taken from the object's name attribute, so the type can be detected.
+ParseSource = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+
+
+def is_path(source: ParseSource) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+def source_name(source: ParseSource, file_name: Optional[str] = None) -> str:
+    if is_path(source):
+        return os.fspath(source)
+    name = file_name or getattr(source, "name", None)
+    if not isinstance(name, str) or not name:
+        raise ValueError("A file name is required to parse in-memory content")
+    return os.path.basename(name)
+
+
+def _as_bytes(source: Union[bytes, bytearray, memoryview]) -> bytes:
+    # A view over a whole bytes object is handed on as that object, without a copy
+    if isinstance(source, memoryview) and isinstance(source.obj, bytes) and source.nbytes == len(source.obj):
+        return source.obj
+    return source if isinstance(source, bytes) else bytes(source)
+
+
+@asynccontextmanager
+async def parser_input(source: ParseSource, file_name: Optional[str] = None):
+    '''
+    Yields (input, extra_info) for LlamaParse. Paths, bytes and buffered readers are passed
+    as they are; any other file-like object is copied once to a spooled file, off the event
+    loop, which is removed afterwards.
+    '''
+    if is_path(source):
+        yield os.fspath(source), None
+        return
+    name = source_name(source, file_name)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield _as_bytes(source), {"file_name": name}
+        return
+    if isinstance(source, io.BufferedIOBase):
+        # Buffers are always parsed from the start, e.g. again after a failed batch
+        if source.seekable():
+            source.seek(0)
+        yield source, {"file_name": name}
+        return
+    if source.seekable():
+        source.seek(0)
+    path = await asyncio.to_thread(spool_to_file, source, name)
+    try:
+        yield path, None
+    finally:
+        await asyncio.to_thread(remove_spooled, path)
+
+
+class ParserConfigurationError(RuntimeError):
+    '''
+    The parser cannot be created from the current settings
+    '''
+
+
+class ParserService:
+    '''
+    Long-lived LlamaParse client. One parser and one pooled HTTP client are shared by
+    every request, so connections to the parse API are reused across files and uploads.
+    '''
+    def __init__(self, api_key: str = LLAMA_CLOUD_API_KEY, max_connections: int = PARSER_MAX_CONNECTIONS):
+        if not api_key:
+            raise ParserConfigurationError("LLAMA_CLOUD_API_KEY is not set; it is required to parse non-text documents")
+        from llama_parse import LlamaParse
+
+        self.http_client = httpx.AsyncClient(
+            timeout=PARSER_TIMEOUT,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.parser = LlamaParse(
+            api_key=api_key,
+            verbose=True,
+            show_progress=False,
+            # Errors are raised for single files so callers see why a parse failed
+            ignore_errors=False,
+            num_workers=PARSER_NUM_WORKERS,
+            custom_client=self.http_client,
+            **PARSER_SETTINGS,
+        )
+        # In a batch a failed file comes back as an empty result instead of failing every file
+        self.batch_parser = self.parser.model_copy(update={"ignore_errors": True})
+
+    async def _load(self, parser, operation: str, file_input, extra_info: dict | None = None):
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with span(f"parser.{operation}", files=len(file_input) if isinstance(file_input, list) else 1):
+                if extra_info is None:
+                    documents = await parser.aload_data(file_input)
+                else:
+                    documents = await parser.aload_data(file_input, extra_info=extra_info)
+            outcome = "ok"
+            return documents
+        finally:
+            parser_request_seconds.observe(time.perf_counter() - start, operation=operation, outcome=outcome)
+
+    async def parse(self, source: ParseSource, file_name: Optional[str] = None) -> str:
+        """
+        Parse a single document from a path, bytes or a file-like object
+        """
+        async with parser_input(source, file_name) as (file_input, extra_info):
+            documents = await self._load(self.parser, "single", file_input, extra_info)
+        return _joined(documents)
 
-async def parse_document(file_path: str) -> str:
+    async def parse_many(self, sources: List[ParseSource]) -> List[Union[str, Exception]]:
+        """
+        Parse several documents. Paths go as one batch, in-memory sources as one batch per
+        file extension, since a batch carries a single file name for them. Results line up
+        with sources; a file that fails is returned as its exception. If a batch result
+        cannot be matched to its inputs, each of its files is retried on its own.
+        """
+        if not sources:
+            return []
+        results: List[Union[str, Exception]] = [""] * len(sources)
+        inputs: List[tuple] = [()] * len(sources)
+        batches: Dict[Optional[str], List[int]] = {}
+        async with AsyncExitStack() as stack:
+            for i, source in enumerate(sources):
+                try:
+                    inputs[i] = await stack.enter_async_context(parser_input(source))
+                except Exception as e:
+                    results[i] = e
+                    continue
+                extra_info = inputs[i][1]
+                key = None if extra_info is None else os.path.splitext(extra_info["file_name"])[1].lower()
+                batches.setdefault(key, []).append(i)
+            batch_results = await asyncio.gather(*[
+                self._parse_batch([sources[i] for i in indexes], [inputs[i] for i in indexes])
+                for indexes in batches.values()
+            ])
+        for indexes, texts in zip(batches.values(), batch_results):
+            for i, text in zip(indexes, texts):
+                results[i] = text
+        return results
+
+    async def _parse_batch(self, sources: List[ParseSource], inputs: List[tuple]) -> List[Union[str, Exception]]:
+        # In-memory inputs of a batch share an extension, so the first name stands for all
+        extra_info = inputs[0][1]
+        try:
+            documents = await self._load(self.batch_parser, "batch", [file_input for file_input, _ in inputs], extra_info)
+        except Exception:
+            logger.exception("Batch parse failed, falling back to per-file parsing")
+            documents = []
+
+        # With split_by_page off each file yields one document, in input order, or none
+        # when it failed; only a full set can be matched to the inputs
+        if len(documents) == len(inputs):
+            return [document.text for document in documents]
+
+        results = []
+        for source in sources:
+            try:
+                results.append(await self.parse(source))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+
+def _joined(documents) -> str:
+    # One document per file with split_by_page off; pages are joined should there be more
+    return "\n\n".join(document.text for document in documents)
+
+
+_parser_service: ParserService | None = None
+
+
+def preload_parser():
+    '''
+    Import the parser library ahead of the first upload. Run off the event loop from the
+    app lifespan, so startup does not wait for it.
+    '''
+    import llama_parse  # noqa: F401
+
+
+def start_parser_service() -> ParserService:
+    '''
+    Create the shared parser service on first use
+    '''
+    global _parser_service
+    if _parser_service is None:
+        _parser_service = ParserService()
+    return _parser_service
+
+
+async def stop_parser_service():
+    global _parser_service
+    if _parser_service is not None:
+        await _parser_service.aclose()
+        _parser_service = None
+
+
+def get_parser_service() -> ParserService:
+    return start_parser_service()
+
+
+async def parse_document(source: ParseSource, file_name: Optional[str] = None) -> str:
     """
-    Parse a single document using LlamaParse
+    Parse a single document using LlamaParse. source is a path, bytes, a memoryview or a
+    binary file-like object; in-memory content needs file_name unless it has a name.
     """
-    api_key = "llx-QbWueYYRCw7keyBNRpGY1x0kW6YgdjFZn9uWE57U5sKFJIG6"
-    parser = LlamaParse(
-        api_key=api_key,
-        result_type="markdown",
-        verbose=True,
-    )
-
-    # Process single file
-    documents = await parser.aload_data(file_path)
-    
-    # Assuming the API returns a list of documents, we'll take the first one
-    # You might want to adjust this based on the actual API response
-    return documents[0].text if documents else ""
+    return await get_parser_service().parse(source, file_name)
+
 
+async def parse_documents(sources: List[ParseSource]) -> List[Union[str, Exception]]:
     """
     Parse multiple documents using LlamaParse batch processing
     """
-    parser = LlamaParse(
-        api_key="llx-...",
-        result_type="markdown",
-        verbose=True,
-    )
-
-    # Process batch of files
-    documents = await parser.aload_data(file_paths)
-    return documents
\ No newline at end of file
+    return await get_parser_service().parse_many(sources)
@@ -0,0 +1,436 @@
+'''
+Content-addressed cache in front of parse_document, so re-uploaded files skip the remote parser
+'''
+from app.utils.metrics import registry
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_BACKEND = os.getenv("PARSE_CACHE_BACKEND", "memory")
+PARSE_CACHE_TTL = int(os.getenv("PARSE_CACHE_TTL", 30 * 24 * 3600))
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+PARSE_CACHE_MAX_ENTRIES = int(os.getenv("PARSE_CACHE_MAX_ENTRIES", 10000))
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "doc2quiz", "parse"))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    '''
+    SHA-256 of a file, read in chunks so large uploads are never fully in memory
+    '''
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def buffer_digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def stream_digest(source) -> str:
+    '''
+    SHA-256 of a binary file-like object from its start; the position is reset afterwards
+    so the parser reads the whole content
+    '''
+    sha = hashlib.sha256()
+    source.seek(0)
+    while chunk := source.read(HASH_CHUNK_SIZE):
+        sha.update(chunk)
+    source.seek(0)
+    return sha.hexdigest()
+
+
+async def source_digest(source) -> str:
+    '''
+    Content hash of a path, bytes-like object or seekable file-like object. Hashing runs
+    in a thread unless the content is small and already in memory.
+    '''
+    if isinstance(source, (str, os.PathLike)):
+        return await asyncio.to_thread(file_digest, os.fspath(source))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if memoryview(source).nbytes <= HASH_CHUNK_SIZE:
+            return buffer_digest(source)
+        return await asyncio.to_thread(buffer_digest, source)
+    return await asyncio.to_thread(stream_digest, source)
+
+
+def cache_key(digest: str, settings: dict) -> str:
+    '''
+    Combine the content hash with the parser settings, so changing e.g. result_type
+    never serves text produced under the old settings
+    '''
+    encoded = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(f"{digest}:{encoded}".encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    '''
+    In-process LRU bounded by entry count and total text size, with per-entry TTL
+    '''
+    def __init__(self, max_entries: int = PARSE_CACHE_MAX_ENTRIES, max_bytes: int = PARSE_CACHE_MAX_BYTES, ttl: float = PARSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[str, float, int]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        text, expires_at, _ = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return text
+
+    async def set(self, key: str, text: str):
+        if key in self._entries:
+            self._remove(key)
+        entry_size = len(text.encode("utf-8"))
+        if entry_size > self.max_bytes:
+            return
+        self._entries[key] = (text, time.monotonic() + self.ttl, entry_size)
+        self.size += entry_size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        _, _, entry_size = self._entries.pop(key)
+        self.size -= entry_size
+
+
+class DiskCacheBackend:
+    '''
+    One file per entry under a local directory. File mtime drives TTL expiry and
+    least-recently-used eviction once the directory grows past max_bytes.
+    '''
+    def __init__(self, directory: str = PARSE_CACHE_DIR, max_bytes: int = PARSE_CACHE_MAX_BYTES, ttl: float = PARSE_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.md")
+
+    def _get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.unlink(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        # Touch on read so eviction keeps recently used entries
+        os.utime(path)
+        return text
+
+    def _set(self, key: str, text: str):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".md"):
+                continue
+            stat = entry.stat()
+            if stat.st_mtime + self.ttl < now:
+                os.unlink(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, entry_size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.unlink(path)
+            total -= entry_size
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, text: str):
+        await asyncio.to_thread(self._set, key, text)
+
+    async def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".md"):
+                os.unlink(entry.path)
+
+
+class MongoCacheBackend:
+    '''
+    Entries stored in the parse_cache collection of the connected database. Expiry is checked
+    on read and Mongo's TTL index removes expired entries. The total text size is tracked
+    as entries are written; once it passes max_bytes the least recently used entries are
+    dropped, so the collection is only summed when it may have overflowed.
+    '''
+    def __init__(self, collection=None, max_bytes: int = PARSE_CACHE_MAX_BYTES, ttl: float = PARSE_CACHE_TTL):
+        self._collection = collection
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Estimated total size of the entries; other workers write too, so it is
+        # re-read from the collection before anything is evicted
+        self.size: Optional[int] = None
+
+    @property
+    def collection(self):
+        # Without a collection of its own, the backend uses the database connected by the
+        # app lifespan at the time of each call, not whichever was bound when it was built
+        if self._collection is not None:
+            return self._collection
+        from app.db.database import get_database
+        return get_database().parse_cache
+
+    async def get(self, key: str) -> Optional[str]:
+        now = datetime.now(timezone.utc)
+        entry = await self.collection.find_one({"_id": key, "expires_at": {"$gt": now}}, {"text": 1})
+        if entry is None:
+            return None
+        await self.collection.update_one({"_id": key}, {"$set": {"accessed_at": now}})
+        return entry["text"]
+
+    async def set(self, key: str, text: str):
+        entry_size = len(text.encode("utf-8"))
+        if entry_size > self.max_bytes:
+            return
+        now = datetime.now(timezone.utc)
+        previous = await self.collection.find_one_and_replace(
+            {"_id": key},
+            {
+                "_id": key,
+                "text": text,
+                "size": entry_size,
+                "created_at": now,
+                "accessed_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl),
+            },
+            projection={"size": 1},
+            upsert=True,
+        )
+        if self.size is None:
+            self.size = await self._total()
+        else:
+            self.size += entry_size - (previous or {}).get("size", 0)
+        if self.size > self.max_bytes:
+            await self._evict()
+
+    async def _total(self) -> int:
+        cursor = self.collection.aggregate([{"$group": {"_id": None, "size": {"$sum": "$size"}}}])
+        totals = [total async for total in cursor]
+        return totals[0]["size"] if totals else 0
+
+    async def _evict(self):
+        total = await self._total()
+        stale = []
+        if total > self.max_bytes:
+            # Oldest-accessed first, through the accessed_at index
+            cursor = self.collection.find({}, {"size": 1}).sort("accessed_at", 1)
+            async for entry in cursor:
+                stale.append(entry["_id"])
+                total -= entry.get("size", 0)
+                if total <= self.max_bytes:
+                    break
+            await self.collection.delete_many({"_id": {"$in": stale}})
+        self.size = total
+
+    async def clear(self):
+        await self.collection.delete_many({})
+        self.size = 0
+
+
+class ParseCache:
+    '''
+    Looks up parsed text by content hash before calling the parser. Identical files
+    parsed concurrently share one parser call. Backend failures are logged and treated
+    as misses so the cache can never fail an upload.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+    async def lookup(self, key: str) -> Optional[str]:
+        try:
+            text = await self.backend.get(key)
+        except Exception:
+            self.errors += 1
+            logger.exception("Parse cache lookup failed")
+            return None
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    async def store(self, key: str, text: str):
+        try:
+            await self.backend.set(key, text)
+        except Exception:
+            self.errors += 1
+            logger.exception("Parse cache store failed")
+
+    async def parse(self, source, parser: Callable[[Any], Awaitable[str]], settings: dict) -> str:
+        '''
+        Return the parsed text for source (a path, bytes or a file-like object), calling
+        parser only on a miss
+        '''
+        digest = await source_digest(source)
+        key = cache_key(digest, settings)
+        if key in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[key])
+
+        # Registered before the lookup yields, so a concurrent miss on the same content
+        # waits for this parse instead of starting its own
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            text = await self.lookup(key)
+            if text is None:
+                text = await parser(source)
+                await self.store(key, text)
+            future.set_result(text)
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting on the future; mark the exception as retrieved
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        return text
+
+    async def parse_many(self, sources: List, batch_parser: Callable[[List], Awaitable[List]], settings: dict, return_exceptions: bool = False) -> List:
+        '''
+        Cached variant of a batch parse: only files whose content is not cached are sent,
+        as one batch, to batch_parser. Files already being parsed, by parse or another
+        batch, are waited for instead of sent again, and this batch's files are shared the
+        same way. Successful results are cached before the first failure, if any, is
+        raised. With return_exceptions, failed files are returned as their exception instead.
+        '''
+        digests = await asyncio.gather(*[source_digest(source) for source in sources])
+        keys = [cache_key(digest, settings) for digest in digests]
+
+        texts: Dict[str, str | Exception] = {}
+        # Duplicate files within the batch are looked up and parsed once. Every key is
+        # registered before the first lookup yields, as in parse
+        waiting: Dict[str, asyncio.Future] = {}
+        owned: Dict[str, asyncio.Future] = {}
+        sources_by_key: Dict[str, Any] = {}
+        loop = asyncio.get_running_loop()
+        for key, source in zip(keys, sources):
+            if key in waiting or key in owned:
+                self.hits += 1
+            elif key in self._inflight:
+                self.hits += 1
+                waiting[key] = self._inflight[key]
+            else:
+                owned[key] = self._inflight[key] = loop.create_future()
+                sources_by_key[key] = source
+
+        def settle(key: str, result):
+            texts[key] = result
+            future = owned[key]
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+                # Nobody may be waiting on the future; mark the exception as retrieved
+                future.exception()
+            else:
+                future.set_result(result)
+
+        try:
+            missing: Dict[str, Any] = {}
+            for key in owned:
+                text = await self.lookup(key)
+                if text is None:
+                    missing[key] = sources_by_key[key]
+                else:
+                    settle(key, text)
+            if missing:
+                results = await batch_parser(list(missing.values()))
+                for key, result in zip(missing.keys(), results):
+                    if not isinstance(result, Exception):
+                        await self.store(key, result)
+                    settle(key, result)
+        except BaseException as e:
+            for key, future in owned.items():
+                if not future.done():
+                    settle(key, e)
+            raise
+        finally:
+            for key, future in owned.items():
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+        for key, future in waiting.items():
+            try:
+                texts[key] = await asyncio.shield(future)
+            except Exception as e:
+                texts[key] = e
+        results = [texts[key] for key in keys]
+        failure = next((result for result in results if isinstance(result, Exception)), None)
+        if failure is not None and not return_exceptions:
+            raise failure
+        return results
+
+
+def create_backend(name: str = PARSE_CACHE_BACKEND):
+    if name == "memory":
+        return MemoryCacheBackend()
+    if name == "disk":
+        return DiskCacheBackend()
+    if name == "mongo":
+        return MongoCacheBackend()
+    raise ValueError(f"Unknown parse cache backend: {name}")
+
+
+_parse_cache: ParseCache | None = None
+
+
+def get_parse_cache() -> ParseCache:
+    global _parse_cache
+    if _parse_cache is None:
+        _parse_cache = ParseCache(create_backend())
+    return _parse_cache
+
+
+def _cache_stats() -> dict:
+    if _parse_cache is None:
+        return {}
+    return {(result,): count for result, count in _parse_cache.stats.items()}
+
+
+registry.counter("doc2quiz_parse_cache_requests_total", "Parse cache lookups by result", ("result",)).set_function(_cache_stats)
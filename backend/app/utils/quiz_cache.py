@@ -0,0 +1,135 @@
+'''
+Memoizes generated quizzes by their inputs, so asking again for a quiz over unchanged
+material returns the stored one instead of repeating minutes of model calls
+'''
+from app.db.database import get_database
+from app.utils.metrics import registry
+from bson import ObjectId
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+QUIZ_CACHE_MAX_ENTRIES = int(os.getenv("QUIZ_CACHE_MAX_ENTRIES", 1000))
+
+
+def document_version(document: dict) -> str:
+    '''
+    Content version of a document, kept on every DocumentRef to it. A large PDF keeps its
+    id while its page ranges are parsed, so its status and parsed page count stand in for
+    its text.
+    '''
+    metadata = document.get("metadata") or {}
+    return f"{metadata.get('status', 'stored')}:{metadata.get('pages_parsed', '')}"
+
+
+def quiz_fingerprint(subjects: List[dict], params: dict) -> str:
+    '''
+    Hash of the subject ids, the documents each subject references with the content
+    versions on their refs, and the generation parameters. Adding or removing a document,
+    or more of a document's pages arriving, changes the fingerprint, so a quiz generated
+    from the old material can never be served for the new one, by this process or any other.
+    '''
+    material = [
+        {
+            "subject_id": str(subject["_id"]),
+            "documents": sorted([str(ref["id"]), ref.get("version") or ""] for ref in subject.get("documents", [])),
+        }
+        for subject in sorted(subjects, key=lambda subject: str(subject["_id"]))
+    ]
+    encoded = json.dumps({"subjects": material, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class QuizCache:
+    '''
+    In-process LRU of ready quizzes by fingerprint, backed by the cache_key stored in each
+    quiz's metadata. Quizzes still being generated are tracked too, so identical requests
+    arriving together share one generation.
+    '''
+    def __init__(self, max_entries: int = QUIZ_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._pending: Dict[str, ObjectId] = {}
+
+    async def lookup(self, key: str, quizzes=None) -> Optional[dict]:
+        '''
+        The quiz generated for key, or None. A quiz still being generated by this process
+        is returned with status pending. Misses are looked up in quizzes, the connected
+        database's by default.
+        '''
+        quiz = self._entries.get(key)
+        if quiz is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return quiz
+        if key in self._pending:
+            self.hits += 1
+            return {"_id": self._pending[key], "status": "pending"}
+        quizzes = quizzes if quizzes is not None else get_database().quizzes
+        quiz = await quizzes.find_one(
+            {"metadata.cache_key": key, "status": "ready"}, sort=[("created_at", -1)]
+        )
+        if quiz is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.remember(quiz)
+        return quiz
+
+    def pending(self, key: str, quiz_id: ObjectId):
+        self._pending[key] = quiz_id
+
+    def settle(self, key: str):
+        self._pending.pop(key, None)
+
+    def remember(self, quiz: dict):
+        key = quiz.get("metadata", {}).get("cache_key")
+        if not key or quiz.get("status") != "ready":
+            return
+        self._entries[key] = quiz
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def invalidate_subject(self, subject_id: ObjectId, quizzes=None):
+        '''
+        Forget every quiz generated from the subject, in this process and in the database,
+        once its documents change
+        '''
+        for key in [key for key, quiz in self._entries.items() if subject_id in quiz["subject_ids"]]:
+            del self._entries[key]
+        quizzes = quizzes if quizzes is not None else get_database().quizzes
+        await quizzes.update_many(
+            {"subject_ids": subject_id, "metadata.cache_key": {"$exists": True}},
+            {"$unset": {"metadata.cache_key": ""}},
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+
+
+_quiz_cache = None
+
+
+def get_quiz_cache() -> QuizCache:
+    global _quiz_cache
+    if _quiz_cache is None:
+        _quiz_cache = QuizCache()
+    return _quiz_cache
+
+
+def _cache_stats() -> dict:
+    if _quiz_cache is None:
+        return {}
+    return {("hits",): _quiz_cache.hits, ("misses",): _quiz_cache.misses}
+
+
+registry.counter("doc2quiz_quiz_cache_requests_total", "Quiz cache lookups by result", ("result",)).set_function(_cache_stats)
@@ -0,0 +1,306 @@
+'''
+Quiz generation as a langgraph graph: plan sections over the requested subjects, generate
+a batch of questions per section concurrently, and stream each accepted batch into the
+quiz document as it finishes
+'''
+from app.db.database import Database, get_database
+from app.db.schemas import Question
+from app.db.text_store import load_texts
+from app.utils.embeddings import HashingEmbedder, get_embedder
+from app.utils.quiz_cache import get_quiz_cache
+from app.utils.quiz_models import get_quiz_model
+from app.utils.vector_index import get_subject_index, index_documents, retrieve
+from bson import ObjectId
+from datetime import datetime
+from pymongo import ReturnDocument
+from typing import Annotated, Dict, List, TypedDict
+import asyncio
+import logging
+import math
+import operator
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QUIZ_BATCH_SIZE = int(os.getenv("QUIZ_BATCH_SIZE", 5))
+# Bounds the material sent per model call, and with it the time to the first question
+QUIZ_SECTION_CHARS = int(os.getenv("QUIZ_SECTION_CHARS", 6000))
+# Chunks retrieved around each section's seed chunk, before QUIZ_SECTION_CHARS cuts them off
+QUIZ_SECTION_CHUNKS = int(os.getenv("QUIZ_SECTION_CHUNKS", 8))
+# Documents of an unindexed subject indexed per batch; a quiz only waits for the first batch
+QUIZ_INDEX_BATCH_DOCUMENTS = int(os.getenv("QUIZ_INDEX_BATCH_DOCUMENTS", 16))
+QUIZ_DEDUPE_THRESHOLD = float(os.getenv("QUIZ_DEDUPE_THRESHOLD", 0.85))
+
+
+class QuestionDeduper:
+    '''
+    Rejects questions whose text is nearly identical to one already accepted for the quiz,
+    by cosine similarity of hashed bag-of-words vectors
+    '''
+    def __init__(self, threshold: float = QUIZ_DEDUPE_THRESHOLD):
+        self.threshold = threshold
+        self.embedder = HashingEmbedder(dim=512)
+        self.accepted = np.zeros((0, 512), dtype=np.float32)
+
+    def filter(self, questions: List[dict]) -> List[dict]:
+        if not questions:
+            return []
+        vectors = self.embedder.embed_sync([question["question"] for question in questions])
+        kept = []
+        for question, vector in zip(questions, vectors):
+            if len(self.accepted) and float((self.accepted @ vector).max()) >= self.threshold:
+                continue
+            self.accepted = np.vstack([self.accepted, vector])
+            kept.append(question)
+        return kept
+
+
+class QuizState(TypedDict):
+    quiz_id: ObjectId
+    subject_ids: List[ObjectId]
+    num_questions: int
+    # {"subject_id", "seed"} of each section
+    sections: List[dict]
+    generated: Annotated[int, operator.add]
+
+
+class SectionState(TypedDict):
+    quiz_id: ObjectId
+    subject_id: ObjectId
+    seed: str
+    count: int
+
+
+class QuizRun:
+    '''
+    Per-quiz collaborators shared by the graph nodes: the database, the model, the deduper,
+    the running count of accepted questions and the key the finished quiz is cached under
+    '''
+    def __init__(self, db: Database, model, num_questions: int, cache_key: str | None = None):
+        self.db = db
+        self.model = model
+        self.num_questions = num_questions
+        self.cache_key = cache_key
+        self.deduper = QuestionDeduper()
+        self.accepted = 0
+
+
+def generation_params(num_questions: int, model=None) -> dict:
+    '''
+    Everything besides the material that decides which questions a quiz gets
+    '''
+    return {
+        "num_questions": num_questions,
+        "model": (model or get_quiz_model()).name,
+        "batch_size": QUIZ_BATCH_SIZE,
+        "section_chars": QUIZ_SECTION_CHARS,
+        "section_chunks": QUIZ_SECTION_CHUNKS,
+        "dedupe_threshold": QUIZ_DEDUPE_THRESHOLD,
+    }
+
+
+# Background indexing of subjects stored before the ingestion stage existed, by subject id,
+# with an event set once their first batch is searchable
+_backfills: Dict[str, tuple[asyncio.Task, asyncio.Event]] = {}
+
+
+async def _backfill(subject_id: ObjectId, db: Database, first_batch: asyncio.Event):
+    index = get_subject_index(subject_id)
+    try:
+        await asyncio.to_thread(index.mark_incomplete)
+        # Documents an interrupted backfill already added are not added again
+        indexed = await asyncio.to_thread(index.document_ids)
+        # Documents linked from other subjects as near-duplicates are material of this subject too
+        subject = await db.subjects.find_one({"_id": subject_id}, {"documents": 1}) or {}
+        query = {"$or": [{"subject_id": subject_id}, {"_id": {"$in": [ref["id"] for ref in subject.get("documents", [])]}}]}
+        cursor = db.documents.find(query, {"filename": 1, "ocr_text": 1, "text_ref": 1}).batch_size(QUIZ_INDEX_BATCH_DOCUMENTS)
+        batch = []
+        async for document in cursor:
+            if str(document["_id"]) in indexed:
+                continue
+            batch.append(document)
+            if len(batch) == QUIZ_INDEX_BATCH_DOCUMENTS:
+                await index_documents(subject_id, await load_texts(batch, db.texts))
+                first_batch.set()
+                batch = []
+        await index_documents(subject_id, await load_texts(batch, db.texts))
+        await asyncio.to_thread(index.mark_complete)
+    finally:
+        first_batch.set()
+
+
+def _backfill_done(key: str, task: asyncio.Task):
+    _backfills.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Indexing subject %s failed", key, exc_info=task.exception())
+
+
+async def ensure_indexed(subject_id: ObjectId, db: Database):
+    '''
+    Index a subject stored before the ingestion stage existed, one document batch at a
+    time in the background. Only the first batch is waited for, so the time to the first
+    question does not grow with the subject; later quizzes see more of it. A backfill
+    interrupted by a restart is resumed by the next quiz over the subject, and so is a
+    subject indexed by another embedder, whose segments are dropped.
+    '''
+    key = str(subject_id)
+    if key not in _backfills:
+        index = get_subject_index(subject_id)
+        await asyncio.to_thread(index.drop_stale, get_embedder().name)
+        if len(index) and not index.incomplete:
+            return
+        first_batch = asyncio.Event()
+        task = asyncio.create_task(_backfill(subject_id, db, first_batch))
+        task.add_done_callback(lambda task: _backfill_done(key, task))
+        _backfills[key] = (task, first_batch)
+    task, first_batch = _backfills[key]
+    await first_batch.wait()
+    if task.done() and not task.cancelled() and task.exception() is not None:
+        raise task.exception()
+
+
+async def plan_sections(state: QuizState, config) -> dict:
+    '''
+    Spread the sections over the subjects in proportion to how much material each has
+    indexed, each around an evenly spaced seed chunk of its subject
+    '''
+    run: QuizRun = config["configurable"]["run"]
+    num_sections = math.ceil(state["num_questions"] / QUIZ_BATCH_SIZE)
+    await asyncio.gather(*[ensure_indexed(subject_id, run.db) for subject_id in state["subject_ids"]])
+    indexes = [(subject_id, get_subject_index(subject_id)) for subject_id in state["subject_ids"]]
+    indexes = [(subject_id, index) for subject_id, index in indexes if len(index)]
+    total = sum(len(index) for _, index in indexes)
+    sections = []
+    for subject_id, index in indexes:
+        share = max(1, round(num_sections * len(index) / total))
+        sections.extend({"subject_id": subject_id, "seed": seed} for seed in index.seeds(share))
+    return {"sections": sections}
+
+
+async def section_material(subject_id: ObjectId, seed: str, max_chars: int = QUIZ_SECTION_CHARS) -> str:
+    '''
+    The seed chunk followed by the chunks of the subject most related to it, at most
+    max_chars in all, so a section covers one topic wherever in the subject it appears
+    '''
+    parts, size = [seed[:max_chars]], len(seed[:max_chars])
+    for result in await retrieve(subject_id, seed, QUIZ_SECTION_CHUNKS):
+        if result["text"] == seed:
+            continue
+        if size + len(result["text"]) > max_chars:
+            break
+        parts.append(result["text"])
+        size += len(result["text"])
+    return "\n\n".join(parts)
+
+
+def dispatch_sections(state: QuizState) -> list:
+    from langgraph.types import Send
+
+    sections = state["sections"]
+    if not sections:
+        return [Send("finalize", state)]
+    per_section = math.ceil(state["num_questions"] / len(sections))
+    return [
+        Send("generate", {"quiz_id": state["quiz_id"], **section, "count": per_section})
+        for section in sections
+    ]
+
+
+async def generate(state: SectionState, config) -> dict:
+    '''
+    Gather the section's material, generate one batch, drop near-duplicates and append what
+    is left to the quiz document
+    '''
+    run: QuizRun = config["configurable"]["run"]
+    context = await section_material(state["subject_id"], state["seed"])
+    raw = await run.model.generate(context, state["count"])
+    remaining = run.num_questions - run.accepted
+    accepted = run.deduper.filter(raw)[:max(0, remaining)]
+    if not accepted:
+        return {"generated": 0}
+    run.accepted += len(accepted)
+    questions = [
+        Question(
+            question=item["question"],
+            choices=item["choices"],
+            answer=item["answer"],
+            explanation=item.get("explanation"),
+            metadata={"model": run.model.name},
+        ).model_dump(mode="json")
+        for item in accepted
+    ]
+    await run.db.quizzes.update_one(
+        {"_id": state["quiz_id"]},
+        {"$push": {"questions": {"$each": questions}}, "$set": {"updated_at": datetime.now()}},
+    )
+    return {"generated": len(questions)}
+
+
+async def finalize(state: QuizState, config) -> dict:
+    run: QuizRun = config["configurable"]["run"]
+    quiz = await run.db.quizzes.find_one_and_update(
+        {"_id": state["quiz_id"]},
+        {"$set": {"status": "ready", "updated_at": datetime.now(), "metadata.generated": state.get("generated", 0)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if quiz is not None and run.cache_key:
+        get_quiz_cache().remember(quiz)
+    return {}
+
+
+def build_quiz_graph():
+    # langgraph imports most of langchain-core; only load it once a quiz is generated
+    from langgraph.graph import StateGraph, START, END
+
+    graph = StateGraph(QuizState)
+    graph.add_node("plan", plan_sections)
+    graph.add_node("generate", generate)
+    graph.add_node("finalize", finalize)
+    graph.add_edge(START, "plan")
+    graph.add_conditional_edges("plan", dispatch_sections, ["generate", "finalize"])
+    graph.add_edge("generate", "finalize")
+    graph.add_edge("finalize", END)
+    return graph.compile()
+
+
+_quiz_graph = None
+
+
+def get_quiz_graph():
+    global _quiz_graph
+    if _quiz_graph is None:
+        _quiz_graph = build_quiz_graph()
+    return _quiz_graph
+
+
+async def generate_quiz(
+    quiz_id: ObjectId,
+    subject_ids: List[ObjectId],
+    num_questions: int,
+    model=None,
+    cache_key: str | None = None,
+    db: Database | None = None,
+):
+    '''
+    Run the generation graph for a pending quiz. The quiz is marked failed if generation raises.
+    With a cache_key the finished quiz is cached for later identical requests.
+    '''
+    db = db or get_database()
+    run = QuizRun(db, model or get_quiz_model(), num_questions, cache_key)
+    try:
+        await get_quiz_graph().ainvoke(
+            {"quiz_id": quiz_id, "subject_ids": subject_ids, "num_questions": num_questions, "sections": [], "generated": 0},
+            config={"configurable": {"run": run}},
+        )
+    except Exception as e:
+        logger.exception("Generating quiz %s failed", quiz_id)
+        await db.quizzes.update_one(
+            {"_id": quiz_id},
+            {"$set": {"status": "failed", "updated_at": datetime.now(), "metadata.error": str(e)}},
+        )
+        raise
+    finally:
+        if cache_key:
+            get_quiz_cache().settle(cache_key)
@@ -0,0 +1,159 @@
+'''
+Model backends that turn a section of study material into multiple-choice questions
+'''
+from typing import List
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+
+# "fake" is the local template model of the tests and benchmarks, never a production default
+QUIZ_MODEL_BACKEND = os.getenv("QUIZ_MODEL_BACKEND", "openai")
+QUIZ_MODEL = os.getenv("QUIZ_MODEL", "gpt-4o-mini")
+QUIZ_MODEL_MAX_CONCURRENCY = int(os.getenv("QUIZ_MODEL_MAX_CONCURRENCY", 4))
+QUIZ_MODEL_REQUESTS_PER_SECOND = float(os.getenv("QUIZ_MODEL_REQUESTS_PER_SECOND", 2))
+
+PROMPT = """You write multiple-choice quiz questions from study material.
+Write {count} questions that test understanding of the material below. Each question has
+exactly four choices and one correct answer, which must be one of the choices.
+Reply with only a JSON list of objects with the keys "question", "choices", "answer" and "explanation".
+
+Material:
+{context}
+"""
+
+
+class FakeQuizModel:
+    '''
+    Deterministic local model for development and tests. Builds fill-in-the-blank
+    questions from the sentences of the material, optionally after a simulated delay.
+    '''
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def generate(self, context: str, count: int) -> List[dict]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", context) if len(s.split()) >= 5]
+        words = sorted({w for w in re.findall(r"[A-Za-z]{5,}", context)}, key=lambda w: (-len(w), w))
+        questions = []
+        for sentence in sentences[:count]:
+            candidates = sorted(re.findall(r"[A-Za-z]{5,}", sentence), key=lambda w: (-len(w), w))
+            if not candidates:
+                continue
+            answer = candidates[0]
+            distractors = [w for w in words if w.lower() != answer.lower()][:3]
+            if len(distractors) < 3:
+                continue
+            choices = sorted([answer, *distractors], key=lambda w: hashlib.md5(f"{sentence}{w}".encode()).hexdigest())
+            questions.append({
+                "question": "Fill in the blank: " + re.sub(rf"\b{re.escape(answer)}\b", "_____", sentence, count=1),
+                "choices": choices,
+                "answer": answer,
+                "explanation": sentence,
+            })
+        return questions
+
+
+class OpenAIQuizModel:
+    '''
+    Questions from an OpenAI chat model through llama-index, imported on first use
+    '''
+    name = "openai"
+
+    def __init__(self, model: str = QUIZ_MODEL):
+        from llama_index.llms.openai import OpenAI
+
+        self.llm = OpenAI(model=model, temperature=0.2)
+
+    async def generate(self, context: str, count: int) -> List[dict]:
+        response = await self.llm.acomplete(PROMPT.format(count=count, context=context))
+        return parse_questions(response.text)
+
+
+def parse_questions(text: str) -> List[dict]:
+    '''
+    Pull the JSON list of questions out of a model reply, dropping malformed entries
+    '''
+    match = re.search(r"\[.*\]", text, re.DOTALL)
+    if not match:
+        return []
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return []
+    questions = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        choices = [str(choice) for choice in item.get("choices", [])]
+        answer = str(item.get("answer", ""))
+        if item.get("question") and len(choices) >= 2 and answer in choices:
+            questions.append({
+                "question": str(item["question"]),
+                "choices": choices,
+                "answer": answer,
+                "explanation": item.get("explanation"),
+            })
+    return questions
+
+
+class RateLimiter:
+    '''
+    Token bucket: at most rate acquisitions per second on average, with bursts up to burst
+    '''
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimitedModel:
+    '''
+    Wraps a model so calls are limited both in flight and per second
+    '''
+    def __init__(self, model, max_concurrency: int = QUIZ_MODEL_MAX_CONCURRENCY, requests_per_second: float = QUIZ_MODEL_REQUESTS_PER_SECOND):
+        self.model = model
+        self.name = model.name
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._limiter = RateLimiter(requests_per_second, burst=max_concurrency)
+
+    async def generate(self, context: str, count: int) -> List[dict]:
+        async with self._semaphore:
+            await self._limiter.acquire()
+            return await self.model.generate(context, count)
+
+
+_quiz_model = None
+
+
+def get_quiz_model():
+    global _quiz_model
+    if _quiz_model is None:
+        if QUIZ_MODEL_BACKEND == "fake":
+            model = FakeQuizModel()
+        elif QUIZ_MODEL_BACKEND == "openai":
+            model = OpenAIQuizModel()
+        else:
+            raise ValueError(f"Unknown quiz model backend: {QUIZ_MODEL_BACKEND}")
+        _quiz_model = RateLimitedModel(model)
+    return _quiz_model
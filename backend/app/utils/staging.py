@@ -0,0 +1,251 @@
+'''
+Streams uploaded files to a bounded on-disk staging area so request handlers never
+hold whole documents in memory
+'''
+from dataclasses import dataclass, field
+from app.utils.metrics import registry, stage_seconds, upload_bytes
+from fastapi import HTTPException, UploadFile
+from typing import Dict, List
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Size of each read from the multipart spool; this is the most a single upload holds in RAM
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Ceiling on the total bytes a single request may stage
+MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 512 * 1024 * 1024))
+# Ceiling on the bytes staged by this process across all in-flight requests
+MAX_PROCESS_BYTES = int(os.getenv("UPLOAD_MAX_PROCESS_BYTES", 4 * 1024 * 1024 * 1024))
+STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "doc2quiz-staging"))
+# Files of failed documents are kept for retries; anything older than this is swept
+STAGING_TTL = int(os.getenv("UPLOAD_STAGING_TTL", 24 * 3600))
+# Seconds between sweeps of the staging area while the server runs
+STAGING_SWEEP_INTERVAL = int(os.getenv("UPLOAD_STAGING_SWEEP_INTERVAL", 3600))
+RETRY_AFTER_SECONDS = 30
+
+
+class StagingBudget:
+    '''
+    Process-wide accounting of the bytes staged by uploads in flight. Reservations are
+    kept per request directory and released when the staged file is removed, or when its
+    document fails and the file is only kept for a retry. Whatever a swept directory still
+    holds is credited back.
+    '''
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+        self._directories: Dict[str, int] = {}
+
+    def reserve(self, size: int, directory: str = "") -> bool:
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            self._directories[directory] = self._directories.get(directory, 0) + size
+            return True
+
+    def release(self, size: int, directory: str = ""):
+        with self._lock:
+            held = self._directories.get(directory, 0)
+            size = min(size, held)
+            self.used -= size
+            if held - size:
+                self._directories[directory] = held - size
+            else:
+                self._directories.pop(directory, None)
+
+    def release_directory(self, directory: str) -> int:
+        '''
+        Release everything still reserved for a request directory; returns the bytes released
+        '''
+        with self._lock:
+            size = self._directories.pop(directory, 0)
+            self.used -= size
+            return size
+
+
+budget = StagingBudget(MAX_PROCESS_BYTES)
+
+registry.gauge("doc2quiz_staging_bytes", "Bytes of uploads staged on disk by this process").set_function(lambda: budget.used)
+
+
+@dataclass
+class StagedFile:
+    filename: str
+    path: str
+    size: int = 0
+    # Whether size still counts against the process budget
+    reserved: bool = True
+    _released: bool = field(default=False, repr=False)
+
+    @property
+    def ext(self) -> str:
+        return os.path.splitext(self.filename)[1].lower()
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def unreserve(self):
+        '''
+        Give the file's bytes back to the process budget but keep it on disk, e.g. for a
+        retry of a failed document; the sweep removes it if nobody retries
+        '''
+        if self.reserved:
+            self.reserved = False
+            budget.release(self.size, os.path.dirname(self.path))
+
+    def release(self):
+        '''
+        Delete the staged file and give its bytes back to the process budget. Safe to call twice.
+        '''
+        if self._released:
+            return
+        self._released = True
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.unreserve()
+        # Remove the per-request directory once its last file is gone
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+
+def _too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+def _staging_full() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Upload staging area is full, try again later",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+
+async def stage_upload(file: UploadFile, directory: str, index: int, request_budget: List[int]) -> StagedFile:
+    '''
+    Copy one UploadFile to disk in CHUNK_SIZE pieces. Writes run in a worker thread so
+    the event loop is never blocked on disk I/O.
+    '''
+    filename = file.filename or f"upload-{index}"
+    # Keep the extension so parsers can sniff the type from the path
+    _, ext = os.path.splitext(filename)
+    staged = StagedFile(filename=filename, path=os.path.join(directory, f"{index}{ext.lower()}"))
+    out = await asyncio.to_thread(open, staged.path, "wb")
+    read_seconds = write_seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = await file.read(CHUNK_SIZE)
+            read_seconds += time.perf_counter() - start
+            if not chunk:
+                break
+            request_budget[0] += len(chunk)
+            if request_budget[0] > MAX_REQUEST_BYTES:
+                raise _too_large(f"Upload exceeds the {MAX_REQUEST_BYTES} byte request limit")
+            if not budget.reserve(len(chunk), directory):
+                raise _staging_full()
+            staged.size += len(chunk)
+            start = time.perf_counter()
+            await asyncio.to_thread(out.write, chunk)
+            write_seconds += time.perf_counter() - start
+    except BaseException:
+        await asyncio.to_thread(out.close)
+        staged.release()
+        raise
+    await asyncio.to_thread(out.close)
+    stage_seconds.observe(read_seconds, stage="upload_read")
+    stage_seconds.observe(write_seconds, stage="upload_write")
+    upload_bytes.inc(staged.size)
+    return staged
+
+
+async def stage_uploads(files: List[UploadFile]) -> List[StagedFile]:
+    '''
+    Stage every file of a request into its own directory under STAGING_DIR.
+    On any failure the files staged so far are released before the error propagates.
+    '''
+    directory = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+    staged: List[StagedFile] = []
+    request_budget = [0]
+    try:
+        for index, file in enumerate(files):
+            staged.append(await stage_upload(file, directory, index, request_budget))
+            await file.close()
+    except BaseException:
+        for item in staged:
+            item.release()
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return staged
+
+
+def release_all(staged_files: List[StagedFile]):
+    for staged in staged_files:
+        staged.release()
+
+
+def sweep_staging_area(max_age: float = STAGING_TTL) -> int:
+    '''
+    Remove request directories older than max_age, e.g. failed uploads nobody retried,
+    and credit the budget with any bytes they still held. Returns the number of
+    directories removed.
+    '''
+    if not os.path.isdir(STAGING_DIR):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(STAGING_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            budget.release_directory(entry.path)
+            removed += 1
+    return removed
+
+
+async def sweep_periodically(interval: float = STAGING_SWEEP_INTERVAL):
+    '''
+    Sweep the staging area every interval seconds, off the event loop, until cancelled
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await asyncio.to_thread(sweep_staging_area)
+            if removed:
+                logger.info("Swept %d stale staging directories", removed)
+        except Exception:
+            logger.exception("Sweeping the staging area failed")
+
+
+def spool_to_file(source, filename: str) -> str:
+    '''
+    Copy a file-like object into its own directory under STAGING_DIR for code that needs
+    a path, returning the path. Blocking; call it off the event loop. A copy left behind
+    by a dead worker is swept with the other stale request directories.
+    '''
+    directory = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, os.path.basename(filename))
+    with open(path, "wb") as out:
+        shutil.copyfileobj(source, out, CHUNK_SIZE)
+    return path
+
+
+def remove_spooled(path: str):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
@@ -0,0 +1,172 @@
+'''
+Tracks the progress of upload jobs in jobs_collection, per document and per stage
+'''
+from app.db import database
+from app.db.schemas import UploadJob, DocumentStatus
+from app.utils.metrics import span, stage_errors, stage_seconds
+from app.utils.staging import StagedFile
+from bson import ObjectId
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List
+import asyncio
+import time
+
+TERMINAL_STATES = ["done", "failed"]
+
+# Local wake-ups for event streams served by this process; other processes fall back to polling
+_listeners: Dict[ObjectId, List[asyncio.Event]] = defaultdict(list)
+
+
+def _notify(job_id: ObjectId):
+    for event in _listeners.get(job_id, []):
+        event.set()
+
+
+@asynccontextmanager
+async def listen(job_id: ObjectId):
+    '''
+    Yields an Event that is set whenever this process updates the job
+    '''
+    event = asyncio.Event()
+    _listeners[job_id].append(event)
+    try:
+        yield event
+    finally:
+        _listeners[job_id].remove(event)
+        if not _listeners[job_id]:
+            del _listeners[job_id]
+
+
+class JobTracker:
+    '''
+    Writes job and document state changes to jobs_collection, or to the jobs collection a
+    route handler injected. Documents are addressed by their index in the upload, matching
+    the order of the staged files.
+    '''
+    def __init__(self, job_id: ObjectId, subject_id: ObjectId, filenames: List[str], jobs=None):
+        self.job_id = job_id
+        self.subject_id = subject_id
+        self.filenames = filenames
+        self.jobs = jobs if jobs is not None else database.jobs_collection
+        self.created = time.monotonic()
+
+    @classmethod
+    async def create(cls, name: str, staged_files: List[StagedFile], subject_id: ObjectId | None = None, jobs=None) -> "JobTracker":
+        jobs = jobs if jobs is not None else database.jobs_collection
+        now = datetime.now()
+        job = UploadJob(
+            subject_id=subject_id or ObjectId(),
+            name=name,
+            created_at=now,
+            updated_at=now,
+            documents=[
+                DocumentStatus(filename=staged.filename, staged_path=staged.path, size=staged.size)
+                for staged in staged_files
+            ],
+            metadata={},
+        )
+        await jobs.insert_one(job.to_mongo())
+        return cls(job.id, job.subject_id, [staged.filename for staged in staged_files], jobs)
+
+    async def discard(self):
+        await self.jobs.delete_one({"_id": self.job_id})
+
+    async def _update(self, fields: dict):
+        fields["updated_at"] = datetime.now()
+        await self.jobs.update_one({"_id": self.job_id}, {"$set": fields})
+        _notify(self.job_id)
+
+    async def started(self):
+        await self._update({
+            "status": "running",
+            "started_at": datetime.now(),
+            "metadata.queue_wait": time.monotonic() - self.created,
+        })
+
+    async def document_state(self, indexes: List[int], state: str, timings: Dict[str, float] | None = None, **fields):
+        '''
+        Set the state of one or more documents and record the stage timings spent getting there
+        '''
+        update = {}
+        for index in indexes:
+            update[f"documents.{index}.state"] = state
+            for stage, seconds in (timings or {}).items():
+                update[f"documents.{index}.timings.{stage}"] = seconds
+            for key, value in fields.items():
+                update[f"documents.{index}.{key}"] = value
+        if update:
+            await self._update(update)
+
+    async def finished(self, error: Exception | None = None):
+        await self._update({
+            "status": "failed" if error else "done",
+            "finished_at": datetime.now(),
+            "error": str(error) if error else None,
+            "metadata.total": time.monotonic() - self.created,
+        })
+
+
+class StageTimer:
+    '''
+    Measures the seconds spent in a block: `with StageTimer("parse") as t: ...; t.elapsed`.
+    A named stage is also recorded in the stage metrics and traced as a span.
+    '''
+    def __init__(self, stage: str | None = None):
+        self.stage = stage
+        self.elapsed = 0.0
+        self._span = None
+
+    def __enter__(self):
+        if self.stage:
+            self._span = span(f"pipeline.{self.stage}")
+            self._span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        if self.stage:
+            stage_seconds.observe(self.elapsed, stage=self.stage)
+            if exc[0] is not None:
+                stage_errors.inc(stage=self.stage)
+            self._span.__exit__(*exc)
+        return False
+
+
+async def get_job(job_id: ObjectId, jobs=None) -> dict | None:
+    jobs = jobs if jobs is not None else database.jobs_collection
+    return await jobs.find_one({"_id": job_id})
+
+
+def serialize_job(job: dict) -> dict:
+    '''
+    Make a job document JSON-friendly for API responses
+    '''
+    return {
+        "job_id": str(job["_id"]),
+        "subject_id": str(job["subject_id"]),
+        "name": job["name"],
+        "status": job["status"],
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+        "started_at": job["started_at"].isoformat() if job.get("started_at") else None,
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None,
+        "error": job.get("error"),
+        "documents": [
+            {
+                "filename": document["filename"],
+                "state": document["state"],
+                "document_id": str(document["document_id"]) if document.get("document_id") else None,
+                "error": document.get("error"),
+                "retryable": document["state"] == "failed" and bool(document.get("staged_path")),
+                # Set while a large PDF is parsed range by range
+                "pages": document.get("pages"),
+                "pages_parsed": document.get("pages_parsed"),
+                "timings": document.get("timings", {}),
+            }
+            for document in job["documents"]
+        ],
+        "timings": {key: job.get("metadata", {}).get(key) for key in ["queue_wait", "total"]},
+    }
@@ -0,0 +1,300 @@
+'''
+Array-backed chunk index per subject. Each ingested batch of documents becomes a segment
+of NumPy files on disk that is memory-mapped for search, so retrieving the most relevant
+chunks for quiz generation never loads whole documents.
+'''
+from app.utils.embeddings import chunk_text, get_embedder
+from dataclasses import dataclass
+from typing import List
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX_DIR", os.path.join(tempfile.gettempdir(), "doc2quiz-index"))
+
+
+@dataclass
+class Segment:
+    '''
+    One memory-mapped batch of chunks. Row i of vectors belongs to the chunk whose text is
+    text[offsets[i]:offsets[i + 1]] and whose document is documents[document_rows[i]].
+    embedder and dim are those of the embedder the vectors came from.
+    '''
+    name: str
+    vectors: np.ndarray
+    offsets: np.ndarray
+    document_rows: np.ndarray
+    text: np.ndarray
+    documents: List[dict]
+    embedder: str
+    dim: int
+
+    def chunk(self, row: int) -> str:
+        return bytes(self.text[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    @classmethod
+    def load(cls, directory: str, name: str) -> "Segment":
+        base = os.path.join(directory, name)
+        with open(f"{base}.meta.json") as f:
+            meta = json.load(f)
+        return cls(
+            name=name,
+            vectors=np.load(f"{base}.vectors.npy", mmap_mode="r"),
+            offsets=np.load(f"{base}.offsets.npy", mmap_mode="r"),
+            document_rows=np.load(f"{base}.docs.npy", mmap_mode="r"),
+            text=np.memmap(f"{base}.text.bin", dtype=np.uint8, mode="r") if meta["text_bytes"] else np.zeros(0, dtype=np.uint8),
+            documents=meta["documents"],
+            embedder=meta["embedder"],
+            dim=meta["dim"],
+        )
+
+    def files(self, directory: str) -> List[str]:
+        return [os.path.join(directory, self.name + suffix) for suffix in [".meta.json", ".vectors.npy", ".offsets.npy", ".docs.npy", ".text.bin"]]
+
+
+def _write_segment(directory: str, vectors: np.ndarray, chunks: List[str], document_rows: List[int], documents: List[dict], embedder: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    name = uuid.uuid4().hex
+    base = os.path.join(directory, name)
+    encoded = [chunk.encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    np.save(f"{base}.vectors.npy", vectors.astype(np.float32, copy=False))
+    np.save(f"{base}.offsets.npy", offsets)
+    np.save(f"{base}.docs.npy", np.asarray(document_rows, dtype=np.int32))
+    with open(f"{base}.text.bin", "wb") as f:
+        f.write(b"".join(encoded))
+    # The meta file is written last; a segment without one is incomplete and ignored
+    meta = {"documents": documents, "dim": int(vectors.shape[1]), "embedder": embedder, "text_bytes": int(offsets[-1])}
+    with open(f"{base}.meta.json.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{base}.meta.json.tmp", f"{base}.meta.json")
+    return name
+
+
+class SubjectIndex:
+    '''
+    All segments of one subject. Search scores every segment with a single matrix-vector
+    product (vectors are L2-normalised, so this is cosine similarity) and merges the top k.
+    Segments embedded by another embedder than the query are skipped, as their scores
+    mean nothing; drop_stale removes them so the subject is indexed again.
+    '''
+    def __init__(self, subject_id, root: str = None):
+        self.subject_id = str(subject_id)
+        self.directory = os.path.join(root or EMBEDDING_INDEX_DIR, self.subject_id)
+        self.segments: List[Segment] = []
+        self._loaded: set[str] = set()
+        self._skipped: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _segment_names(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(entry[:-len(".meta.json")] for entry in os.listdir(self.directory) if entry.endswith(".meta.json"))
+
+    def refresh(self):
+        '''
+        Map any segments written since the last call, including by other processes
+        '''
+        with self._lock:
+            names = self._segment_names()
+            if set(names) == self._loaded:
+                return
+            self.segments = [segment for segment in self.segments if segment.name in names]
+            for name in names:
+                if name not in self._loaded:
+                    self.segments.append(Segment.load(self.directory, name))
+            self._loaded = set(names)
+
+    def __len__(self) -> int:
+        return sum(len(segment.offsets) - 1 for segment in self.segments)
+
+    def add(self, vectors: np.ndarray, chunks: List[str], document_rows: List[int], documents: List[dict], embedder: str = "hashing"):
+        if not chunks:
+            return
+        _write_segment(self.directory, vectors, chunks, document_rows, documents, embedder)
+        self.refresh()
+
+    def search(self, query: np.ndarray, k: int = 8, embedder: str | None = None) -> List[dict]:
+        '''
+        Top k chunks for a query vector embedded by embedder, by default whichever embedder
+        the segments come from as long as the dimensions agree
+        '''
+        self.refresh()
+        query = query.reshape(-1).astype(np.float32, copy=False)
+        candidates = []
+        for segment_number, segment in enumerate(self.segments):
+            if segment.dim != len(query) or (embedder is not None and segment.embedder != embedder):
+                if segment.name not in self._skipped:
+                    self._skipped.add(segment.name)
+                    logger.warning(
+                        "Skipping segment %s of subject %s: embedded by %s (%d dimensions), the query by %s (%d dimensions)",
+                        segment.name, self.subject_id, segment.embedder, segment.dim, embedder or "another embedder", len(query),
+                    )
+                continue
+            if not len(segment.vectors):
+                continue
+            scores = segment.vectors @ query
+            top = min(k, len(scores))
+            rows = np.argpartition(-scores, top - 1)[:top]
+            candidates.extend((float(scores[row]), segment_number, int(row)) for row in rows)
+        candidates.sort(reverse=True)
+
+        results = []
+        for score, segment_number, row in candidates[:k]:
+            segment = self.segments[segment_number]
+            document = segment.documents[int(segment.document_rows[row])]
+            results.append({
+                "score": score,
+                "text": segment.chunk(row),
+                "document_id": document["document_id"],
+                "filename": document["filename"],
+            })
+        return results
+
+    def seeds(self, count: int) -> List[str]:
+        '''
+        count evenly spaced chunks of the subject, to build sections around. Only those
+        chunks are read.
+        '''
+        self.refresh()
+        total = len(self)
+        if not total or count <= 0:
+            return []
+        bounds = np.cumsum([0] + [len(segment.offsets) - 1 for segment in self.segments])
+        seeds = []
+        for position in sorted({int(start) for start in np.linspace(0, total, min(count, total), endpoint=False)}):
+            segment_number = int(np.searchsorted(bounds, position, side="right") - 1)
+            seeds.append(self.segments[segment_number].chunk(position - int(bounds[segment_number])))
+        return seeds
+
+    def drop_stale(self, embedder: str) -> int:
+        '''
+        Delete the segments embedded by another embedder than the given one, whose
+        documents then count as not indexed. Returns the number of segments deleted.
+        '''
+        self.refresh()
+        stale = [segment for segment in self.segments if segment.embedder != embedder]
+        for segment in stale:
+            logger.warning(
+                "Dropping segment %s of subject %s: embedded by %s, not %s",
+                segment.name, self.subject_id, segment.embedder, embedder,
+            )
+            self._unlink(segment)
+        if stale:
+            self.segments, self._loaded = [], set()
+            self.refresh()
+        return len(stale)
+
+    def _unlink(self, segment: Segment):
+        for path in segment.files(self.directory):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def document_ids(self) -> set[str]:
+        self.refresh()
+        return {document["document_id"] for segment in self.segments for document in segment.documents}
+
+    @property
+    def _incomplete_marker(self) -> str:
+        return os.path.join(self.directory, "INCOMPLETE")
+
+    @property
+    def incomplete(self) -> bool:
+        '''
+        Whether documents stored before the index existed are still being added to it
+        '''
+        return os.path.exists(self._incomplete_marker)
+
+    def mark_incomplete(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._incomplete_marker, "w"):
+            pass
+
+    def mark_complete(self):
+        try:
+            os.unlink(self._incomplete_marker)
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        '''
+        Merge the segments of each embedder into one, so long-lived subjects map a single
+        set of files
+        '''
+        self.refresh()
+        groups: dict[tuple[str, int], List[Segment]] = {}
+        for segment in self.segments:
+            groups.setdefault((segment.embedder, segment.dim), []).append(segment)
+        merged = False
+        for (embedder, _), segments in groups.items():
+            if len(segments) < 2:
+                continue
+            documents, vectors, chunks, document_rows = [], [], [], []
+            for segment in segments:
+                base = len(documents)
+                documents.extend(segment.documents)
+                vectors.append(np.asarray(segment.vectors))
+                chunks.extend(segment.chunk(row) for row in range(len(segment.offsets) - 1))
+                document_rows.extend(base + int(row) for row in segment.document_rows)
+            _write_segment(self.directory, np.concatenate(vectors), chunks, document_rows, documents, embedder)
+            for segment in segments:
+                self._unlink(segment)
+            merged = True
+        if merged:
+            self.segments, self._loaded = [], set()
+            self.refresh()
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.segments, self._loaded = [], set()
+
+
+_indexes: dict[str, SubjectIndex] = {}
+
+
+def get_subject_index(subject_id) -> SubjectIndex:
+    key = str(subject_id)
+    if key not in _indexes:
+        _indexes[key] = SubjectIndex(key)
+    return _indexes[key]
+
+
+async def index_documents(subject_id, documents: List[dict]) -> int:
+    '''
+    Chunk and embed freshly stored documents (dicts with _id, filename and ocr_text) and
+    add them to the subject's index as one segment. Returns the number of chunks added.
+    '''
+    embedder = get_embedder()
+    chunks, document_rows, refs = [], [], []
+    for row, document in enumerate(documents):
+        refs.append({"document_id": str(document["_id"]), "filename": document["filename"]})
+        for chunk in chunk_text(document["ocr_text"]):
+            chunks.append(chunk)
+            document_rows.append(row)
+    if not chunks:
+        return 0
+    vectors = await embedder.embed(chunks)
+    index = get_subject_index(subject_id)
+    await asyncio.to_thread(index.add, vectors, chunks, document_rows, refs, embedder.name)
+    return len(chunks)
+
+
+async def retrieve(subject_id, query: str, k: int = 8) -> List[dict]:
+    '''
+    Top-k chunks of a subject for a query
+    '''
+    embedder = get_embedder()
+    query_vector = await embedder.embed([query])
+    return get_subject_index(subject_id).search(query_vector[0], k, embedder.name)
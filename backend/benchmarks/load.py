@@ -0,0 +1,376 @@
+'''
+Load benchmark for the upload pipeline. Drives app.server:app over ASGI with concurrent
+multi-file uploads, using a parser stand-in with tunable latency and mongomock (or a real
+Mongo given --mongo-uri), and reports uploads/s, latency percentiles, peak RSS and
+event-loop lag. Results are printed as JSON; with --baseline the run is compared against
+an earlier result and the exit status is non-zero on a regression.
+
+    python -m benchmarks.load [--uploads 50] [--concurrency 8] [--mix txt=2,md=1,pdf=1]
+                              [--file-kb 64] [--parser-latency 0.2] [--output load.json]
+                              [--baseline load.json]
+'''
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+# Relative change allowed against a baseline before a metric counts as a regression
+LOAD_REGRESSION_TOLERANCE = float(os.getenv("LOAD_REGRESSION_TOLERANCE", 0.2))
+
+# metric path -> (direction, absolute change ignored as noise)
+COMPARED_METRICS = {
+    "uploads_per_second": ("higher", 0.5),
+    "upload_latency.p99": ("lower", 0.005),
+    "job_latency.p99": ("lower", 0.01),
+    "event_loop_lag.p99": ("lower", 0.005),
+    "peak_rss_mb": ("lower", 16),
+}
+
+WORDS = (
+    "cell membrane protein enzyme energy reaction molecule gradient transport signal "
+    "nucleus gene expression pathway structure function receptor channel binding rate"
+).split()
+
+
+@dataclass
+class LoadConfig:
+    uploads: int = 50
+    concurrency: int = 8
+    files_per_upload: int = 4
+    # Relative weight of each file type in an upload
+    mix: Dict[str, int] = field(default_factory=lambda: {"txt": 2, "md": 1, "pdf": 1})
+    file_kb: int = 64
+    pdf_pages: int = 4
+    # Seconds per parser request, single file or batch
+    parser_latency: float = 0.2
+    # Extra seconds per file in a batch
+    parser_latency_per_file: float = 0.0
+    lag_interval: float = 0.01
+    seed: int = 0
+    mongo_uri: str | None = None
+
+
+class FakeParserService:
+    '''
+    Stands in for ParserService: sleeps like a remote parse and returns text derived
+    from the file name
+    '''
+    def __init__(self, latency: float = 0.2, latency_per_file: float = 0.0, text_kb: int = 4):
+        self.latency = latency
+        self.latency_per_file = latency_per_file
+        self.text = " ".join(WORDS) * max(1, text_kb * 1024 // len(" ".join(WORDS)))
+        self.requests = 0
+        self.files = 0
+
+    async def parse(self, source, file_name: str | None = None) -> str:
+        from app.utils.ocr import source_name
+
+        name = source_name(source, file_name)
+        self.requests += 1
+        self.files += 1
+        await asyncio.sleep(self.latency + self.latency_per_file)
+        return f"# {os.path.basename(name)}\n\n{self.text}"
+
+    async def parse_many(self, sources: list) -> list:
+        from app.utils.ocr import source_name
+
+        # Named like the real service names them; a source without a name fails on its own
+        results = []
+        for source in sources:
+            try:
+                results.append(f"# {os.path.basename(source_name(source))}\n\n{self.text}")
+            except ValueError as e:
+                results.append(e)
+        self.requests += 1
+        self.files += len(sources)
+        await asyncio.sleep(self.latency + self.latency_per_file * len(sources))
+        return results
+
+    async def aclose(self):
+        pass
+
+
+def make_text(size: int, rng: random.Random, markdown: bool = False) -> bytes:
+    lines, total = [], 0
+    while total < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(12))
+        if markdown and rng.random() < 0.1:
+            line = "## " + line
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines).encode("utf-8")[:size]
+
+
+def make_pdf(pages: int, token: str) -> bytes:
+    '''
+    A PDF without a text layer, so the whole file goes to the parser. The token keeps the
+    bytes unique and the parse cache cold.
+    '''
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=612, height=792)
+    writer.add_metadata({"/Title": token})
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def make_upload(config: LoadConfig, number: int, rng: random.Random) -> List[tuple]:
+    kinds = rng.choices(list(config.mix), weights=list(config.mix.values()), k=config.files_per_upload)
+    files = []
+    for i, kind in enumerate(kinds):
+        filename = f"upload{number}-file{i}.{kind}"
+        if kind == "pdf":
+            content, mime = make_pdf(config.pdf_pages, filename), "application/pdf"
+        else:
+            content, mime = make_text(config.file_kb * 1024, rng, markdown=kind == "md"), "text/plain"
+        files.append(("files", (filename, content, mime)))
+    return files
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0, "mean": 0.0}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": ordered[-1], "mean": sum(ordered) / len(ordered)}
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+async def watch_loop(interval: float, lags: List[float], rss: List[float]):
+    '''
+    Measures how late the loop wakes a sleeping task, the delay every other task sees too
+    '''
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - start - interval))
+        rss.append(current_rss_mb())
+
+
+async def wait_for_job(job_id: str) -> dict:
+    from app.utils.upload_jobs import TERMINAL_STATES, get_job, listen
+    from bson import ObjectId
+
+    async with listen(ObjectId(job_id)) as changed:
+        while True:
+            job = await get_job(ObjectId(job_id))
+            if job["status"] in TERMINAL_STATES:
+                return job
+            try:
+                await asyncio.wait_for(changed.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+
+
+def stage_summary() -> dict:
+    from app.utils.metrics import stage_seconds
+
+    sums, counts = {}, {}
+    for name, labels, value in stage_seconds.samples():
+        if name.endswith("_sum"):
+            sums[labels["stage"]] = value
+        elif name.endswith("_count"):
+            counts[labels["stage"]] = value
+    return {stage: {"count": counts[stage], "mean_seconds": sums[stage] / counts[stage]} for stage in counts if counts[stage]}
+
+
+async def run(config: LoadConfig) -> dict:
+    '''
+    Run one load test in this process and return its results. The database binding and
+    parser service it swaps in are restored afterwards.
+    '''
+    import mongomock
+    from app.db import database
+    from benchmarks.mock_db import AsyncMockDatabase
+    from app.server import app
+    from app.utils import ocr
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    rng = random.Random(config.seed)
+    uploads = [make_upload(config, number, rng) for number in range(config.uploads)]
+    upload_bytes = sum(len(content) for files in uploads for _, (_, content, _) in files)
+
+    previous_database, previous_parser = database._database, ocr._parser_service
+    parser = FakeParserService(config.parser_latency, config.parser_latency_per_file)
+    try:
+        if config.mongo_uri:
+            # connect() keeps an existing binding, so bind the benchmark's client explicitly
+            mongo_client = AsyncIOMotorClient(config.mongo_uri, **database.client_options())
+            database.use(mongo_client[f"doc2quiz_load_{os.getpid()}"], mongo_client)
+        else:
+            mock_client = mongomock.MongoClient()
+            database.use(AsyncMockDatabase(mock_client["doc2quiz_load"]), mock_client)
+        ocr._parser_service = parser
+        return await _measure(config, uploads, upload_bytes, parser, app)
+    finally:
+        ocr._parser_service = previous_parser
+        # A no-op when the app lifespan already closed the benchmark's client
+        database.close()
+        if previous_database is not None:
+            database.use(previous_database.db, previous_database.client)
+
+
+async def _measure(config: LoadConfig, uploads: List[list], upload_bytes: int, parser, app) -> dict:
+    from app.utils import accounts, jobs
+    import httpx
+
+    upload_latencies, job_latencies, lags, rss = [], [], [], []
+    outcomes = {"done": 0, "failed": 0, "rejected": 0, "error": 0}
+    rss_start = current_rss_mb()
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load", timeout=None) as client:
+            pending = list(enumerate(uploads))
+
+            async def user():
+                while pending:
+                    number, files = pending.pop(0)
+                    start = time.perf_counter()
+                    response = await client.post("/api/upload", files=files, data={"name": f"Load {number}"})
+                    upload_latencies.append(time.perf_counter() - start)
+                    # Queue full or over a quota
+                    if response.status_code in (429, 503):
+                        outcomes["rejected"] += 1
+                        continue
+                    if response.status_code != 200:
+                        outcomes["error"] += 1
+                        continue
+                    job = await wait_for_job(response.json()["job_id"])
+                    job_latencies.append(time.perf_counter() - start)
+                    outcomes[job["status"]] += 1
+
+            watcher = asyncio.create_task(watch_loop(config.lag_interval, lags, rss))
+            start = time.perf_counter()
+            await asyncio.gather(*[user() for _ in range(config.concurrency)])
+            elapsed = time.perf_counter() - start
+            watcher.cancel()
+
+    completed = outcomes["done"] + outcomes["failed"]
+    files = sum(len(files) for files in uploads)
+    return {
+        "config": asdict(config),
+        "elapsed_seconds": elapsed,
+        "uploads": {"submitted": config.uploads, "completed": completed, **outcomes},
+        "uploads_per_second": completed / elapsed,
+        "files_per_second": files / elapsed,
+        "megabytes_per_second": upload_bytes / 2 ** 20 / elapsed,
+        # POST /api/upload until the response, i.e. staging and queueing
+        "upload_latency": percentiles(upload_latencies),
+        # POST /api/upload until the job is done
+        "job_latency": percentiles(job_latencies),
+        "event_loop_lag": percentiles(lags),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": max(rss, default=rss_start) - rss_start,
+        "parser": {"requests": parser.requests, "files": parser.files},
+        # Every upload comes from one client without a user_id, one account, so these bound
+        # how much work is in flight at once; 0 is unlimited
+        "quotas": {"client": asdict(accounts.CLIENT_QUOTA), "anonymous": asdict(accounts.ANONYMOUS_QUOTA)},
+        "max_running_per_account": jobs.JOB_MAX_RUNNING_PER_TENANT,
+        "stages": stage_summary(),
+    }
+
+
+def _lookup(result: dict, path: str) -> float:
+    for key in path.split("."):
+        result = result[key]
+    return result
+
+
+def regressions(result: dict, baseline: dict, tolerance: float = LOAD_REGRESSION_TOLERANCE) -> List[str]:
+    '''
+    Metrics that got worse than baseline by more than tolerance (and more than noise)
+    '''
+    failures = []
+    for path, (better, noise) in COMPARED_METRICS.items():
+        current, previous = _lookup(result, path), _lookup(baseline, path)
+        change = current - previous if better == "lower" else previous - current
+        if change > noise and change > tolerance * previous:
+            failures.append(f"{path} {current:.4g} vs baseline {previous:.4g}")
+    if result["uploads"]["completed"] < result["uploads"]["submitted"]:
+        failures.append(f"{result['uploads']['submitted'] - result['uploads']['completed']} uploads did not complete")
+    return failures
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip().lstrip(".")] = int(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure upload throughput and latency of the API server")
+    parser.add_argument("--uploads", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--files-per-upload", type=int, default=4)
+    parser.add_argument("--mix", type=parse_mix, default="txt=2,md=1,pdf=1", help="file types and weights, e.g. txt=2,pdf=1")
+    parser.add_argument("--file-kb", type=int, default=64, help="size of each text file")
+    parser.add_argument("--pdf-pages", type=int, default=4)
+    parser.add_argument("--parser-latency", type=float, default=0.2, help="seconds per parser request")
+    parser.add_argument("--parser-latency-per-file", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", help="use this Mongo server instead of mongomock")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    args = parser.parse_args()
+
+    config = LoadConfig(
+        uploads=args.uploads, concurrency=args.concurrency, files_per_upload=args.files_per_upload,
+        mix=args.mix, file_kb=args.file_kb, pdf_pages=args.pdf_pages, parser_latency=args.parser_latency,
+        parser_latency_per_file=args.parser_latency_per_file, seed=args.seed, mongo_uri=args.mongo_uri,
+    )
+    # Scratch space of this run only; the parser import is not needed with the stand-in
+    with tempfile.TemporaryDirectory(prefix="doc2quiz-load-") as scratch:
+        os.environ.setdefault("UPLOAD_STAGING_DIR", os.path.join(scratch, "staging"))
+        os.environ.setdefault("EMBEDDING_INDEX_DIR", os.path.join(scratch, "index"))
+        os.environ.setdefault("PARSE_CACHE_BACKEND", "memory")
+        os.environ["PARSER_PRELOAD"] = "false"
+        os.environ["QUIZ_MODEL_BACKEND"] = "fake"
+        # All uploads share one client address and the anonymous account; lift their
+        # quotas and running limit unless set, so the run measures the pipeline rather
+        # than admission and fair sharing
+        for account in ["CLIENT", "ANONYMOUS"]:
+            for limit in ["JOBS", "BYTES", "PAGES"]:
+                os.environ.setdefault(f"UPLOAD_{account}_MAX_{limit}", "0")
+        os.environ.setdefault("JOB_MAX_RUNNING_PER_TENANT", os.getenv("JOB_WORKERS", "4"))
+        result = asyncio.run(run(config))
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["regressions"] = regressions(result, json.load(f))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    sys.exit(1 if result.get("regressions") else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''
+Motor-compatible wrappers around mongomock, for running the app without a Mongo server
+(the tests and the load benchmark). They live outside the app package, which only runs
+on Motor. mongomock's calls are synchronous, so they run inline on the event loop.
+'''
+
+
+class AsyncMockCursor:
+    '''
+    Async iteration over a mongomock cursor, mirroring the parts of Motor's cursor we use
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n):
+        self._cursor = self._cursor.skip(n)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        docs = list(self._cursor)
+        return docs if length is None else docs[:length]
+
+
+class AsyncMockCollection:
+    '''
+    Wraps a mongomock collection so its methods can be awaited like Motor's
+    '''
+    def __init__(self, collection):
+        self.sync = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncMockCursor(self.sync.find(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return AsyncMockCursor(self.sync.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return call
+
+
+class AsyncMockDatabase:
+    '''
+    A mongomock database whose collections behave like Motor collections
+    '''
+    def __init__(self, database):
+        self.sync = database
+
+    def __getitem__(self, name):
+        return AsyncMockCollection(self.sync[name])
+
+    def __getattr__(self, name):
+        return self[name]
@@ -0,0 +1,84 @@
+'''
+Micro-benchmark of the stored models on the hot paths: building a Document (validated and
+with model_construct), turning it into the dict Motor inserts (model_dump against
+to_mongo), BSON-encoding that dict, and validating a stored dict read back. Runs each
+operation for documents of 1 KB to 10 MB of text and prints operations per second as JSON.
+
+    python -m benchmarks.schemas [--sizes 1024,102400,1048576,10485760] [--seconds 0.5] [--output schemas.json]
+'''
+from app.db.schemas import Document
+from bson import ObjectId
+from datetime import datetime
+from typing import Callable, Dict, List
+import argparse
+import bson
+import json
+import time
+
+DEFAULT_SIZES = [1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+
+
+def document_fields(size: int) -> dict:
+    words = "the cell membrane controls what enters and leaves the cell "
+    return {
+        "_id": ObjectId(),
+        "subject_id": ObjectId(),
+        "filename": "notes.pdf",
+        "ocr_text": (words * (size // len(words) + 1))[:size],
+        "uploaded_at": datetime.now(),
+        "metadata": {"encoding": "utf-8", "language": "en", "language_confidence": 0.9, "normalized": True},
+    }
+
+
+def operations(size: int) -> Dict[str, Callable[[], object]]:
+    fields = document_fields(size)
+    document = Document(**fields)
+    stored = document.to_mongo()
+    return {
+        "build": lambda: Document(**fields),
+        "construct": lambda: Document.model_construct(**fields),
+        "model_dump": lambda: document.model_dump(by_alias=True),
+        "to_mongo": lambda: document.to_mongo(),
+        "bson_encode": lambda: bson.encode(stored),
+        "validate": lambda: Document.model_validate(stored),
+    }
+
+
+def rate(operation: Callable[[], object], seconds: float) -> float:
+    '''
+    Calls per second, over batches that double until seconds have passed
+    '''
+    calls, batch = 0, 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            operation()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+        batch *= 2
+
+
+def measure(sizes: List[int] | None = None, seconds: float = 0.5) -> dict:
+    results = {}
+    for size in sizes or DEFAULT_SIZES:
+        results[str(size)] = {name: round(rate(operation, seconds), 1) for name, operation in operations(size).items()}
+    return {"ops_per_second": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure build/dump/validate throughput of the stored models")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="text sizes in bytes")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each operation and size")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    result = measure([int(size) for size in args.sizes.split(",")], args.seconds)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
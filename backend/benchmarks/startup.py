@@ -0,0 +1,106 @@
+'''
+Startup benchmark for app.server:app. Each run is a fresh interpreter that imports the app,
+runs the lifespan startup and sends two requests, so module import costs are measured cold.
+Prints the medians as JSON and exits non-zero when a budget is exceeded.
+
+    python -m benchmarks.startup [--runs 5] [--output startup.json]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Regression thresholds, in seconds
+STARTUP_IMPORT_BUDGET = float(os.getenv("STARTUP_IMPORT_BUDGET", 1.5))
+STARTUP_FIRST_REQUEST_BUDGET = float(os.getenv("STARTUP_FIRST_REQUEST_BUDGET", 0.25))
+
+# Modules that must only load on first use
+HEAVY_MODULES = ["llama_parse", "llama_index.core", "langgraph.graph", "nest_asyncio"]
+
+CHILD = '''
+import asyncio, json, sys, time
+start = time.perf_counter()
+from app.server import app
+import_seconds = time.perf_counter() - start
+heavy = [name for name in %r if name in sys.modules]
+
+async def main():
+    import httpx
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        startup_seconds = time.perf_counter() - start
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            start = time.perf_counter()
+            (await client.get("/health")).raise_for_status()
+            first_request_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            (await client.get("/health")).raise_for_status()
+            second_request_seconds = time.perf_counter() - start
+    return {
+        "import_seconds": import_seconds,
+        "startup_seconds": startup_seconds,
+        "first_request_seconds": first_request_seconds,
+        "second_request_seconds": second_request_seconds,
+        "heavy_modules_on_import": heavy,
+    }
+
+print(json.dumps(asyncio.run(main())))
+''' % (HEAVY_MODULES,)
+
+
+def measure_once() -> dict:
+    env = {
+        **os.environ,
+        # Keep the run independent of a reachable database and of the background import
+        "MONGO_ENSURE_INDEXES": "false",
+        "PARSER_PRELOAD": "false",
+        "QUIZ_MODEL_BACKEND": "fake",
+    }
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=backend, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(runs: int = 5) -> dict:
+    samples = [measure_once() for _ in range(runs)]
+    result = {
+        key: statistics.median(sample[key] for sample in samples)
+        for key in ["import_seconds", "startup_seconds", "first_request_seconds", "second_request_seconds"]
+    }
+    result["heavy_modules_on_import"] = sorted({name for sample in samples for name in sample["heavy_modules_on_import"]})
+    result["runs"] = runs
+    result["budgets"] = {"import_seconds": STARTUP_IMPORT_BUDGET, "first_request_seconds": STARTUP_FIRST_REQUEST_BUDGET}
+    return result
+
+
+def regressions(result: dict) -> list:
+    failures = [
+        f"{key} {result[key]:.3f}s over budget {budget:.3f}s"
+        for key, budget in result["budgets"].items()
+        if result[key] > budget
+    ]
+    if result["heavy_modules_on_import"]:
+        failures.append(f"heavy modules imported at startup: {', '.join(result['heavy_modules_on_import'])}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and first-request latency of the API server")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    result = measure(args.runs)
+    result["regressions"] = regressions(result)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    sys.exit(1 if result["regressions"] else 0)
+
+
+if __name__ == "__main__":
+    main()
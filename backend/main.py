@@ -1,9 +1,10 @@
-from app.server import run_server
 from dotenv import load_dotenv
 
-
+# Settings are read when the app modules are imported, so load them first
 load_dotenv()
 
+from app.server import run_server
+
 if __name__ == "__main__":
     run_server()
     
\ No newline at end of file
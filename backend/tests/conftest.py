@@ -1,3 +1,17 @@
 from dotenv import load_dotenv
+import os
+
+# Tests never call a real model; set before any app module reads it
+os.environ["QUIZ_MODEL_BACKEND"] = "fake"
+
+from benchmarks.mock_db import AsyncMockDatabase
+import mongomock
+import pytest
 
 load_dotenv()
+
+
+@pytest.fixture
+def async_mongo():
+    """An empty mongomock database with awaitable collection methods."""
+    return AsyncMockDatabase(mongomock.MongoClient()["test_doc_2_quiz"])
@@ -0,0 +1,137 @@
+from app.db import database
+from app.db.archive import ARCHIVE_FORMAT, ArchiveError, ArchiveTooLargeError, _Writer, export_archive, import_archive
+from app.db.text_store import TextHandle, store_texts
+from bson import ObjectId
+from datetime import datetime
+from benchmarks.mock_db import AsyncMockDatabase
+import mongomock
+import pytest
+
+LONG_TEXT = "Photosynthesis turns light into chemical energy. " * 400
+
+
+@pytest.fixture
+def source(async_mongo):
+    database.use(async_mongo)
+    yield async_mongo
+    database.close()
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+async def replay(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def populate(db):
+    '''
+    Subject "Biology" with a long (offloaded) document, a short one and a document still
+    being parsed; subject "Revision" linking the long document; one quiz over both
+    '''
+    biology, revision = ObjectId(), ObjectId()
+    long_doc = {"_id": ObjectId(), "subject_id": biology, "filename": "long.md", "ocr_text": LONG_TEXT, "metadata": {}}
+    short_doc = {"_id": ObjectId(), "subject_id": biology, "filename": "short.md", "ocr_text": "Cells", "metadata": {}}
+    partial = {"_id": ObjectId(), "subject_id": biology, "filename": "book.pdf", "ocr_text": "", "metadata": {"status": "parsing"}}
+    stored = await store_texts([long_doc, short_doc, partial], threshold=1024)
+    db.sync.documents.insert_many(stored)
+    db.sync.document_pages.insert_one({"document_id": partial["_id"], "start": 0, "end": 10, "text": "Chapter 1"})
+    now = datetime(2025, 1, 1)
+    db.sync.subjects.insert_many([
+        {"_id": biology, "name": "Biology", "user_id": "u1", "created_at": now, "metadata": {},
+         "documents": [{"id": doc["_id"], "filename": doc["filename"]} for doc in [long_doc, short_doc, partial]]},
+        {"_id": revision, "name": "Revision", "user_id": "u1", "created_at": now, "metadata": {},
+         "documents": [{"id": long_doc["_id"], "filename": "long copy.md"}]},
+    ])
+    db.sync.quizzes.insert_one({"_id": ObjectId(), "subject_ids": [biology, revision], "status": "ready", "questions": []})
+    return biology, revision, long_doc
+
+
+@pytest.mark.asyncio
+async def test_export_streams_a_subject_with_linked_documents(source):
+    _, revision, long_doc = await populate(source)
+    chunks = await collect(export_archive(database.get_database(), [revision], batch_size=1, chunk_bytes=64))
+
+    target = AsyncMockDatabase(mongomock.MongoClient()["target"])
+    counts = await import_archive(replay(chunks), database.use(target))
+    assert counts == {"text": 1, "page": 0, "document": 1, "subject": 1, "quiz": 1}
+    imported = target.sync.documents.find_one({})
+    assert imported["_id"] == long_doc["_id"]
+    assert await TextHandle(imported).read() == LONG_TEXT
+
+
+@pytest.mark.asyncio
+async def test_round_trip_is_idempotent(source):
+    biology, _, _ = await populate(source)
+    data = b"".join(await collect(export_archive(database.get_database(), user_id="u1", batch_size=2)))
+    # Records are reassembled across chunk boundaries
+    chunks = [data[start:start + 7] for start in range(0, len(data), 7)]
+
+    target = AsyncMockDatabase(mongomock.MongoClient()["target"])
+    target_db = database.use(target)
+    counts = await import_archive(replay(chunks), target_db, user_id="u2", batch_size=2)
+    # The long document and the quiz come along with both subjects
+    assert counts == {"text": 2, "page": 1, "document": 4, "subject": 2, "quiz": 2}
+    assert target.sync.documents.count_documents({}) == 3
+    assert target.sync.quizzes.count_documents({}) == 1
+    assert target.sync.document_pages.count_documents({}) == 1
+    assert {subject["user_id"] for subject in target.sync.subjects.find({})} == {"u2"}
+    assert target.sync.subjects.find_one({"_id": biology})["documents"] == source.sync.subjects.find_one({"_id": biology})["documents"]
+
+    await import_archive(replay(chunks), target_db)
+    assert target.sync.documents.count_documents({}) == 3
+    assert target.sync.document_texts.count_documents({}) == source.sync.document_texts.count_documents({})
+
+
+@pytest.mark.asyncio
+async def test_import_rejects_damaged_archives(source):
+    await populate(source)
+    chunks = await collect(export_archive(database.get_database(), chunk_bytes=64))
+    data = b"".join(chunks)
+    target = AsyncMockDatabase(mongomock.MongoClient()["target"])
+    target_db = database.use(target)
+    with pytest.raises(ArchiveError, match="truncated"):
+        await import_archive(replay([data[:len(data) // 2]]), target_db, batch_size=1)
+    with pytest.raises(ArchiveError):
+        await import_archive(replay([b"not an archive"]), target_db)
+    # Nothing of a damaged archive is written, even past the first batch
+    assert all(target.sync[name].count_documents({}) == 0 for name in ["subjects", "documents", "document_texts", "quizzes"])
+
+
+def archive_of(*records) -> bytes:
+    writer = _Writer(chunk_bytes=1 << 20)
+    for kind, data in records:
+        writer.write(kind, data)
+    return writer.take(final=True)
+
+
+@pytest.mark.asyncio
+async def test_import_rejects_malformed_records(source):
+    header = ("header", {"format": ARCHIVE_FORMAT, "version": 1})
+    subject = ("subject", {"_id": ObjectId(), "name": "Biology"})
+    for records in [
+        [("header", None)],
+        [header, ("subject", None)],
+        [header, subject, ("end", {})],
+        [header, subject, ("end", None)],
+    ]:
+        with pytest.raises(ArchiveError):
+            await import_archive(replay([archive_of(*records)]), database.get_database())
+    assert source.sync.subjects.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_import_limits_archive_size(source):
+    await populate(source)
+    chunks = await collect(export_archive(database.get_database(), chunk_bytes=64))
+    target = AsyncMockDatabase(mongomock.MongoClient()["target"])
+    target_db = database.use(target)
+    with pytest.raises(ArchiveTooLargeError, match="bytes"):
+        await import_archive(replay(chunks), target_db, max_bytes=len(b"".join(chunks)) - 1)
+    with pytest.raises(ArchiveTooLargeError, match="records"):
+        await import_archive(replay(chunks), target_db, max_records=5)
+    assert target.sync.subjects.count_documents({}) == 0
+    counts = await import_archive(replay(chunks), target_db, max_bytes=len(b"".join(chunks)), max_records=100)
+    assert counts["subject"] == 2
@@ -0,0 +1,53 @@
+from app.db import database
+from app.db.database import PoolMetrics
+from types import SimpleNamespace
+import time
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def disconnected():
+    database.close()
+    yield
+    database.close()
+
+
+def test_get_database_requires_connect():
+    with pytest.raises(RuntimeError):
+        database.get_database()
+
+
+def test_connect_is_lazy_and_configurable(monkeypatch):
+    monkeypatch.setattr(database, "MONGO_MAX_POOL_SIZE", 7)
+    monkeypatch.setattr(database, "MONGO_WRITE_CONCERN", "majority")
+    monkeypatch.setattr(database, "MONGO_COMPRESSORS", "zlib")
+    start = time.monotonic()
+    # Nothing listens on this port; creating the client must not wait for it
+    connected = database.connect("mongodb://127.0.0.1:1", "lazy_test")
+    assert time.monotonic() - start < 1
+    assert database.get_database() is connected
+    assert database.connect() is connected
+    assert database.documents_collection.name == "documents"
+    assert database.texts_collection.name == "document_texts"
+    assert connected.client.options.pool_options.max_pool_size == 7
+    assert connected.client.write_concern.document == {"w": "majority"}
+    assert connected.client.options.pool_options._compression_settings.compressors == ["zlib"]
+
+    database.close()
+    assert database.documents_collection is None
+
+
+def test_pool_metrics_counts_connections():
+    metrics = PoolMetrics()
+    event = SimpleNamespace(address=("db", 27017))
+    for _ in range(2):
+        metrics.connection_created(event)
+        metrics.connection_check_out_started(event)
+        metrics.connection_checked_out(event)
+    metrics.connection_checked_in(event)
+    metrics.connection_closed(event)
+    metrics.connection_check_out_started(event)
+    metrics.connection_check_out_failed(event)
+    assert metrics.snapshot() == {"db:27017": {
+        "open": 1, "created": 2, "closed": 1, "waiting": 0, "in_use": 1, "checked_out": 2, "checkout_failed": 1,
+    }}
@@ -0,0 +1,35 @@
+from app.db import database
+from app.db.indexes import INDEXES, ensure_indexes
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def collections(async_mongo, monkeypatch):
+    for attribute in INDEXES:
+        monkeypatch.setattr(database, attribute, async_mongo[attribute.removesuffix("_collection")])
+    return async_mongo
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes(collections):
+    created = await ensure_indexes()
+    assert created["documents_collection"] == ["subject_id_id", "fingerprint_lsh"]
+    indexes = collections.sync.documents.index_information()
+    assert list(indexes["subject_id_id"]["key"]) == [("subject_id", 1), ("_id", 1)]
+    ttl = collections.sync.parse_cache.index_information()["expires_at_ttl"]
+    assert ttl["expireAfterSeconds"] == 0
+    assert "user_id_created_at" in collections.sync.subjects.index_information()
+    assert "subject_ids" in collections.sync.quizzes.index_information()
+    # Running again on every start is harmless
+    assert (await ensure_indexes()).keys() == created.keys()
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_skips_failing_collections(collections, monkeypatch):
+    async def denied(indexes):
+        raise PermissionError("not authorized")
+
+    monkeypatch.setattr(database.jobs_collection, "create_indexes", denied, raising=False)
+    created = await ensure_indexes()
+    assert "jobs_collection" not in created
+    assert "documents_collection" in created
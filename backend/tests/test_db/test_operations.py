@@ -0,0 +1,48 @@
+from app.db import database, operations
+from app.db.operations import insert_documents
+from pymongo.errors import AutoReconnect
+from bson import ObjectId
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def documents(async_mongo, monkeypatch):
+    collection = async_mongo.documents
+    monkeypatch.setattr(database, "documents_collection", collection)
+    monkeypatch.setattr(operations, "WRITE_RETRY_BACKOFF", 0)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_insert_documents_tolerates_already_written(documents):
+    existing = {"_id": ObjectId(), "filename": "a.txt"}
+    documents.sync.insert_one(existing)
+    await insert_documents([existing, {"_id": ObjectId(), "filename": "b.txt"}])
+    assert documents.sync.count_documents({}) == 2
+
+
+@pytest.mark.asyncio
+async def test_insert_documents_retries_transient_errors(documents, monkeypatch):
+    calls = []
+    bulk_write = documents.sync.bulk_write
+
+    async def flaky_bulk_write(requests, ordered=True):
+        calls.append(ordered)
+        if len(calls) == 1:
+            raise AutoReconnect("primary stepped down")
+        return bulk_write(requests, ordered=ordered)
+
+    monkeypatch.setattr(documents, "bulk_write", flaky_bulk_write, raising=False)
+    await insert_documents([{"_id": ObjectId(), "filename": "a.txt"}])
+    assert calls == [False, False]
+    assert documents.sync.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+async def test_insert_documents_gives_up(documents, monkeypatch):
+    async def down(requests, ordered=True):
+        raise AutoReconnect("no primary")
+
+    monkeypatch.setattr(documents, "bulk_write", down, raising=False)
+    with pytest.raises(AutoReconnect):
+        await insert_documents([{"_id": ObjectId(), "filename": "a.txt"}])
@@ -0,0 +1,31 @@
+from app.db.schemas import Document, DocumentRef, Subject
+from bson import ObjectId
+from datetime import datetime
+from pydantic import ValidationError
+import pytest
+
+
+def make_subject() -> Subject:
+    return Subject(name="Biology", created_at=datetime(2025, 1, 1), metadata={},
+                   documents=[DocumentRef(id=ObjectId(), filename="notes.md")])
+
+
+def test_object_id_fields_accept_hex_strings_and_dump_as_strings():
+    document_id = ObjectId()
+    ref = DocumentRef(id=str(document_id), filename="notes.md")
+    assert ref.id == document_id
+    assert ref.model_dump()["id"] == document_id
+    assert ref.model_dump(mode="json")["id"] == str(document_id)
+    assert Subject.model_json_schema()["properties"]["_id"]["type"] == "string"
+    with pytest.raises(ValidationError):
+        DocumentRef(id="not-an-id", filename="notes.md")
+
+
+def test_to_mongo_matches_model_dump_without_copying_text():
+    subject = make_subject()
+    assert subject.to_mongo() == subject.model_dump(by_alias=True)
+    text = "x" * 100_000
+    document = Document(subject_id=ObjectId(), filename="a.md", ocr_text=text, uploaded_at=datetime.now(), metadata={})
+    stored = document.to_mongo()
+    assert stored == document.model_dump(by_alias=True)
+    assert stored["ocr_text"] is text
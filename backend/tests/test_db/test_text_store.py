@@ -0,0 +1,93 @@
+from app.db import database, text_store
+from app.db.migrate_text import migrate
+from app.db.text_store import TextHandle, load_texts, store_texts
+from bson import ObjectId
+import pytest
+
+LONG_TEXT = "The mitochondria is the powerhouse of the cell. " * 2000
+
+
+@pytest.fixture(autouse=True)
+def collections(async_mongo, monkeypatch):
+    monkeypatch.setattr(database, "documents_collection", async_mongo.documents)
+    monkeypatch.setattr(database, "texts_collection", async_mongo.document_texts)
+    return async_mongo
+
+
+def document(text: str) -> dict:
+    return {"_id": ObjectId(), "filename": "notes.md", "ocr_text": text}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+async def test_long_text_is_offloaded(collections, monkeypatch, codec):
+    monkeypatch.setattr(text_store, "TEXT_BLOB_CHUNK_BYTES", 64)
+    short, long = document("short"), document(LONG_TEXT)
+    stored = await store_texts([short, long], threshold=1024, codec=codec)
+
+    assert stored[0] is short
+    assert "ocr_text" not in stored[1]
+    ref = stored[1]["text_ref"]
+    assert ref["codec"] == codec
+    assert ref["size"] == len(LONG_TEXT)
+    assert ref["stored_size"] < len(LONG_TEXT) // 10
+    assert ref["chunks"] == collections.sync.document_texts.count_documents({"text_id": ref["id"]}) > 1
+    # The caller's dict still has its text, e.g. for indexing
+    assert long["ocr_text"] == LONG_TEXT
+
+    handle = TextHandle(stored[1])
+    assert handle.size == len(LONG_TEXT)
+    assert not handle.loaded
+    assert await handle.read() == LONG_TEXT
+    assert handle.loaded
+
+
+@pytest.mark.asyncio
+async def test_load_texts_resolves_refs(collections):
+    stored = await store_texts([document(LONG_TEXT), document("inline")], threshold=1024)
+    collections.sync.documents.insert_many(stored)
+    loaded = await load_texts(list(collections.sync.documents.find({}, {"ocr_text": 1, "text_ref": 1})))
+    assert [item["ocr_text"] for item in loaded] == [LONG_TEXT, "inline"]
+    assert all("text_ref" not in item for item in loaded)
+
+
+@pytest.mark.asyncio
+async def test_migrate_converts_long_documents(collections):
+    collections.sync.documents.insert_many([document(LONG_TEXT), document("inline"), document(LONG_TEXT)])
+
+    dry = await migrate(threshold=1024, batch_size=1, dry_run=True)
+    assert (dry["scanned"], dry["converted"]) == (3, 2)
+    assert collections.sync.document_texts.count_documents({}) == 0
+
+    stats = await migrate(threshold=1024, batch_size=1)
+    assert stats["converted"] == 2
+    assert stats["bytes_after"] < stats["bytes_before"]
+    assert collections.sync.documents.count_documents({"text_ref": {"$exists": True}, "ocr_text": {"$exists": False}}) == 2
+    assert collections.sync.documents.count_documents({"ocr_text": "inline"}) == 1
+    for stored in collections.sync.documents.find({"text_ref": {"$exists": True}}):
+        assert await TextHandle(stored).read() == LONG_TEXT
+
+    # Nothing left to convert on a second run
+    assert (await migrate(threshold=1024))["converted"] == 0
+
+
+@pytest.mark.asyncio
+async def test_migrate_leaves_no_orphaned_blobs(collections, monkeypatch):
+    failing, ok = document(LONG_TEXT), document(LONG_TEXT)
+    collections.sync.documents.insert_many([failing, ok])
+    # An earlier run was interrupted after writing the blob of ok
+    await store_texts([ok], threshold=1024)
+    update_one = collections.documents.update_one
+
+    async def flaky_update(query, update):
+        if query["_id"] == failing["_id"]:
+            raise ConnectionError("lost the primary")
+        return await update_one(query, update)
+    monkeypatch.setattr(database.documents_collection, "update_one", flaky_update)
+
+    stats = await migrate(threshold=1024)
+    assert (stats["converted"], stats["failed"]) == (1, 1)
+    assert collections.sync.documents.find_one({"_id": failing["_id"]})["ocr_text"] == LONG_TEXT
+    stored = collections.sync.documents.find_one({"_id": ok["_id"]})
+    # Only the blob the converted document references is left
+    assert {blob["text_id"] for blob in collections.sync.document_texts.find()} == {stored["text_ref"]["id"]}
@@ -2,43 +2,61 @@ import pytest
 import pytest_asyncio
 from httpx import AsyncClient, ASGITransport
 import mongomock
-from motor.motor_asyncio import AsyncIOMotorClient
 from app.server import app
 from app.db import database
+from app.utils import parse_cache, jobs, vector_index, quiz_models, quiz_cache
+from benchmarks.mock_db import AsyncMockDatabase
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Store original database clients
-original_client = database.client
-original_db = database.db
-original_documents_collection = database.documents_collection
-original_subjects_collection = database.subjects_collection
-
 @pytest.fixture(scope="function", autouse=True)
-def mock_mongo_client(monkeypatch):
-    """Mocks the MongoDB client for each test function."""
+def mock_mongo_client():
+    """Binds the app to an empty mongomock database for each test function."""
     mock_client = mongomock.MongoClient()
-    mock_db = mock_client["test_doc_2_quiz"]
-
-    # Mock the database objects used in the application
-    monkeypatch.setattr(database, "client", mock_client)
-    monkeypatch.setattr(database, "db", mock_db)
-    # Assuming collections are accessed via database.db
-    monkeypatch.setattr(database, "documents_collection", mock_db.documents)
-    monkeypatch.setattr(database, "subjects_collection", mock_db.subjects)
-
-    # Ensure collections are clean before tests start (redundant now with mock_db fixture, but harmless)
-    mock_db.documents.drop()
-    mock_db.subjects.drop()
-
-    yield mock_client  # Provide the mock client to tests if needed
-
-    # Cleanup: Restore original database client and drop mock collections after tests
-    # Monkeypatch handles restoration automatically when the function scope ends
-    mock_db.documents.drop()
-    mock_db.subjects.drop()
-    # No need to manually restore with monkeypatch.setattr here, it's handled by pytest
+    # Collections are wrapped so the application can await them like Motor collections
+    database.use(AsyncMockDatabase(mock_client["test_doc_2_quiz"]), mock_client)
+    yield mock_client
+    database.close()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def fresh_parse_cache(monkeypatch):
+    """Gives every test an empty in-memory parse cache."""
+    monkeypatch.setattr(parse_cache, "_parse_cache", parse_cache.ParseCache(parse_cache.MemoryCacheBackend()))
+
+
+@pytest.fixture(scope="function", autouse=True)
+def fresh_quiz_cache(monkeypatch):
+    """Gives every test an empty quiz cache."""
+    cache = quiz_cache.QuizCache()
+    monkeypatch.setattr(quiz_cache, "_quiz_cache", cache)
+    return cache
+
+
+@pytest.fixture(scope="function", autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    """Writes subject embedding indexes under the test's temporary directory."""
+    monkeypatch.setattr(vector_index, "EMBEDDING_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(vector_index, "_indexes", {})
+    return tmp_path / "index"
+
+
+@pytest.fixture(scope="function", autouse=True)
+def fake_quiz_model(monkeypatch):
+    """Generates quizzes with the deterministic local model."""
+    model = quiz_models.FakeQuizModel()
+    monkeypatch.setattr(quiz_models, "_quiz_model", quiz_models.RateLimitedModel(model, requests_per_second=1000))
+    return model
+
+
+@pytest_asyncio.fixture(scope="function", autouse=True)
+async def fresh_job_queue(monkeypatch):
+    """Gives every test its own job queue, bound to the test's event loop."""
+    queue = jobs.JobQueue(workers=2)
+    monkeypatch.setattr(jobs, "_job_queue", queue)
+    yield queue
+    await queue.stop()
 
 
 @pytest_asyncio.fixture(scope="function")
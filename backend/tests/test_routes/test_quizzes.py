@@ -0,0 +1,158 @@
+import pytest
+from bson import ObjectId
+from datetime import datetime
+from httpx import AsyncClient
+from io import BytesIO
+from app.routes.upload import process_files
+from app.utils.staging import StagedFile
+from app.utils.upload_jobs import JobTracker
+
+NOTES = """# Cell biology
+
+The mitochondria produces most of the chemical energy needed by the cell.
+Ribosomes translate messenger RNA into chains of amino acids.
+The nucleus stores genetic information inside chromosomes.
+
+# Ecology
+
+Photosynthesis converts sunlight, water and carbon dioxide into glucose.
+Predators regulate populations of herbivores within an ecosystem.
+Decomposers return nutrients from dead organisms back into the soil.
+"""
+
+
+async def upload_subject(client: AsyncClient, fresh_job_queue) -> str:
+    files = [('files', ('biology.md', BytesIO(NOTES.encode()), 'text/markdown'))]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Biology"})).json()
+    await fresh_job_queue.join()
+    return upload["subject_id"]
+
+
+@pytest.mark.asyncio
+async def test_create_quiz(client: AsyncClient, fresh_job_queue, fake_quiz_model):
+    subject_id = await upload_subject(client, fresh_job_queue)
+
+    response = await client.post("/api/quizzes", json={"subject_ids": [subject_id], "num_questions": 4})
+    assert response.status_code == 200
+    created = response.json()
+    assert created["status"] == "pending"
+    await fresh_job_queue.join()
+
+    quiz = (await client.get(f"/api/quizzes/{created['quiz_id']}")).json()
+    assert quiz["status"] == "ready"
+    assert quiz["subject_ids"] == [subject_id]
+    assert 0 < len(quiz["questions"]) <= 4
+    for question in quiz["questions"]:
+        assert question["answer"] in question["choices"]
+        assert len(question["choices"]) == 4
+    assert len({question["question"] for question in quiz["questions"]}) == len(quiz["questions"])
+    assert quiz["metadata"]["generated"] == len(quiz["questions"])
+
+
+@pytest.mark.asyncio
+async def test_create_quiz_unknown_subject(client: AsyncClient):
+    response = await client.post("/api/quizzes", json={"subject_ids": [str(ObjectId())]})
+    assert response.status_code == 404
+    response = await client.post("/api/quizzes", json={"subject_ids": ["nope"]})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_create_quiz_validates_request(client: AsyncClient):
+    assert (await client.post("/api/quizzes", json={"subject_ids": []})).status_code == 422
+    assert (await client.post("/api/quizzes", json={"subject_ids": ["x"], "num_questions": 0})).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_get_quiz_not_found(client: AsyncClient):
+    assert (await client.get(f"/api/quizzes/{ObjectId()}")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_create_quiz_is_cached(client: AsyncClient, fresh_job_queue, fake_quiz_model, fresh_quiz_cache):
+    subject_id = await upload_subject(client, fresh_job_queue)
+    request = {"subject_ids": [subject_id], "num_questions": 4}
+    fake_quiz_model.latency = 0.2
+
+    first = (await client.post("/api/quizzes", json=request)).json()
+    # An identical request while the first is generating shares it
+    assert (await client.post("/api/quizzes", json=request)).json() == {**first, "cached": True}
+    await fresh_job_queue.join()
+    calls = fake_quiz_model.calls
+
+    again = (await client.post("/api/quizzes", json=request)).json()
+    assert again == {"quiz_id": first["quiz_id"], "status": "ready", "cached": True}
+    assert fake_quiz_model.calls == calls
+
+    # A restarted process finds the quiz through its stored cache key
+    fresh_quiz_cache.clear()
+    assert (await client.post("/api/quizzes", json=request)).json()["quiz_id"] == first["quiz_id"]
+
+    other = (await client.post("/api/quizzes", json={**request, "num_questions": 3})).json()
+    refreshed = (await client.post("/api/quizzes", json={**request, "refresh": True})).json()
+    assert not other["cached"] and not refreshed["cached"]
+    assert len({first["quiz_id"], other["quiz_id"], refreshed["quiz_id"]}) == 3
+    await fresh_job_queue.join()
+
+
+@pytest.mark.asyncio
+async def test_cached_quiz_invalidated_by_new_documents(client: AsyncClient, fresh_job_queue, mock_db, tmp_path):
+    subject_id = await upload_subject(client, fresh_job_queue)
+    request = {"subject_ids": [subject_id], "num_questions": 4}
+    first = (await client.post("/api/quizzes", json=request)).json()
+    await fresh_job_queue.join()
+
+    # Store another document into the subject, as a retried upload would
+    path = tmp_path / "genetics.md"
+    path.write_text("Genes are segments of deoxyribonucleic acid that encode proteins.")
+    staged = StagedFile(filename="genetics.md", path=str(path), size=path.stat().st_size)
+    job = await JobTracker.create("Biology", [staged], subject_id=ObjectId(subject_id))
+    await process_files([(0, staged)], job, datetime.now())
+
+    quiz = mock_db.quizzes.find_one({"_id": ObjectId(first["quiz_id"])})
+    assert "cache_key" not in quiz["metadata"]
+    second = (await client.post("/api/quizzes", json=request)).json()
+    assert not second["cached"]
+    assert second["quiz_id"] != first["quiz_id"]
+    await fresh_job_queue.join()
+
+
+@pytest.mark.asyncio
+async def test_quiz_jobs_are_charged_to_the_callers_account(client: AsyncClient, fresh_job_queue, fake_quiz_model, monkeypatch):
+    from app.utils.jobs import Quota
+    subject_id = await upload_subject(client, fresh_job_queue)
+    fake_quiz_model.latency = 0.2
+    submitted = []
+    submit = fresh_job_queue.submit
+    monkeypatch.setattr(fresh_job_queue, "submit", lambda *args, **kwargs: submitted.append(submit(*args, **kwargs)) or submitted[-1])
+    monkeypatch.setattr("app.utils.accounts.USER_QUOTA", Quota(jobs=1))
+
+    request = {"subject_ids": [subject_id], "num_questions": 4, "user_id": "u1"}
+    assert (await client.post("/api/quizzes", json=request)).status_code == 200
+    job = submitted[0]
+    assert job.tenant == "user:u1"
+    assert "user:u1" in job.accounts
+    # Quizzes never take the small-job lane, however few questions they ask for
+    assert not job.small_lane
+    response = await client.post("/api/quizzes", json={**request, "refresh": True})
+    assert response.status_code == 429
+    await fresh_job_queue.join()
+
+
+@pytest.mark.asyncio
+async def test_cached_quiz_is_resolved_from_the_subjects_query(client: AsyncClient, fresh_job_queue, monkeypatch):
+    from app.db.database import get_database
+    subject_id = await upload_subject(client, fresh_job_queue)
+    request = {"subject_ids": [subject_id], "num_questions": 4}
+    first = (await client.post("/api/quizzes", json=request)).json()
+    await fresh_job_queue.join()
+
+    db = get_database()
+    calls = []
+    for collection, method in [(db.documents, "find"), (db.quizzes, "find_one")]:
+        original = getattr(collection, method)
+        monkeypatch.setattr(collection, method, lambda *args, original=original, name=method, **kwargs: calls.append(name) or original(*args, **kwargs))
+    again = (await client.post("/api/quizzes", json=request)).json()
+    assert again == {"quiz_id": first["quiz_id"], "status": "ready", "cached": True}
+    # Only the subjects are read; the documents are not, and the quiz comes from memory
+    assert calls == []
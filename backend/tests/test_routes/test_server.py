@@ -0,0 +1,105 @@
+from benchmarks import load, schemas
+from benchmarks.startup import HEAVY_MODULES, measure_once, regressions
+from io import BytesIO
+import pytest
+
+
+def test_server_starts_without_heavy_imports():
+    """Importing and starting the app leaves the parser and LLM libraries unloaded."""
+    sample = measure_once()
+    assert sample["heavy_modules_on_import"] == []
+    assert "nest_asyncio" in HEAVY_MODULES
+
+
+def test_regressions_reports_budget_overruns():
+    result = {
+        "import_seconds": 2.0,
+        "first_request_seconds": 0.1,
+        "heavy_modules_on_import": ["llama_parse"],
+        "budgets": {"import_seconds": 1.5, "first_request_seconds": 0.25},
+    }
+    assert regressions(result) == [
+        "import_seconds 2.000s over budget 1.500s",
+        "heavy modules imported at startup: llama_parse",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, fresh_job_queue):
+    files = [('files', ('notes.md', BytesIO(b"# Notes about cells"), 'text/markdown'))]
+    await client.post("/api/upload", files=files, data={'name': "Measured"})
+    await fresh_job_queue.join()
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    for stage in ["stage_upload", "upload_read", "upload_write", "document", "store", "index"]:
+        assert f'doc2quiz_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'doc2quiz_http_request_seconds_count{method="POST",route="/api/upload",status="200"}' in text
+    assert 'doc2quiz_job_queue_jobs{state="queued"} 0' in text
+    assert 'doc2quiz_jobs_total{state="completed"}' in text
+    assert "doc2quiz_upload_bytes_total" in text
+    assert "doc2quiz_staging_bytes" in text
+
+
+@pytest.mark.asyncio
+async def test_load_benchmark_runs_uploads_to_completion():
+    from app.db import database
+    from app.utils import ocr
+    bound, parser = database.get_database().db, ocr._parser_service
+    config = load.LoadConfig(uploads=4, concurrency=2, files_per_upload=3, file_kb=4, pdf_pages=2, parser_latency=0.01, seed=1)
+    result = await load.run(config)
+    # Later tests keep the test database and parser
+    assert database.get_database().db is bound
+    assert ocr._parser_service is parser
+    assert result["uploads"] == {"submitted": 4, "completed": 4, "done": 4, "failed": 0, "rejected": 0, "error": 0}
+    assert result["uploads_per_second"] > 0
+    assert result["job_latency"]["p50"] >= result["upload_latency"]["p50"]
+    assert result["peak_rss_mb"] > 0 and result["event_loop_lag"]["max"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_load_benchmark_sends_scanned_pdfs_to_the_fake_parser():
+    config = load.LoadConfig(uploads=2, concurrency=2, files_per_upload=2, mix={"pdf": 1}, pdf_pages=2, parser_latency=0.01)
+    result = await load.run(config)
+    assert result["uploads"]["done"] == 2
+    # Blank PDFs have no text layer at all, so each goes to the parser whole
+    assert result["parser"]["files"] == 4
+
+
+@pytest.mark.asyncio
+async def test_fake_parser_names_sources_like_the_real_service():
+    parser = load.FakeParserService(latency=0)
+    named = BytesIO(b"%PDF-1.4")
+    named.name = "/tmp/staging/notes.pdf"
+    results = await parser.parse_many(["/tmp/a.pdf", named, BytesIO(b"%PDF-1.4")])
+    assert results[0].startswith("# a.pdf")
+    assert results[1].startswith("# notes.pdf")
+    assert isinstance(results[2], ValueError)
+    assert (await parser.parse(b"%PDF-1.4", "scan.pdf")).startswith("# scan.pdf")
+
+
+def test_load_regressions_compare_against_baseline():
+    baseline = {
+        "uploads": {"submitted": 10, "completed": 10},
+        "uploads_per_second": 10.0,
+        "upload_latency": {"p99": 0.1},
+        "job_latency": {"p99": 1.0},
+        "event_loop_lag": {"p99": 0.01},
+        "peak_rss_mb": 100.0,
+    }
+    same = {**baseline, "job_latency": {"p99": 1.05}}
+    assert load.regressions(same, baseline) == []
+    slower = {**baseline, "uploads_per_second": 5.0, "job_latency": {"p99": 2.0}, "uploads": {"submitted": 10, "completed": 9}}
+    assert load.regressions(slower, baseline) == [
+        "uploads_per_second 5 vs baseline 10",
+        "job_latency.p99 2 vs baseline 1",
+        "1 uploads did not complete",
+    ]
+
+
+def test_schema_benchmark_covers_every_operation():
+    result = schemas.measure([1024], seconds=0.01)["ops_per_second"]["1024"]
+    assert set(result) == {"build", "construct", "model_dump", "to_mongo", "bson_encode", "validate"}
+    assert all(value > 0 for value in result.values())
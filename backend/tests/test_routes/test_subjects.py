@@ -0,0 +1,155 @@
+import pytest
+from bson import ObjectId
+from datetime import datetime, timedelta
+from httpx import AsyncClient
+from app.db import database
+from app.db.text_store import store_texts
+
+
+def insert_subjects(mock_db, count, user_id=None):
+    start = datetime(2025, 1, 1)
+    subjects = [
+        {"_id": ObjectId(), "name": f"Subject {i}", "user_id": user_id, "created_at": start + timedelta(minutes=i),
+         "documents": [], "metadata": {"status": "ready"}}
+        for i in range(count)
+    ]
+    mock_db.subjects.insert_many(subjects)
+    return subjects
+
+
+@pytest.mark.asyncio
+async def test_list_subjects_paginates_newest_first(client: AsyncClient, mock_db):
+    insert_subjects(mock_db, 5)
+    # A subject created at the same time as another is still paged without gaps
+    insert_subjects(mock_db, 1)
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = (await client.get("/api/subjects", params=params)).json()
+        assert len(page["subjects"]) <= 2
+        seen.extend(page["subjects"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(seen) == 6
+    assert len({subject["id"] for subject in seen}) == 6
+    assert [subject["created_at"] for subject in seen] == sorted((subject["created_at"] for subject in seen), reverse=True)
+    assert seen[0]["name"] == "Subject 4"
+    assert "documents" not in seen[0]
+    assert seen[0]["metadata"] == {"status": "ready"}
+
+
+@pytest.mark.asyncio
+async def test_list_subjects_by_user(client: AsyncClient, mock_db):
+    insert_subjects(mock_db, 3, user_id="ada")
+    insert_subjects(mock_db, 2, user_id="bob")
+    page = (await client.get("/api/subjects", params={"user_id": "bob"})).json()
+    assert [subject["user_id"] for subject in page["subjects"]] == ["bob", "bob"]
+    assert page["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_list_subjects_invalid_cursor(client: AsyncClient):
+    assert (await client.get("/api/subjects", params={"cursor": "garbage"})).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_list_subject_documents(client: AsyncClient, mock_db):
+    subject = insert_subjects(mock_db, 1)[0]
+    documents = [
+        {"_id": ObjectId(), "subject_id": subject["_id"], "filename": f"{i}.md", "ocr_text": "x" * 1000,
+         "uploaded_at": datetime(2025, 1, 1), "metadata": {}}
+        for i in range(5)
+    ]
+    mock_db.documents.insert_many(documents)
+    mock_db.documents.insert_one({**documents[0], "_id": ObjectId(), "subject_id": ObjectId()})
+
+    url = f"/api/subjects/{subject['_id']}/documents"
+    first = (await client.get(url, params={"limit": 3})).json()
+    assert [document["filename"] for document in first["documents"]] == ["0.md", "1.md", "2.md"]
+    assert all("ocr_text" not in document for document in first["documents"])
+    assert first["documents"][0]["subject_id"] == str(subject["_id"])
+
+    second = (await client.get(url, params={"limit": 3, "cursor": first["next_cursor"], "include_text": True})).json()
+    assert [document["filename"] for document in second["documents"]] == ["3.md", "4.md"]
+    assert second["documents"][0]["ocr_text"] == "x" * 1000
+    assert second["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_list_subject_documents_not_found(client: AsyncClient):
+    assert (await client.get(f"/api/subjects/{ObjectId()}/documents")).status_code == 404
+    assert (await client.get("/api/subjects/nope/documents")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_list_subject_documents_reads_offloaded_text(client: AsyncClient, mock_db):
+    subject = insert_subjects(mock_db, 1)[0]
+    text = "Photosynthesis converts light into chemical energy. " * 1000
+    stored = await store_texts([{
+        "_id": ObjectId(), "subject_id": subject["_id"], "filename": "long.md", "ocr_text": text,
+        "uploaded_at": datetime(2025, 1, 1), "metadata": {},
+    }], threshold=1024)
+    mock_db.documents.insert_many(stored)
+
+    url = f"/api/subjects/{subject['_id']}/documents"
+    document = (await client.get(url, params={"include_text": True})).json()["documents"][0]
+    assert document["ocr_text"] == text
+    assert "text_ref" not in document
+    assert "ocr_text" not in (await client.get(url)).json()["documents"][0]
+
+
+@pytest.mark.asyncio
+async def test_health_reports_pool(client: AsyncClient):
+    body = (await client.get("/health")).json()
+    assert body["status"] == "ok"
+    assert body["mongo_pool"]["max_pool_size"] == database.MONGO_MAX_POOL_SIZE
+
+
+@pytest.mark.asyncio
+async def test_export_and_import_subjects(client: AsyncClient, mock_db):
+    subject = insert_subjects(mock_db, 1, user_id="u1")[0]
+    document = {"_id": ObjectId(), "subject_id": subject["_id"], "filename": "notes.md", "ocr_text": "Cells divide", "metadata": {}}
+    mock_db.documents.insert_one(document)
+    mock_db.subjects.update_one({"_id": subject["_id"]}, {"$push": {"documents": {"id": document["_id"], "filename": "notes.md"}}})
+
+    response = await client.get("/api/subjects/export", params={"subject_id": str(subject["_id"])})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    archive = response.content
+
+    mock_db.documents.drop()
+    mock_db.subjects.drop()
+    response = await client.post("/api/subjects/import", params={"user_id": "u2"}, content=archive)
+    assert response.status_code == 200
+    assert response.json()["counts"]["document"] == 1
+    assert mock_db.subjects.find_one({"_id": subject["_id"]})["user_id"] == "u2"
+    assert mock_db.documents.find_one({"_id": document["_id"]})["ocr_text"] == "Cells divide"
+
+    assert (await client.get("/api/subjects/export", params={"subject_id": str(ObjectId())})).status_code == 404
+    assert (await client.post("/api/subjects/import", content=b"garbage")).status_code == 400
+    # Everything at once is only exported from the command line
+    assert (await client.get("/api/subjects/export")).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_import_rejects_oversized_archives(client: AsyncClient, mock_db, monkeypatch):
+    subject = insert_subjects(mock_db, 1, user_id="u1")[0]
+    archive = (await client.get("/api/subjects/export", params={"subject_id": str(subject["_id"])})).content
+    mock_db.subjects.drop()
+
+    monkeypatch.setattr("app.routes.subjects.ARCHIVE_IMPORT_MAX_BYTES", len(archive) - 1)
+    response = await client.post("/api/subjects/import", content=archive)
+    assert response.status_code == 413
+
+    async def streamed():
+        yield archive
+    # Without a Content-Length the body is counted as it arrives
+    response = await client.post("/api/subjects/import", content=streamed())
+    assert response.status_code == 413
+
+    monkeypatch.setattr("app.routes.subjects.ARCHIVE_IMPORT_MAX_BYTES", 0)
+    monkeypatch.setattr("app.routes.subjects.ARCHIVE_IMPORT_MAX_RECORDS", 0)
+    assert (await client.post("/api/subjects/import", content=archive)).status_code == 200
+    assert mock_db.subjects.count_documents({}) == 1
@@ -1,9 +1,9 @@
 import pytest
+import asyncio
 import pytest_asyncio
 from bson import ObjectId
 from datetime import datetime
 from unittest.mock import patch, AsyncMock, MagicMock
-import tempfile
 import os
 
 # Import the function to test
@@ -22,50 +22,49 @@ SAMPLE_PDF_CONTENT = b"%PDF-..." # Dummy PDF content
 MOCKED_OCR_TEXT = "Parsed text from document"
 
 @pytest.mark.asyncio
-async def test_process_document_txt():
+async def test_process_document_txt(tmp_path):
     """Test processing a .txt file."""
+    path = tmp_path / SAMPLE_TXT_FILENAME
+    path.write_bytes(SAMPLE_TXT_CONTENT)
     document = await process_document(
-        SAMPLE_TXT_FILENAME, SAMPLE_TXT_CONTENT, SAMPLE_TIME, SAMPLE_SUBJECT_ID
+        SAMPLE_TXT_FILENAME, str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID
     )
     assert isinstance(document, Document)
     assert document.subject_id == SAMPLE_SUBJECT_ID
     assert document.filename == SAMPLE_TXT_FILENAME
     assert document.ocr_text == SAMPLE_TXT_CONTENT.decode('utf-8')
     assert document.uploaded_at == SAMPLE_TIME
-    assert document.metadata == {}
+    assert document.metadata["encoding"] == "utf-8"
+    assert document.metadata["language"] == "en"
     assert isinstance(document.id, ObjectId)
 
 @pytest.mark.asyncio
-async def test_process_document_md():
+async def test_process_document_md(tmp_path):
     """Test processing a .md file."""
+    path = tmp_path / SAMPLE_MD_FILENAME
+    path.write_bytes(SAMPLE_MD_CONTENT)
     document = await process_document(
-        SAMPLE_MD_FILENAME, SAMPLE_MD_CONTENT, SAMPLE_TIME, SAMPLE_SUBJECT_ID
+        SAMPLE_MD_FILENAME, str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID
     )
     assert isinstance(document, Document)
     assert document.subject_id == SAMPLE_SUBJECT_ID
     assert document.filename == SAMPLE_MD_FILENAME
     assert document.ocr_text == SAMPLE_MD_CONTENT.decode('utf-8')
     assert document.uploaded_at == SAMPLE_TIME
-    assert document.metadata == {}
+    assert document.metadata["normalized"]
     assert isinstance(document.id, ObjectId)
 
 @pytest.mark.asyncio
 @patch('app.routes.upload.parse_document', new_callable=AsyncMock)
-@patch('tempfile.NamedTemporaryFile')
-@patch('os.unlink')
-async def test_process_document_other_file(mock_unlink, mock_named_temp_file, mock_parse_document):
+async def test_process_document_other_file(mock_parse_document, tmp_path):
     """Test processing other file types using mocked LlamaParse."""
     # Configure mocks
     mock_parse_document.return_value = MOCKED_OCR_TEXT
-
-    # Mock the NamedTemporaryFile context manager
-    mock_temp_file = MagicMock()
-    mock_temp_file.name = "dummy_temp_file.pdf"
-    # __enter__ returns the file-like object
-    mock_named_temp_file.return_value.__enter__.return_value = mock_temp_file
+    path = tmp_path / SAMPLE_PDF_FILENAME
+    path.write_bytes(SAMPLE_PDF_CONTENT)
 
     document = await process_document(
-        SAMPLE_PDF_FILENAME, SAMPLE_PDF_CONTENT, SAMPLE_TIME, SAMPLE_SUBJECT_ID
+        SAMPLE_PDF_FILENAME, str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID
     )
 
     # Assertions
@@ -74,19 +73,37 @@ async def test_process_document_other_file(mock_unlink, mock_named_temp_file, mo
     assert document.filename == SAMPLE_PDF_FILENAME
     assert document.ocr_text == MOCKED_OCR_TEXT
     assert document.uploaded_at == SAMPLE_TIME
-    assert document.metadata == {}
+    assert document.metadata["normalized"]
     assert isinstance(document.id, ObjectId)
 
-    # Verify mocks were called correctly
-    mock_named_temp_file.assert_called_once_with(delete=False, suffix=".pdf")
-    mock_temp_file.write.assert_called_once_with(SAMPLE_PDF_CONTENT)
-    mock_temp_file.flush.assert_called_once()
-    mock_parse_document.assert_called_once_with(mock_temp_file.name)
-    mock_unlink.assert_called_once_with(mock_temp_file.name)
+    # The staged file is parsed in place, no temporary copy is made
+    mock_parse_document.assert_called_once_with(str(path))
+
+@pytest.mark.asyncio
+async def test_process_document_keeps_extracted_text_as_is(tmp_path):
+    """A text layer extracted locally is not markdown, so its lines are not rewritten."""
+    path = tmp_path / SAMPLE_PDF_FILENAME
+    path.write_bytes(SAMPLE_PDF_CONTENT)
+    text = "#Results\n* 12 samples"
+    extracted = await process_document(SAMPLE_PDF_FILENAME, str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID, ocr_text=text, markdown=False)
+    assert extracted.ocr_text == text
+    parsed = await process_document(SAMPLE_PDF_FILENAME, str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID, ocr_text=text)
+    assert parsed.ocr_text == "# Results\n- 12 samples"
 
 # Tests for process_subject
 from app.routes.upload import process_subject
 from app.db.schemas import Subject, DocumentRef
+from app.utils.staging import StagedFile
+
+
+def make_staged_files(tmp_path, file_contents):
+    """Write (filename, bytes) pairs to disk the way the staging area would."""
+    staged_files = []
+    for index, (filename, content) in enumerate(file_contents):
+        path = tmp_path / f"{index}{os.path.splitext(filename)[1]}"
+        path.write_bytes(content)
+        staged_files.append(StagedFile(filename=filename, path=str(path), size=len(content)))
+    return staged_files
 
 # Mock Document returned by process_document
 SAMPLE_DOC_1 = Document(
@@ -107,10 +124,11 @@ SAMPLE_DOC_2 = Document(
 )
 
 @pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock)
 @patch('app.routes.upload.process_document', new_callable=AsyncMock)
 @patch('app.routes.upload.ObjectId') # Mock ObjectId to control the generated subject_id
 @patch('app.routes.upload.datetime') # Mock datetime to control created_at
-async def test_process_subject_success(mock_datetime, mock_object_id, mock_process_document, mock_db):
+async def test_process_subject_success(mock_datetime, mock_object_id, mock_process_document, mock_parse_documents, mock_db, tmp_path):
     """Test successful processing of a subject with multiple documents."""
     # Setup mocks
     test_subject_id = ObjectId()
@@ -123,7 +141,7 @@ async def test_process_subject_success(mock_datetime, mock_object_id, mock_proce
     doc1_processed = SAMPLE_DOC_1.model_copy(update={"subject_id": test_subject_id, "uploaded_at": test_time})
     doc2_processed = SAMPLE_DOC_2.model_copy(update={"subject_id": test_subject_id, "uploaded_at": test_time})
 
-    async def side_effect(filename, content, time, subject_id):
+    async def side_effect(filename, path, time, subject_id, ocr_text=None, markdown=True):
         if filename == "doc1.txt":
             return doc1_processed
         elif filename == "doc2.pdf":
@@ -131,15 +149,16 @@ async def test_process_subject_success(mock_datetime, mock_object_id, mock_proce
         return None
 
     mock_process_document.side_effect = side_effect
+    mock_parse_documents.return_value = ["text 2"]
 
-    file_contents = [
+    staged_files = make_staged_files(tmp_path, [
         ("doc1.txt", b"content1"),
         ("doc2.pdf", b"content2"),
-    ]
+    ])
     subject_name = "Test Subject"
 
     # Run the function
-    result = await process_subject(file_contents, subject_name)
+    result = await process_subject(staged_files, subject_name)
 
     # Assertions
     assert result == {"message": "Subject uploaded successfully"}
@@ -151,6 +170,9 @@ async def test_process_subject_success(mock_datetime, mock_object_id, mock_proce
     # Convert BSON documents back to Pydantic models for easier comparison if needed
     # Ensure the correct documents were passed to insert_many (via model_dump)
     assert mock_process_document.call_count == 2
+    # Only the non-text file is sent to the parser, as a single batch
+    mock_parse_documents.assert_awaited_once_with([staged_files[1].path])
+    assert mock_process_document.call_args_list[1].kwargs["ocr_text"] == "text 2"
 
     # Check subject inserted
     inserted_subject = mock_db.subjects.find_one({"_id": test_subject_id})
@@ -162,13 +184,15 @@ async def test_process_subject_success(mock_datetime, mock_object_id, mock_proce
     assert inserted_subject["documents"][0]["filename"] == doc1_processed.filename
     assert inserted_subject["documents"][1]["id"] == doc2_processed.id
     assert inserted_subject["documents"][1]["filename"] == doc2_processed.filename
+    assert inserted_subject["metadata"]["status"] == "ready"
 
 @pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock, return_value=["text 2"])
 @patch('app.routes.upload.process_document', new_callable=AsyncMock)
 @patch('app.routes.upload.ObjectId')
 @patch('app.routes.upload.datetime')
-async def test_process_subject_failure_cleanup(mock_datetime, mock_object_id, mock_process_document, mock_db):
-    """Test cleanup when process_document raises an exception."""
+async def test_process_subject_keeps_completed_documents(mock_datetime, mock_object_id, mock_process_document, mock_parse_documents, mock_db, tmp_path):
+    """A failing document no longer discards the documents that were already stored."""
     # Setup mocks
     test_subject_id = ObjectId()
     test_time = datetime(2024, 1, 1, 12, 0, 0)
@@ -176,7 +200,7 @@ async def test_process_subject_failure_cleanup(mock_datetime, mock_object_id, mo
     mock_datetime.now.return_value = test_time
 
     # Simulate failure in the second document processing
-    async def side_effect(filename, content, time, subject_id):
+    async def side_effect(filename, path, time, subject_id, ocr_text=None, markdown=True):
         if filename == "doc1.txt":
             return SAMPLE_DOC_1.model_copy(update={"subject_id": subject_id, "uploaded_at": time})
         elif filename == "doc2.pdf":
@@ -185,62 +209,127 @@ async def test_process_subject_failure_cleanup(mock_datetime, mock_object_id, mo
         return None
     mock_process_document.side_effect = side_effect
 
-    file_contents = [
+    staged_files = make_staged_files(tmp_path, [
         ("doc1.txt", b"content1"),
         ("doc2.pdf", b"content2"),
-    ]
+    ])
     subject_name = "Test Subject Fail"
 
-    # Run the function and expect an exception
-    with pytest.raises(ValueError, match="Processing failed"):
-        await process_subject(file_contents, subject_name)
+    result = await process_subject(staged_files, subject_name)
+    assert result == {"message": "Subject uploaded with 1 failed documents"}
+
+    # The stored document and the subject survive, with only the stored document referenced
+    assert mock_db.documents.count_documents({}) == 1
+    subject = mock_db.subjects.find_one({"_id": test_subject_id})
+    assert [ref["filename"] for ref in subject["documents"]] == ["doc1.txt"]
+    assert subject["metadata"]["status"] == "partial"
+
+    # The failure is recorded on the upload job
+    job = mock_db.jobs.find_one({"subject_id": test_subject_id})
+    assert job["status"] == "failed"
+    assert job["error"] == "1 of 2 documents failed"
+    assert [doc["state"] for doc in job["documents"]] == ["stored", "failed"]
+    assert job["documents"][1]["error"] == "Processing failed"
+
+    # Stored files are released; the failed one stays staged for a retry
+    assert not os.path.exists(staged_files[0].path)
+    assert os.path.exists(staged_files[1].path)
 
-    # Verify cleanup - collections should be empty
-    assert mock_db.documents.count_documents({}) == 0
-    assert mock_db.subjects.count_documents({}) == 0
 
 # Tests for the /upload endpoint
-from fastapi import BackgroundTasks
 from httpx import AsyncClient
+from app.utils.jobs import QueueFullError
+import json
+from app.utils import staging
 from io import BytesIO
+import tracemalloc
 
 @pytest.mark.asyncio
-@patch('app.routes.upload.BackgroundTasks.add_task')
-async def test_upload_documents_endpoint(mock_add_task, client: AsyncClient):
+@patch('app.utils.jobs.JobQueue.submit')
+async def test_upload_documents_endpoint(mock_submit, client: AsyncClient):
     """Test the POST /upload endpoint success case."""
     subject_name = "Endpoint Test Subject"
     file1_content = b"file content 1"
     file2_content = b"file content 2"
-    files = {
-        'files': [('file1.txt', BytesIO(file1_content), 'text/plain'),
-                  ('file2.md', BytesIO(file2_content), 'text/markdown')],
-        'name': (None, subject_name)
-    }
+    files = [
+        ('files', ('file1.txt', BytesIO(file1_content), 'text/plain')),
+        ('files', ('file2.md', BytesIO(file2_content), 'text/markdown')),
+    ]
 
-    response = await client.post("/upload", files=files)
+    response = await client.post("/api/upload", files=files, data={'name': subject_name})
 
     assert response.status_code == 200
-    assert response.json() == {"message": "Documents uploaded successfully"}
+    body = response.json()
+    assert body["message"] == "Documents uploaded successfully"
+    assert ObjectId.is_valid(body["job_id"])
+    assert ObjectId.is_valid(body["subject_id"])
 
-    # Verify background task was added with correct arguments
-    mock_add_task.assert_called_once()
+    # Verify the job was queued with correct arguments
+    mock_submit.assert_called_once()
     # Extract args from call
-    call_args, call_kwargs = mock_add_task.call_args
+    call_args, call_kwargs = mock_submit.call_args
     # First arg is the function (process_subject)
     assert call_args[0].__name__ == 'process_subject'
-    # Second arg is file_contents list
-    expected_file_contents = [
-        ('file1.txt', file1_content),
-        ('file2.md', file2_content)
-    ]
-    assert call_args[1] == expected_file_contents
+    # Second arg is the list of staged files, written to disk with the uploaded bytes
+    staged_files = call_args[1]
+    assert [staged.filename for staged in staged_files] == ['file1.txt', 'file2.md']
+    assert [staged.read_bytes() for staged in staged_files] == [file1_content, file2_content]
+    assert [staged.size for staged in staged_files] == [len(file1_content), len(file2_content)]
     # Third arg is the name
     assert call_args[2] == subject_name
+    assert str(call_kwargs["job"].job_id) == body["job_id"]
+    for staged in staged_files:
+        staged.release()
+
+async def multipart_upload(boundary: str, filename: str, size: int, chunk: int):
+    """A multipart upload of one file, generated chunk by chunk so the client holds no copy of it."""
+    yield (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"name\"\r\n\r\nLarge\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{filename}\"\r\n"
+        "Content-Type: text/plain\r\n\r\n"
+    ).encode()
+    block = b"x" * chunk
+    for start in range(0, size, chunk):
+        yield block[:min(chunk, size - start)]
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+@pytest.mark.asyncio
+@patch('app.utils.jobs.JobQueue.submit')
+async def test_upload_memory_stays_flat(mock_submit, client: AsyncClient, monkeypatch, tmp_path):
+    """Peak memory while a request is received and staged stays at a few chunks no matter how large the upload is."""
+    chunk = 1024 * 1024
+    monkeypatch.setattr(staging, "STAGING_DIR", str(tmp_path))
+    monkeypatch.setattr(staging, "CHUNK_SIZE", chunk)
+
+    async def peak_upload_memory(size):
+        boundary = "doc2quiz-boundary"
+        tracemalloc.start()
+        try:
+            response = await client.post(
+                "/api/upload",
+                content=multipart_upload(boundary, "big.txt", size, chunk),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert response.status_code == 200
+        staged = mock_submit.call_args.args[1][0]
+        assert staged.size == size
+        assert os.path.getsize(staged.path) == size
+        staged.release()
+        return peak
+
+    small = await peak_upload_memory(4 * chunk)
+    large = await peak_upload_memory(64 * chunk)
+    assert large < 8 * chunk
+    # The request body and the staging copy each hold a chunk or two at a time
+    assert large < small + 2 * chunk
 
 @pytest.mark.asyncio
 async def test_upload_documents_endpoint_no_files(client: AsyncClient):
     """Test the POST /upload endpoint when no files are provided."""
-    response = await client.post("/upload", data={"name": "No Files Subject"})
+    response = await client.post("/api/upload", data={"name": "No Files Subject"})
     # FastAPI/Starlette should return 422 Unprocessable Entity for missing files
     assert response.status_code == 422
 
@@ -248,10 +337,549 @@ async def test_upload_documents_endpoint_no_files(client: AsyncClient):
 async def test_upload_documents_endpoint_no_name(client: AsyncClient):
     """Test the POST /upload endpoint when the name field is missing."""
     file1_content = b"file content 1"
-    files = {
-        'files': [('file1.txt', BytesIO(file1_content), 'text/plain')]
+    files = [
+        ('files', ('file1.txt', BytesIO(file1_content), 'text/plain'))
         # Missing 'name' field
-    }
-    response = await client.post("/upload", files=files)
+    ]
+    response = await client.post("/api/upload", files=files)
     # FastAPI/Starlette should return 422 Unprocessable Entity for missing form field
-    assert response.status_code == 422 
\ No newline at end of file
+    assert response.status_code == 422 
+
+@pytest.mark.asyncio
+@patch('app.utils.jobs.JobQueue.submit', side_effect=QueueFullError(retry_after=12))
+async def test_upload_documents_endpoint_queue_full(mock_submit, client: AsyncClient, mock_db):
+    """A full job queue sheds load with 503 and Retry-After, and frees the staged files."""
+    files = [('files', ('file1.txt', BytesIO(b"file content 1"), 'text/plain'))]
+    response = await client.post("/api/upload", files=files, data={'name': "Busy"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "12"
+    assert staging.budget.used == 0
+    # The job record of a rejected upload is removed
+    assert mock_db.jobs.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock)
+async def test_process_subject_extracts_text_layers_locally(mock_parse_documents, mock_db, tmp_path):
+    """Born-digital PDFs skip OCR; scanned ones still go to the parser."""
+    mock_parse_documents.return_value = ["scanned text"]
+    with open("tests/sample_documents/sample.pdf", "rb") as f:
+        sample_pdf = f.read()
+    staged_files = make_staged_files(tmp_path, [
+        ("sample.pdf", sample_pdf),
+        ("scan.png", b"\x89PNG..."),
+    ])
+
+    await process_subject(staged_files, "Local Extraction")
+
+    mock_parse_documents.assert_awaited_once_with([staged_files[1].path])
+    texts = {doc["filename"]: doc["ocr_text"] for doc in mock_db.documents.find({})}
+    assert "This is a simple PDF" in texts["sample.pdf"]
+    assert texts["scan.png"] == "scanned text"
+
+
+@pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock, return_value=["scanned text"])
+async def test_upload_job_status(mock_parse_documents, client: AsyncClient, fresh_job_queue):
+    """An upload can be polled until every document is stored, with stage timings."""
+    files = [
+        ('files', ('notes.md', BytesIO(b"# Notes"), 'text/markdown')),
+        ('files', ('scan.png', BytesIO(b"\x89PNG..."), 'image/png')),
+    ]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Tracked"})).json()
+    job_id = upload["job_id"]
+    await fresh_job_queue.join()
+
+    response = await client.get(f"/api/upload/{job_id}")
+    assert response.status_code == 200
+    job = response.json()
+    assert job["status"] == "done"
+    assert job["subject_id"] == upload["subject_id"]
+    assert [doc["state"] for doc in job["documents"]] == ["stored", "stored"]
+    assert all(ObjectId.is_valid(doc["document_id"]) for doc in job["documents"])
+    assert set(job["documents"][1]["timings"]) == {"extract", "parse", "store", "index"}
+    assert job["timings"]["total"] >= job["timings"]["queue_wait"] >= 0
+
+
+@pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock, return_value=["scanned text"])
+async def test_pipeline_writes_to_the_injected_database(mock_parse_documents, client: AsyncClient, fresh_job_queue, mock_db):
+    """The queued pipeline writes through the Database the route was given, not the module globals."""
+    import mongomock
+    from app.db.database import Database, get_database
+    from benchmarks.mock_db import AsyncMockDatabase
+    from app.server import app
+    from app.utils.quiz_cache import get_quiz_cache
+
+    injected = AsyncMockDatabase(mongomock.MongoClient()["injected"])
+    override = Database.of(injected)
+    app.dependency_overrides[get_database] = lambda: override
+    try:
+        files = [
+            ('files', ('notes.md', BytesIO(b"# Notes on the cell membrane and its transport proteins."), 'text/markdown')),
+            ('files', ('scan.png', BytesIO(b"\x89PNG..."), 'image/png')),
+        ]
+        upload = (await client.post("/api/upload", files=files, data={'name': "Injected"})).json()
+        await fresh_job_queue.join()
+        job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+        request = {"subject_ids": [upload["subject_id"]], "num_questions": 2}
+        quiz = (await client.post("/api/quizzes", json=request)).json()
+        await fresh_job_queue.join()
+        # The finished quiz is found again through the injected database's quizzes
+        get_quiz_cache().clear()
+        again = (await client.post("/api/quizzes", json=request)).json()
+    finally:
+        app.dependency_overrides.pop(get_database)
+
+    assert [doc["state"] for doc in job["documents"]] == ["stored", "stored"]
+    subject = injected.sync.subjects.find_one({"_id": ObjectId(upload["subject_id"])})
+    assert subject["metadata"]["status"] == "ready"
+    assert injected.sync.documents.count_documents({"subject_id": subject["_id"]}) == 2
+    assert injected.sync.quizzes.find_one({"_id": ObjectId(quiz["quiz_id"])})["status"] == "ready"
+    assert again == {"quiz_id": quiz["quiz_id"], "status": "ready", "cached": True}
+    assert mock_db.subjects.count_documents({}) == 0
+    assert mock_db.documents.count_documents({}) == 0
+    assert mock_db.quizzes.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_upload_job_status_not_found(client: AsyncClient):
+    assert (await client.get("/api/upload/not-an-id")).status_code == 404
+    assert (await client.get(f"/api/upload/{ObjectId()}")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upload_job_events(client: AsyncClient, fresh_job_queue):
+    """The event stream sends job snapshots and closes once the job finishes."""
+    files = [('files', ('notes.txt', BytesIO(b"some notes"), 'text/plain'))]
+    response = await client.post("/api/upload", files=files, data={'name': "Streamed"})
+    job_id = response.json()["job_id"]
+
+    events = []
+    async with client.stream("GET", f"/api/upload/{job_id}/events") as stream:
+        assert stream.headers["content-type"].startswith("text/event-stream")
+        async for line in stream.aiter_lines():
+            if line.startswith("data: "):
+                events.append(json.loads(line[len("data: "):]))
+    assert events[-1]["status"] == "done"
+    assert events[-1]["documents"][0]["state"] == "stored"
+
+
+@pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock)
+async def test_retry_reprocesses_only_failed_documents(mock_parse_documents, client: AsyncClient, mock_db, fresh_job_queue):
+    """POST /upload/{job_id}/retry parses only the documents that failed."""
+    mock_parse_documents.side_effect = [[RuntimeError("parser down")], ["scanned text"]]
+    files = [
+        ('files', ('notes.txt', BytesIO(b"some notes"), 'text/plain')),
+        ('files', ('scan.png', BytesIO(b"\x89PNG..."), 'image/png')),
+    ]
+    staged_bytes = staging.budget.used
+    upload = (await client.post("/api/upload", files=files, data={'name': "Retried"})).json()
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["status"] == "failed"
+    assert [doc["state"] for doc in job["documents"]] == ["stored", "failed"]
+    assert job["documents"][1]["retryable"]
+    # The failed file is kept for the retry, but no longer counts against the staging budget
+    assert staging.budget.used == staged_bytes
+
+    response = await client.post(f"/api/upload/{upload['job_id']}/retry")
+    assert response.status_code == 200
+    assert response.json()["documents"] == 1
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["status"] == "done"
+    assert [doc["state"] for doc in job["documents"]] == ["stored", "stored"]
+    assert mock_parse_documents.await_count == 2
+    assert mock_parse_documents.await_args.args[0][0].endswith(".png")
+    subject = mock_db.subjects.find_one({"_id": ObjectId(upload["subject_id"])})
+    assert sorted(ref["filename"] for ref in subject["documents"]) == ["notes.txt", "scan.png"]
+    assert subject["metadata"]["status"] == "ready"
+    assert mock_db.documents.count_documents({}) == 2
+
+    assert staging.budget.used == staged_bytes
+    # Nothing is left to retry
+    assert (await client.post(f"/api/upload/{upload['job_id']}/retry")).status_code == 409
+
+
+@pytest.mark.asyncio
+async def test_failed_store_leaves_no_orphans_behind(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """Documents written before referencing them failed are removed, so a retry stores them
+    again instead of dropping them as duplicates of the orphans."""
+    from app.db import text_store
+    from app.db.database import get_database
+    monkeypatch.setattr(text_store, "TEXT_INLINE_MAX_BYTES", 64)
+    subjects = get_database().subjects
+    update_one = subjects.update_one
+    failures = [RuntimeError("connection reset")]
+
+    async def flaky_update_one(query, update, *args, **kwargs):
+        if "$push" in update and failures:
+            raise failures.pop()
+        return await update_one(query, update, *args, **kwargs)
+
+    monkeypatch.setattr(subjects, "update_one", flaky_update_one)
+    notes = " ".join(f"Paragraph {i} explains how cell membranes move ions and nutrients." for i in range(40))
+    files = [('files', ('notes.txt', BytesIO(notes.encode()), 'text/plain'))]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Notes"})).json()
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["documents"][0]["state"] == "failed"
+    assert mock_db.documents.count_documents({}) == 0
+    assert mock_db.document_texts.count_documents({}) == 0
+
+    assert (await client.post(f"/api/upload/{upload['job_id']}/retry")).status_code == 200
+    await fresh_job_queue.join()
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["documents"][0]["state"] == "stored"
+    subject = mock_db.subjects.find_one({"_id": ObjectId(upload["subject_id"])})
+    assert [ref["id"] for ref in subject["documents"]] == [ObjectId(job["documents"][0]["document_id"])]
+    assert mock_db.documents.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+@patch('app.routes.upload.parse_documents', new_callable=AsyncMock)
+async def test_concurrent_retries_queue_the_job_once(mock_parse_documents, client: AsyncClient, mock_db, fresh_job_queue, monkeypatch):
+    """Two retries of the same job sent at once: one is queued, the other is turned away."""
+    from app.routes import upload as upload_route
+    mock_parse_documents.side_effect = [[RuntimeError("parser down")], ["scanned text"]]
+    files = [('files', ('scan.png', BytesIO(b"\x89PNG..."), 'image/png'))]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Retried"})).json()
+    await fresh_job_queue.join()
+
+    get_job = upload_route.get_job
+
+    async def slow_get_job(*args, **kwargs):
+        # Both retries read the finished job before either of them queues it
+        job = await get_job(*args, **kwargs)
+        await asyncio.sleep(0.01)
+        return job
+
+    monkeypatch.setattr(upload_route, "get_job", slow_get_job)
+    submitted = []
+    submit = fresh_job_queue.submit
+    monkeypatch.setattr(fresh_job_queue, "submit", lambda *args, **kwargs: submitted.append(args) or submit(*args, **kwargs))
+    responses = await asyncio.gather(*[client.post(f"/api/upload/{upload['job_id']}/retry") for _ in range(2)])
+    assert sorted(response.status_code for response in responses) == [200, 409]
+    assert len(submitted) == 1
+    await fresh_job_queue.join()
+    assert mock_parse_documents.await_count == 2
+    assert mock_db.documents.count_documents({}) == 1
+
+
+@pytest.mark.asyncio
+async def test_upload_offloads_long_text(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """Long texts are stored compressed outside the document and still reach the index."""
+    from app.db import text_store
+    from app.utils.vector_index import get_subject_index
+    monkeypatch.setattr(text_store, "TEXT_INLINE_MAX_BYTES", 1024)
+    text = "Enzymes lower the activation energy of reactions. " * 500
+    files = [
+        ('files', ('long.md', BytesIO(text.encode()), 'text/markdown')),
+        ('files', ('short.md', BytesIO(b"# Short notes"), 'text/markdown')),
+    ]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Offloaded"})).json()
+    await fresh_job_queue.join()
+
+    long_document = mock_db.documents.find_one({"filename": "long.md"})
+    assert "ocr_text" not in long_document
+    # Normalization drops the trailing space
+    assert long_document["text_ref"]["size"] == len(text.rstrip())
+    assert await text_store.TextHandle(long_document).read() == text.rstrip()
+    assert mock_db.documents.find_one({"filename": "short.md"})["ocr_text"] == "# Short notes"
+    assert len(get_subject_index(upload["subject_id"])) > 1
+
+
+@pytest.mark.asyncio
+async def test_process_document_normalizes_legacy_text(tmp_path):
+    """Non-UTF-8 text is decoded by detection and normalized before storage."""
+    path = tmp_path / "notes.txt"
+    path.write_bytes("Caf\u00e9 notes\r\n\r\n\r\n\u00a0La c\u00e9lula es la unidad de la vida y de los organismos.  \r\n".encode("cp1252"))
+    document = await process_document("notes.txt", str(path), SAMPLE_TIME, SAMPLE_SUBJECT_ID)
+    assert document.ocr_text == "Caf\u00e9 notes\n\n La c\u00e9lula es la unidad de la vida y de los organismos."
+    assert document.metadata["encoding"] != "utf-8"
+    assert document.metadata["language"] == "es"
+
+
+TOPICS = ["membrane", "nucleus", "ribosome", "enzyme", "protein", "receptor", "channel", "gradient",
+          "mitochondria", "chloroplast", "vesicle", "cytoskeleton", "lysosome", "genome", "hormone", "neuron"]
+NOTES = " ".join(
+    f"Lecture point {i}: the {a} interacts with the {b} whenever the {c} signals a change near the {d}."
+    for i, (a, b, c, d) in enumerate(zip(TOPICS, TOPICS[5:] + TOPICS[:5], TOPICS[9:] + TOPICS[:9], TOPICS[13:] + TOPICS[:13]))
+)
+
+
+@pytest.mark.asyncio
+async def test_upload_skips_and_links_near_duplicates(client: AsyncClient, fresh_job_queue, mock_db):
+    """Copies within a subject are dropped; copies of another subject of the same user are linked."""
+    from app.utils.vector_index import get_subject_index
+    files = [
+        ('files', ('notes.md', BytesIO(NOTES.encode()), 'text/markdown')),
+        ('files', ('notes (1).md', BytesIO(NOTES.encode()), 'text/markdown')),
+    ]
+    first = (await client.post("/api/upload", files=files, data={'name': "Cells", 'user_id': "u1"})).json()
+    await fresh_job_queue.join()
+    job = (await client.get(f"/api/upload/{first['job_id']}")).json()
+    assert sorted(document["state"] for document in job["documents"]) == ["duplicate", "stored"]
+    assert mock_db.documents.count_documents({}) == 1
+    original = mock_db.documents.find_one({})
+    assert original["metadata"]["fingerprint"]["scope"] == "user:u1"
+
+    edited = NOTES.replace("Lecture point 3", "Lecture point three")
+    files = [('files', ('notes-v2.md', BytesIO(edited.encode()), 'text/markdown'))]
+    second = (await client.post("/api/upload", files=files, data={'name': "Cells again", 'user_id': "u1"})).json()
+    await fresh_job_queue.join()
+    job = (await client.get(f"/api/upload/{second['job_id']}")).json()
+    assert job["status"] == "done"
+    assert job["documents"][0]["state"] == "linked"
+    assert job["documents"][0]["document_id"] == str(original["_id"])
+    assert mock_db.documents.count_documents({}) == 1
+    subject = mock_db.subjects.find_one({"_id": ObjectId(second["subject_id"])})
+    assert subject["documents"] == [{"id": original["_id"], "filename": "notes-v2.md", "version": None}]
+    assert len(get_subject_index(second["subject_id"])) > 0
+
+    # The documents listing never exposes the binary fingerprint
+    listing = (await client.get(f"/api/subjects/{first['subject_id']}/documents")).json()
+    assert "fingerprint" not in listing["documents"][0]["metadata"]
+    # The linked document is listed in the subject that links it
+    listing = (await client.get(f"/api/subjects/{second['subject_id']}/documents")).json()
+    assert [document["id"] for document in listing["documents"]] == [str(original["_id"])]
+
+    # Another user's copy is stored
+    files = [('files', ('notes.md', BytesIO(NOTES.encode()), 'text/markdown'))]
+    await client.post("/api/upload", files=files, data={'name': "Cells", 'user_id': "u2"})
+    await fresh_job_queue.join()
+    assert mock_db.documents.count_documents({}) == 2
+
+
+def make_scanned_pdf(pages):
+    """A PDF without a text layer; page sizes differ so every page range has distinct bytes."""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for page in range(pages):
+        writer.add_blank_page(width=400 + page, height=600)
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_large_pdf_is_stored_range_by_range(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """A large scanned PDF is parsed in page ranges; finished ranges are saved and indexed
+    even when another range fails, and a retry only parses what is missing."""
+    from app.utils import extract
+    from app.utils.vector_index import get_subject_index
+    monkeypatch.setattr(extract, "PARSE_SPLIT_MIN_PAGES", 8)
+    monkeypatch.setattr(extract, "PARSE_RANGE_PAGES", 4)
+    calls = []
+
+    async def parse(source):
+        calls.append(source.name)
+        start = int(source.name.split(".pages-")[1].split("-")[0])
+        if start == 4 and calls.count(source.name) == 1:
+            raise RuntimeError("parser timeout")
+        return f"Chapter {start // 4 + 1} covers pages {start} to {start + 3} of the book."
+
+    monkeypatch.setattr("app.routes.upload.parse_document", parse)
+    files = [('files', ('book.pdf', BytesIO(make_scanned_pdf(12)), 'application/pdf'))]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Book"})).json()
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["documents"][0]["state"] == "failed"
+    assert job["documents"][0]["pages"] == 12
+    assert job["documents"][0]["pages_parsed"] == 8
+    document_id = ObjectId(job["documents"][0]["document_id"])
+    # The document is referenced and its finished ranges are searchable before it is complete
+    assert mock_db.documents.find_one({"_id": document_id})["metadata"]["status"] == "parsing"
+    subject = mock_db.subjects.find_one({"_id": ObjectId(upload["subject_id"])})
+    assert [ref["id"] for ref in subject["documents"]] == [document_id]
+    # The ref carries the content version quizzes are fingerprinted with
+    assert subject["documents"][0]["version"] == "parsing:8"
+    assert sorted(row["start"] for row in mock_db.document_pages.find({"document_id": document_id})) == [0, 8]
+    assert len(get_subject_index(upload["subject_id"])) == 2
+
+    assert (await client.post(f"/api/upload/{upload['job_id']}/retry")).status_code == 200
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload['job_id']}")).json()
+    assert job["status"] == "done"
+    assert job["documents"][0]["state"] == "stored"
+    assert job["documents"][0]["document_id"] == str(document_id)
+    assert sorted(calls) == ["0.pages-0-4.pdf", "0.pages-4-8.pdf", "0.pages-4-8.pdf", "0.pages-8-12.pdf"]
+    document = mock_db.documents.find_one({"_id": document_id})
+    assert document["ocr_text"].split("\n\n") == [
+        "Chapter 1 covers pages 0 to 3 of the book.",
+        "Chapter 2 covers pages 4 to 7 of the book.",
+        "Chapter 3 covers pages 8 to 11 of the book.",
+    ]
+    assert "status" not in document["metadata"]
+    assert mock_db.subjects.find_one({"_id": ObjectId(upload["subject_id"])})["documents"][0]["version"] is None
+    assert mock_db.documents.count_documents({}) == 1
+    assert mock_db.document_pages.count_documents({}) == 0
+    assert len(get_subject_index(upload["subject_id"])) == 3
+
+
+@pytest.mark.asyncio
+async def test_large_pdf_ranges_are_built_as_slots_free(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """Only the ranges being parsed are held in memory, and parsing starts before the rest are built."""
+    from app.routes import upload
+    from app.utils import extract
+    monkeypatch.setattr(extract, "PARSE_SPLIT_MIN_PAGES", 8)
+    monkeypatch.setattr(extract, "PARSE_RANGE_PAGES", 2)
+    built, live_at_parse = [], []
+
+    async def split(path, extraction, runs=None):
+        buffers = await extract.split_missing_pages(path, extraction, runs)
+        built.extend(buffers)
+        return buffers
+
+    async def parse(source):
+        live_at_parse.append((len(built), sum(not buffer.closed for buffer in built)))
+        await asyncio.sleep(0.01)
+        return f"Pages from {source.name}"
+
+    monkeypatch.setattr(upload, "split_missing_pages", split)
+    monkeypatch.setattr(upload, "parse_document", parse)
+    files = [('files', ('book.pdf', BytesIO(make_scanned_pdf(16)), 'application/pdf'))]
+    upload_response = (await client.post("/api/upload", files=files, data={'name': "Book"})).json()
+    await fresh_job_queue.join()
+
+    job = (await client.get(f"/api/upload/{upload_response['job_id']}")).json()
+    assert job["documents"][0]["state"] == "stored"
+    assert len(built) == len(live_at_parse) == 8
+    assert live_at_parse[0][0] < 8
+    per_subject = fresh_job_queue.limiter.per_key
+    assert max(live for _, live in live_at_parse) <= per_subject
+    assert all(buffer.closed for buffer in built)
+
+
+@pytest.mark.asyncio
+async def test_upload_over_user_quota_is_rejected(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """A user over their page or job quota gets 429 with Retry-After and nothing is queued;
+    other users and anonymous uploads are counted separately."""
+    from app.utils.jobs import Quota
+    monkeypatch.setattr("app.utils.accounts.USER_QUOTA", Quota(jobs=1, pages=10))
+    release = asyncio.Event()
+
+    async def parse(sources):
+        await release.wait()
+        return ["Parsed text of the scanned pages."] * len(sources)
+
+    monkeypatch.setattr("app.routes.upload.parse_documents", parse)
+
+    def upload(pages, **data):
+        files = [('files', ('scan.pdf', BytesIO(make_scanned_pdf(pages)), 'application/pdf'))]
+        return client.post("/api/upload", files=files, data={'name': "Scans", **data})
+
+    response = await upload(12, user_id="u1")
+    assert response.status_code == 429
+    assert "pages" in response.json()["detail"]
+    assert int(response.headers["Retry-After"]) > 0
+    assert mock_db.jobs.count_documents({}) == 0
+
+    assert (await upload(2, user_id="u1")).status_code == 200
+    response = await upload(2, user_id="u1")
+    assert response.status_code == 429
+    assert "jobs" in response.json()["detail"]
+    # Another user, and anonymous uploads, are unaffected
+    assert (await upload(2, user_id="u2")).status_code == 200
+    assert (await upload(12)).status_code == 200
+    release.set()
+    await fresh_job_queue.join()
+    assert mock_db.documents.count_documents({}) == 3
+    assert (await upload(2, user_id="u1")).status_code == 200
+    await fresh_job_queue.join()
+
+
+@pytest.mark.asyncio
+async def test_anonymous_flood_is_capped_and_scheduled_per_account(client: AsyncClient, mock_db, monkeypatch):
+    """Uploads without a user_id share the anonymous quota and are scheduled as their client
+    address, which runs at most two at once: a user's upload sent after the flood takes the
+    free worker instead of the flood's queued uploads."""
+    from app.utils import jobs
+    from app.utils.extract import count_pages
+    from app.utils.jobs import Quota
+    queue = jobs.JobQueue(backend=jobs.MemoryJobBackend(max_running=2), workers=3, small_lane_workers=0)
+    monkeypatch.setattr(jobs, "_job_queue", queue)
+    monkeypatch.setattr("app.utils.accounts.ANONYMOUS_QUOTA", Quota(jobs=4))
+    release = asyncio.Event()
+    parsed = []
+
+    async def parse(sources):
+        pages = count_pages(sources[0], ".pdf")
+        parsed.append(pages)
+        # The flood holds its workers until released
+        if pages == 3:
+            await release.wait()
+        return ["Parsed text of the scanned pages."] * len(sources)
+
+    async def parsed_count(count):
+        for _ in range(100):
+            if len(parsed) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    monkeypatch.setattr("app.routes.upload.parse_documents", parse)
+
+    uploads = iter(range(100))
+
+    def upload(pages, **data):
+        # A trailing comment keeps every scan's bytes, and so its parse, distinct
+        content = make_scanned_pdf(pages) + f"\n% upload {next(uploads)}\n".encode()
+        files = [('files', ('scan.pdf', BytesIO(content), 'application/pdf'))]
+        return client.post("/api/upload", files=files, data={'name': "Scans", **data})
+
+    try:
+        for _ in range(4):
+            assert (await upload(3)).status_code == 200
+        response = await upload(3)
+        assert response.status_code == 429
+        assert "jobs" in response.json()["detail"]
+        assert queue.backend.usage("anonymous")["jobs"] == 4
+
+        # The client address is at its running limit, so the third worker stays free
+        await parsed_count(2)
+        await asyncio.sleep(0.05)
+        assert parsed == [3, 3]
+        # The user's upload is neither counted against the anonymous quota nor queued
+        # behind the flood
+        assert (await upload(1, user_id="u1")).status_code == 200
+        await parsed_count(3)
+        assert parsed == [3, 3, 1]
+        release.set()
+        await queue.join()
+        assert mock_db.jobs.count_documents({"status": "done"}) == 5
+        assert parsed == [3, 3, 1, 3, 3]
+    finally:
+        release.set()
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_large_pdf_keeps_every_page_of_each_range(client: AsyncClient, fresh_job_queue, mock_db, monkeypatch):
+    """The parser answers with one document per page; every page of every range is stored."""
+    from app.utils import extract, ocr
+    from llama_parse import LlamaParse
+    from types import SimpleNamespace
+    monkeypatch.setattr(extract, "PARSE_SPLIT_MIN_PAGES", 8)
+    monkeypatch.setattr(extract, "PARSE_RANGE_PAGES", 4)
+
+    async def aload_data(self, file_path, extra_info=None):
+        start, end = map(int, extra_info["file_name"].split(".pages-")[1].split(".")[0].split("-"))
+        return [SimpleNamespace(text=f"Page {page} text.") for page in range(start, end)]
+
+    service = ocr.ParserService(api_key="llx-test")
+    monkeypatch.setattr(ocr, "_parser_service", service)
+    monkeypatch.setattr(LlamaParse, "aload_data", aload_data)
+    files = [('files', ('book.pdf', BytesIO(make_scanned_pdf(12)), 'application/pdf'))]
+    upload = (await client.post("/api/upload", files=files, data={'name': "Book"})).json()
+    await fresh_job_queue.join()
+    await service.aclose()
+
+    document = mock_db.documents.find_one({"subject_id": ObjectId(upload["subject_id"])})
+    assert document["ocr_text"].split("\n\n") == [f"Page {page} text." for page in range(12)]
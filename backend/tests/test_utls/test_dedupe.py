@@ -0,0 +1,100 @@
+from app.utils.dedupe import Deduper, DuplicateMatch, Fingerprint, LSHIndex, fingerprint
+from bson import ObjectId
+import random
+import pytest
+
+WORDS = ["cell", "membrane", "protein", "enzyme", "energy", "reaction", "molecule", "gradient", "transport",
+         "signal", "nucleus", "gene", "expression", "pathway", "structure", "receptor", "channel", "binding"]
+
+
+def notes(seed: int, words: int = 400) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def edit(text: str, changes: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = text.split()
+    for _ in range(changes):
+        words[rng.randrange(len(words))] = "edited"
+    return " ".join(words)
+
+
+def test_fingerprint_similarity():
+    original = fingerprint(notes(1))
+    assert original.similarity(fingerprint(notes(1).upper())) == 1.0
+    assert original.similarity(fingerprint(edit(notes(1), 3))) > 0.85
+    assert original.similarity(fingerprint(notes(2))) < 0.2
+    assert fingerprint("too short to compare") is None
+
+
+def test_fingerprint_metadata_roundtrip():
+    original = fingerprint(notes(1))
+    restored = Fingerprint.from_metadata(original.to_metadata("user:u1"))
+    assert restored.similarity(original) == 1.0
+    assert restored.bands == original.bands
+    assert all(-2 ** 63 <= band < 2 ** 63 for band in original.bands)
+
+
+def test_lsh_index_finds_edited_copies_only():
+    index = LSHIndex()
+    index.add("a", fingerprint(notes(1)))
+    index.add("b", fingerprint(notes(2)))
+    assert index.query(fingerprint(edit(notes(1), 2)), 0.85)[0] == "a"
+    assert index.query(fingerprint(notes(3)), 0.85) is None
+    index.remove("a")
+    assert index.query(fingerprint(notes(1)), 0.85) is None
+
+
+@pytest.mark.asyncio
+async def test_deduper_checks_stored_and_pending_documents(async_mongo, monkeypatch):
+    from app.db import database
+    monkeypatch.setattr(database, "documents_collection", async_mongo.documents)
+    other_subject, subject = ObjectId(), ObjectId()
+
+    stored = {"_id": ObjectId(), "subject_id": other_subject, "ocr_text": notes(1), "metadata": {}}
+    await Deduper(other_subject, "u1").check([stored])
+    await async_mongo.documents.insert_one(stored)
+
+    deduper = Deduper(subject, "u1")
+    documents = [
+        {"_id": ObjectId(), "ocr_text": edit(notes(1), 2), "metadata": {}},
+        {"_id": ObjectId(), "ocr_text": notes(2), "metadata": {}},
+        {"_id": ObjectId(), "ocr_text": notes(2), "metadata": {}},
+    ]
+    linked, new, copy = await deduper.check(documents)
+    assert linked.document_id == stored["_id"] and deduper.links(linked)
+    assert new is None
+    # The second copy in the same job duplicates the first, in this subject
+    assert copy.document_id == documents[1]["_id"] and not deduper.links(copy)
+
+    # Another user's documents are never matched
+    assert await Deduper(ObjectId(), "u2").check([{"_id": ObjectId(), "ocr_text": notes(1), "metadata": {}}]) == [None]
+    assert await Deduper(subject, "u1", mode="off").check([{"_id": ObjectId(), "ocr_text": notes(1), "metadata": {}}]) == [None]
+
+
+@pytest.mark.asyncio
+async def test_copies_wait_for_their_original_to_be_stored(async_mongo, monkeypatch):
+    from app.db import database
+    import asyncio
+    monkeypatch.setattr(database, "documents_collection", async_mongo.documents)
+    deduper = Deduper(ObjectId(), "u1")
+    first, second, copy_of_first, copy_of_second = [
+        {"_id": ObjectId(), "ocr_text": notes(seed), "metadata": {}} for seed in [1, 2, 1, 2]
+    ]
+    assert await deduper.check([first, second]) == [None, None]
+    # Checked in a later batch, while the originals are still being stored
+    match_first, match_second = await deduper.check([copy_of_first, copy_of_second])
+    assert match_first.document_id == first["_id"]
+    waiting = asyncio.create_task(deduper.original_stored(match_first))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+
+    deduper.stored([first["_id"]])
+    deduper.forget([second["_id"]])
+    assert await waiting
+    # The original failed, so its copy has to be kept rather than dropped
+    assert not await deduper.original_stored(match_second)
+    # Documents stored before the job are there already
+    stored = DuplicateMatch(ObjectId(), ObjectId(), 1.0)
+    assert await deduper.original_stored(stored)
@@ -0,0 +1,120 @@
+from app.utils import extract
+from app.utils.extract import (
+    LocalExtraction,
+    PageRun,
+    extract_local,
+    extract_text,
+    split_missing_pages,
+)
+from pypdf import PdfReader, PdfWriter
+import zipfile
+import pytest
+
+SAMPLE_PDF = "tests/sample_documents/sample.pdf"
+
+
+def make_mixed_pdf(path):
+    """Text page, two blank (image-only) pages, then another text page."""
+    sample = PdfReader(SAMPLE_PDF).pages[0]
+    writer = PdfWriter()
+    writer.add_page(sample)
+    writer.add_blank_page(width=612, height=792)
+    writer.add_blank_page(width=612, height=792)
+    writer.add_page(sample)
+    with open(path, "wb") as f:
+        writer.write(f)
+    return str(path)
+
+
+def test_extract_pdf_with_text_layer():
+    extraction = extract_local(SAMPLE_PDF, ".pdf")
+    assert extraction.complete
+    assert "This is a simple PDF" in extraction.merge([])
+
+
+def test_extract_pdf_marks_image_only_pages(tmp_path):
+    extraction = extract_local(make_mixed_pdf(tmp_path / "mixed.pdf"), ".pdf")
+    assert not extraction.complete
+    assert extraction.missing_runs() == [PageRun(1, 3)]
+
+
+def test_merge_keeps_page_order():
+    extraction = LocalExtraction(pages=["one", None, "three", None])
+    assert extraction.merge(["two", "four"]) == "one\n\ntwo\n\nthree\n\nfour"
+
+
+def test_split_extraction_caps_run_length():
+    extraction = LocalExtraction(pages=["a", "b", None, None, None, None, None, "h"], range_pages=2)
+    assert extraction.missing_runs() == [PageRun(2, 4), PageRun(4, 6), PageRun(6, 7)]
+    assert extraction.text_runs() == [PageRun(0, 2), PageRun(7, 8)]
+    assert extraction.text_of(PageRun(0, 2)) == "a\n\nb"
+    assert extraction.merge(["c", "e", "g"]) == "a\n\nb\n\nc\n\ne\n\ng\n\nh"
+
+
+def test_extract_docx(tmp_path):
+    path = tmp_path / "notes.docx"
+    body = (
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+        '<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>Cell Biology</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t>The mitochondria is the </w:t></w:r><w:r><w:t>powerhouse of the cell.</w:t></w:r></w:p>'
+        '</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("word/document.xml", body)
+    extraction = extract_local(str(path), ".docx")
+    assert extraction.merge([]) == "# Cell Biology\n\nThe mitochondria is the powerhouse of the cell."
+
+
+def test_extract_pptx(tmp_path):
+    path = tmp_path / "slides.pptx"
+    slide = (
+        '<p:sld xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main" '
+        'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"><a:p><a:r><a:t>{}</a:t></a:r></a:p></p:sld>'
+    )
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("ppt/slides/slide10.xml", slide.format("Closing remarks for the lecture"))
+        archive.writestr("ppt/slides/slide2.xml", slide.format("Introduction to thermodynamics"))
+    text = extract_local(str(path), ".pptx").merge([])
+    assert text.index("Introduction") < text.index("Closing")
+    assert text.startswith("## Slide 1")
+
+
+def test_extract_unreadable_file(tmp_path):
+    path = tmp_path / "broken.pdf"
+    path.write_bytes(b"not a pdf")
+    assert extract_local(str(path), ".pdf") is None
+
+
+@pytest.mark.asyncio
+async def test_split_missing_pages(tmp_path):
+    path = make_mixed_pdf(tmp_path / "mixed.pdf")
+    extraction = await extract_text(path, ".pdf")
+    page_runs = await split_missing_pages(path, extraction)
+    assert len(page_runs) == 1
+    assert page_runs[0].name == "mixed.pages-1-3.pdf"
+    assert len(PdfReader(page_runs[0]).pages) == 2
+    # Nothing is written next to the source
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["mixed.pdf"]
+    assert await extract_text(str(tmp_path / "scan.png"), ".png") is None
+
+
+@pytest.mark.asyncio
+async def test_large_scanned_pdf_is_split_into_ranges(tmp_path, monkeypatch):
+    monkeypatch.setattr(extract, "PARSE_SPLIT_MIN_PAGES", 2)
+    monkeypatch.setattr(extract, "PARSE_RANGE_PAGES", 1)
+    path = make_mixed_pdf(tmp_path / "mixed.pdf")
+    extraction = await extract_text(path, ".pdf")
+    assert extraction.split
+    page_runs = await split_missing_pages(path, extraction)
+    assert [buffer.name for buffer in page_runs] == ["mixed.pages-1-2.pdf", "mixed.pages-2-3.pdf"]
+
+    # Without any text layer the file is still split rather than parsed whole
+    writer = PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=612, height=792)
+    with open(tmp_path / "scan.pdf", "wb") as f:
+        writer.write(f)
+    extraction = await extract_text(str(tmp_path / "scan.pdf"), ".pdf")
+    assert extraction.missing_runs() == [PageRun(0, 1), PageRun(1, 2), PageRun(2, 3)]
+    monkeypatch.setattr(extract, "PARSE_SPLIT_MIN_PAGES", 4)
+    assert await extract_text(str(tmp_path / "scan.pdf"), ".pdf") is None
@@ -0,0 +1,168 @@
+from app.utils.jobs import JobQueue, MemoryJobBackend, ConcurrencyLimiter, Quota, QueueFullError, QuotaExceededError, Job
+import asyncio
+import time
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_submit_raises_when_queue_full():
+    queue = JobQueue(backend=MemoryJobBackend(maxsize=1), workers=1)
+    release = asyncio.Event()
+
+    async def blocked():
+        await release.wait()
+
+    queue.submit(blocked)
+    await asyncio.sleep(0)  # worker picks up the first job
+    queue.submit(blocked)
+    with pytest.raises(QueueFullError):
+        queue.submit(blocked)
+
+    release.set()
+    await queue.join()
+    assert queue.stats["completed"] == 2
+    await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_workers_record_failures():
+    queue = JobQueue(workers=1)
+
+    async def fails():
+        raise ValueError("bad document")
+
+    job = queue.submit(fails)
+    await queue.join()
+    assert job.state == "failed"
+    assert job.error == "bad document"
+    assert queue.stats["failed"] == 1
+    await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_limiter_caps_global_and_per_subject_concurrency():
+    limiter = ConcurrencyLimiter(max_concurrency=3, per_key=2)
+    active = {"total": 0, "a": 0, "b": 0}
+    peaks = {"total": 0, "a": 0, "b": 0}
+
+    async def work(key):
+        async with limiter.slot(key):
+            active["total"] += 1
+            active[key] += 1
+            peaks["total"] = max(peaks["total"], active["total"])
+            peaks[key] = max(peaks[key], active[key])
+            await asyncio.sleep(0.01)
+            active["total"] -= 1
+            active[key] -= 1
+
+    await asyncio.gather(*[work("a") for _ in range(6)], *[work("b") for _ in range(6)])
+    assert peaks == {"total": 3, "a": 2, "b": 2}
+    assert limiter.in_use == 0
+
+
+def make_job(tenant, cost=1.0, name=None):
+    async def noop():
+        pass
+    return Job(func=noop, args=(), kwargs={}, tenant=tenant, cost=cost, id=name or f"{tenant}-{cost}")
+
+
+@pytest.mark.asyncio
+async def test_backend_shares_workers_fairly_across_tenants():
+    backend = MemoryJobBackend(max_running=10, weights={"heavy": 1, "gold": 2})
+    for i in range(4):
+        backend.put_nowait(make_job("heavy", 10, f"heavy-{i}"))
+    backend.put_nowait(make_job("light", 10, "light-0"))
+    backend.put_nowait(make_job("light", 10, "light-1"))
+    for i in range(4):
+        backend.put_nowait(make_job("gold", 10, f"gold-{i}"))
+    order = [(await backend.get()).id for _ in range(10)]
+    # Arriving after four heavy jobs does not put light behind them; gold gets twice the share
+    assert order[:4] == ["gold-0", "heavy-0", "light-0", "gold-1"]
+    assert order.index("light-1") < order.index("heavy-2")
+    assert order.index("gold-3") < order.index("heavy-2")
+
+
+@pytest.mark.asyncio
+async def test_backend_caps_running_jobs_per_tenant_and_serves_small_lane():
+    backend = MemoryJobBackend(max_running=1, small_max_cost=100)
+    backend.put_nowait(make_job("a", 1000, "a-0"))
+    backend.put_nowait(make_job("a", 1000, "a-1"))
+    backend.put_nowait(make_job("a", 10, "a-small"))
+    backend.put_nowait(make_job("b", 1000, "b-0"))
+    first = await backend.get()
+    assert first.id == "a-0"
+    # a is at its limit, so only b is eligible
+    assert (await backend.get()).id == "b-0"
+    waiting = asyncio.create_task(backend.get())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    backend.task_done(first)
+    assert (await waiting).id == "a-1"
+    backend.task_done(first)
+    # The small lane skips a's queued large jobs
+    backend.put_nowait(make_job("a", 1000, "a-2"))
+    assert (await backend.get(small_only=True)).id == "a-small"
+
+
+@pytest.mark.asyncio
+async def test_small_lane_skips_jobs_kept_out_of_it():
+    backend = MemoryJobBackend(small_max_cost=100)
+    quiz = make_job("a", 1, "quiz")
+    quiz.small_lane = False
+    backend.put_nowait(quiz)
+    backend.put_nowait(make_job("b", 10, "upload"))
+    assert (await backend.get(small_only=True)).id == "upload"
+    assert (await backend.get()).id == "quiz"
+
+
+@pytest.mark.asyncio
+async def test_quotas_count_queued_and_running_work():
+    queue = JobQueue(workers=1)
+    quota = Quota(jobs=2, bytes=100, pages=5)
+
+    async def work():
+        pass
+
+    queue.submit(work, tenant="subject:1", cost=60, pages=3, quotas={"user:a": quota})
+    with pytest.raises(QuotaExceededError, match="bytes"):
+        queue.submit(work, tenant="subject:2", cost=60, quotas={"user:a": quota})
+    with pytest.raises(QuotaExceededError, match="pages"):
+        queue.submit(work, tenant="subject:2", cost=10, pages=3, quotas={"user:a": quota})
+    queue.submit(work, tenant="subject:2", cost=10, quotas={"user:a": quota})
+    with pytest.raises(QuotaExceededError, match="jobs"):
+        queue.check_quota({"user:a": quota})
+    # Other accounts are unaffected, and a job counts against every account it is charged to
+    queue.submit(work, tenant="subject:3", cost=60, quotas={"user:b": quota, "client:x": Quota(jobs=1)})
+    with pytest.raises(QuotaExceededError, match="jobs"):
+        queue.submit(work, tenant="subject:4", quotas={"user:c": quota, "client:x": Quota(jobs=1)})
+    assert queue.backend.usage("user:a") == {"jobs": 2, "bytes": 70, "pages": 3}
+    assert queue.backend.usage("client:x") == {"jobs": 1, "bytes": 60, "pages": 0}
+    await queue.join()
+    await queue.stop()
+    assert queue.backend.usage("user:a") == {"jobs": 0, "bytes": 0, "pages": 0}
+
+
+@pytest.mark.asyncio
+async def test_small_users_keep_low_latency_while_one_user_floods_the_queue():
+    """Simulated parse latencies: one user queues 40 large uploads, then three users send
+    small ones. Small uploads finish within a couple of job lengths instead of waiting
+    for the backlog, which first-come, first-served would take ~0.8 s to drain."""
+    queue = JobQueue(backend=MemoryJobBackend(maxsize=100, max_running=2), workers=3, small_lane_workers=1)
+    latencies = {"heavy": [], "light": []}
+
+    async def parse(kind, seconds, submitted):
+        await asyncio.sleep(seconds)
+        latencies[kind].append(time.monotonic() - submitted)
+
+    for _ in range(40):
+        queue.submit(parse, "heavy", 0.04, time.monotonic(), tenant="user:heavy", cost=50 * 1024 * 1024)
+    for round in range(3):
+        await asyncio.sleep(0.03)
+        for user in ["a", "b", "c"]:
+            queue.submit(parse, "light", 0.005, time.monotonic(), tenant=f"user:{user}", cost=20 * 1024)
+    await queue.join()
+    await queue.stop()
+
+    assert len(latencies["light"]) == 9
+    assert max(latencies["light"]) < 0.1
+    assert max(latencies["heavy"]) > 0.5
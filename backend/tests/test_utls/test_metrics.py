@@ -0,0 +1,122 @@
+from app.utils import metrics
+from app.utils.metrics import Registry, add_span_hook, remove_span_hook, span
+from contextlib import contextmanager
+import asyncio
+import pytest
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    registry.counter("jobs_total", "Jobs", ("state",)).inc(2, state="done")
+    registry.gauge("queue_depth", "Queue depth").set(3)
+    histogram = registry.histogram("stage_seconds", "Stage time", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, stage="parse")
+    histogram.observe(0.5, stage="parse")
+    histogram.observe(5, stage="parse")
+
+    assert registry.render().splitlines() == [
+        "# HELP jobs_total Jobs",
+        "# TYPE jobs_total counter",
+        'jobs_total{state="done"} 2',
+        "# HELP queue_depth Queue depth",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+        "# HELP stage_seconds Stage time",
+        "# TYPE stage_seconds histogram",
+        'stage_seconds_bucket{stage="parse",le="0.1"} 1',
+        'stage_seconds_bucket{stage="parse",le="1.0"} 2',
+        'stage_seconds_bucket{stage="parse",le="+Inf"} 3',
+        'stage_seconds_sum{stage="parse"} 5.55',
+        'stage_seconds_count{stage="parse"} 3',
+    ]
+
+
+def test_metrics_read_at_scrape_time():
+    registry = Registry()
+    state = {"queued": 1}
+    registry.gauge("queued", "Queued", ("lane",)).set_function(lambda: {("small",): state["queued"]})
+    registry.counter("broken_total", "Broken").set_function(lambda: 1 / 0)
+    state["queued"] = 4
+    text = registry.render()
+    assert 'queued{lane="small"} 4' in text
+    assert "broken_total" in text
+
+
+def test_registry_returns_existing_metric():
+    registry = Registry()
+    assert registry.counter("a_total", "A") is registry.counter("a_total", "A")
+    with pytest.raises(ValueError):
+        registry.gauge("a_total", "A")
+
+
+def test_timer_decorates_sync_and_async_functions():
+    histogram = Registry().histogram("call_seconds", "Calls", ("function",))
+
+    @histogram.time(function="sync")
+    def add(a, b):
+        return a + b
+
+    @histogram.time(function="async")
+    async def slow():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert add(1, 2) == 3
+    assert asyncio.run(slow()) == "done"
+    with histogram.time(function="block"):
+        pass
+    assert [histogram.count(function=name) for name in ["sync", "async", "block"]] == [1, 1, 1]
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    registry = Registry()
+    counter = registry.counter("off_total", "Off")
+    histogram = registry.histogram("off_seconds", "Off")
+    counter.inc()
+    histogram.observe(1)
+    assert counter.value() == 0
+    assert histogram.count() == 0
+
+
+def test_span_hooks():
+    events = []
+
+    @contextmanager
+    def hook(name, attributes):
+        events.append(("start", name, attributes))
+        try:
+            yield
+        except Exception as e:
+            events.append(("error", name, str(e)))
+            raise
+        events.append(("end", name, attributes))
+
+    assert span("idle") is span("other")  # no hooks: a shared no-op
+    add_span_hook(hook)
+    try:
+        with span("parse", files=2):
+            pass
+        with pytest.raises(RuntimeError):
+            with span("store"):
+                raise RuntimeError("boom")
+    finally:
+        remove_span_hook(hook)
+    assert events == [
+        ("start", "parse", {"files": 2}),
+        ("end", "parse", {"files": 2}),
+        ("start", "store", {}),
+        ("error", "store", "boom"),
+    ]
+
+
+def test_opentelemetry_hook():
+    # opentelemetry is not a dependency; the hook is only used when it is installed
+    pytest.importorskip("opentelemetry")
+    hook = metrics.opentelemetry_hook()
+    add_span_hook(hook)
+    try:
+        with span("parse", files=1):
+            pass
+    finally:
+        remove_span_hook(hook)
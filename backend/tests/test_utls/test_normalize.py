@@ -0,0 +1,121 @@
+from app.utils import normalize
+from app.utils.normalize import (
+    decode_chunks,
+    detect_encoding,
+    detect_language,
+    normalize_file,
+    normalize_file_async,
+    normalize_lines,
+    split_lines,
+)
+import asyncio
+import time
+import pytest
+
+
+@pytest.mark.parametrize("content, encoding", [
+    ("plain ascii".encode("utf-8"), "utf-8"),
+    ("café".encode("utf-8"), "utf-8"),
+    ("café".encode("utf-8-sig"), "utf-8-sig"),
+    ("café".encode("utf-16"), "utf-16"),
+])
+def test_detect_encoding(content, encoding):
+    assert detect_encoding(content) == encoding
+
+
+def test_detect_encoding_ignores_a_character_cut_off_by_the_sample():
+    assert detect_encoding("café".encode("utf-8")[:-1]) == "utf-8"
+
+
+def test_decoding_is_incremental_across_chunk_boundaries():
+    data = "naïve 漢字\r\nnext".encode("utf-8")
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert list(split_lines(decode_chunks(chunks, "utf-8"))) == ["naïve 漢字", "next"]
+
+
+def test_split_lines_across_pieces():
+    # A long line arriving in many pieces, and line endings split between pieces
+    assert list(split_lines(["ab"] * 1000 + ["c\r", "\nd\r", "e", "f\n"])) == ["ab" * 1000 + "c", "d", "ef"]
+    assert list(split_lines(["x\r", "y", "z"])) == ["x", "yz"]
+
+
+def test_normalize_markdown():
+    text = (
+        "#Title​\n"
+        "\n\n\n"
+        "* first item   \n"
+        "+ second\n"
+        "```\n"
+        "*   kept   \n"
+        "\n\n\n"
+        "```\n"
+        "\n"
+    )
+    assert normalize_lines(split_lines([text])) == (
+        "# Title\n"
+        "\n"
+        "- first item\n"
+        "- second\n"
+        "```\n"
+        "*   kept   \n"
+        "\n\n\n"
+        "```"
+    )
+    # Plain text keeps its markdown-looking lines
+    assert normalize_lines(["#hashtag", "* star"], markdown=False) == "#hashtag\n* star"
+
+
+def test_only_heading_like_lines_get_a_space():
+    lines = ["#Title", "###methods", "#word", "#include <stdio.h>", "#123 on the list", "#Python #AI", "#  Spaced"]
+    assert normalize_lines(lines).split("\n") == [
+        "# Title", "### methods", "#word", "#include <stdio.h>", "#123 on the list", "#Python #AI", "#  Spaced",
+    ]
+
+
+@pytest.mark.parametrize("text, language", [
+    ("The cell is the basic unit of life, and it is made of the membrane and the nucleus.", "en"),
+    ("La célula es la unidad básica de la vida y está formada por una membrana.", "es"),
+    ("La cellule est l'unité de base du vivant et elle est entourée par une membrane.", "fr"),
+    ("Die Zelle ist die kleinste Einheit des Lebens und von einer Membran umgeben.", "de"),
+    ("Клетка — элементарная единица жизни.", "ru"),
+    ("细胞是生命的基本单位。", "zh"),
+    ("12345 ...", None),
+])
+def test_detect_language(text, language):
+    assert detect_language(text)[0] == language
+
+
+def test_normalize_file_falls_back_when_later_bytes_are_not_utf8(tmp_path, monkeypatch):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"ascii start\n" + "résumé – notes".encode("cp1252"))
+    result = normalize_file(str(path), chunk_size=4)
+    assert result.encoding == "cp1252"
+    assert result.text == "ascii start\nrésumé – notes"
+
+
+@pytest.mark.asyncio
+async def test_large_files_do_not_block_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(normalize, "NORMALIZE_PROCESS_MIN_BYTES", 1024)
+    path = tmp_path / "large.md"
+    line = "The enzyme binds the substrate at the active site — café    \r\n"
+    path.write_bytes((line * 150000).encode("utf-8"))
+
+    lags = []
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - start - 0.005)
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    result = await normalize_file_async(str(path))
+    elapsed = time.perf_counter() - start
+    task.cancel()
+
+    assert result.text.count("\n") == 149999
+    assert result.language == "en"
+    # The loop kept ticking while the file was decoded on the pool
+    assert len(lags) > 5
+    assert max(lags) < max(0.1, elapsed / 2)
@@ -1,9 +1,15 @@
-from app.utils.ocr import parse_document
+from app.utils.ocr import LLAMA_CLOUD_API_KEY, ParserConfigurationError, ParserService, parse_document
 import pytest
 import asyncio
 
 
+def test_parser_service_requires_api_key():
+    with pytest.raises(ParserConfigurationError, match="LLAMA_CLOUD_API_KEY"):
+        ParserService(api_key="")
+
+
 @pytest.mark.asyncio
+@pytest.mark.skipif(not LLAMA_CLOUD_API_KEY, reason="LLAMA_CLOUD_API_KEY is not set")
 async def test_parse_document():
     document = await parse_document("tests/sample_documents/sample.pdf")
     assert document is not None
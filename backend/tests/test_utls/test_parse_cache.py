@@ -0,0 +1,278 @@
+from app.utils.parse_cache import (
+    ParseCache,
+    MemoryCacheBackend,
+    DiskCacheBackend,
+    MongoCacheBackend,
+    cache_key,
+    file_digest,
+    source_digest,
+)
+from unittest.mock import AsyncMock
+import asyncio
+import io
+import os
+import time
+import pytest
+
+SETTINGS = {"result_type": "markdown"}
+
+
+@pytest.fixture
+def sample_file(tmp_path):
+    path = tmp_path / "lecture.pdf"
+    path.write_bytes(b"%PDF- lecture one")
+    return str(path)
+
+
+def test_cache_key_depends_on_settings(sample_file):
+    digest = file_digest(sample_file)
+    assert cache_key(digest, SETTINGS) == cache_key(digest, dict(SETTINGS))
+    assert cache_key(digest, SETTINGS) != cache_key(digest, {"result_type": "text"})
+
+
+@pytest.mark.asyncio
+async def test_duplicate_upload_skips_parser(sample_file, tmp_path):
+    parser = AsyncMock(return_value="# Lecture one")
+    cache = ParseCache(MemoryCacheBackend())
+
+    # A re-upload is a different path with the same bytes
+    copy = tmp_path / "copy.pdf"
+    copy.write_bytes(open(sample_file, "rb").read())
+
+    assert await cache.parse(sample_file, parser, SETTINGS) == "# Lecture one"
+    assert await cache.parse(str(copy), parser, SETTINGS) == "# Lecture one"
+    parser.assert_awaited_once_with(sample_file)
+    assert cache.stats == {"hits": 1, "misses": 1, "errors": 0}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_share_one_parse(sample_file):
+    async def slow_parser(path):
+        await asyncio.sleep(0.05)
+        return "text"
+    parser = AsyncMock(side_effect=slow_parser)
+    cache = ParseCache(MemoryCacheBackend())
+
+    results = await asyncio.gather(*[cache.parse(sample_file, parser, SETTINGS) for _ in range(5)])
+    assert results == ["text"] * 5
+    assert parser.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_during_slow_lookup_share_one_parse(sample_file):
+    backend = MemoryCacheBackend()
+    backend_get = backend.get
+
+    async def slow_get(key):
+        # A disk or mongo lookup yields to the event loop
+        await asyncio.sleep(0.01)
+        return await backend_get(key)
+    backend.get = slow_get
+
+    async def slow_parser(path):
+        await asyncio.sleep(0.05)
+        return "text"
+    parser = AsyncMock(side_effect=slow_parser)
+    cache = ParseCache(backend)
+
+    results = await asyncio.gather(*[cache.parse(sample_file, parser, SETTINGS) for _ in range(3)])
+    assert results == ["text"] * 3
+    assert parser.await_count == 1
+    assert cache._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_parser_errors_are_not_cached(sample_file):
+    parser = AsyncMock(side_effect=[RuntimeError("boom"), "text"])
+    cache = ParseCache(MemoryCacheBackend())
+    with pytest.raises(RuntimeError):
+        await cache.parse(sample_file, parser, SETTINGS)
+    assert await cache.parse(sample_file, parser, SETTINGS) == "text"
+
+
+@pytest.mark.asyncio
+async def test_backend_errors_count_as_misses(sample_file):
+    backend = MemoryCacheBackend()
+    backend.get = AsyncMock(side_effect=ConnectionError)
+    cache = ParseCache(backend)
+    assert await cache.parse(sample_file, AsyncMock(return_value="text"), SETTINGS) == "text"
+    assert cache.stats["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_evicts_lru_by_size():
+    backend = MemoryCacheBackend(max_entries=10, max_bytes=10)
+    await backend.set("a", "aaaa")
+    await backend.set("b", "bbbb")
+    await backend.get("a")
+    await backend.set("c", "cccc")
+    assert await backend.get("a") == "aaaa"
+    assert await backend.get("b") is None
+    assert backend.size == 8
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_ttl():
+    backend = MemoryCacheBackend(ttl=0)
+    await backend.set("a", "text")
+    assert await backend.get("a") is None
+    assert backend.size == 0
+
+
+@pytest.mark.asyncio
+async def test_disk_backend_roundtrip_and_eviction(tmp_path):
+    backend = DiskCacheBackend(directory=str(tmp_path), max_bytes=10)
+    await backend.set("a", "aaaaaa")
+    # Make the first entry the least recently used
+    os.utime(tmp_path / "a.md", (time.time() - 60, time.time() - 60))
+    await backend.set("b", "bbbbbb")
+    assert await backend.get("a") is None
+    assert await backend.get("b") == "bbbbbb"
+
+
+@pytest.mark.asyncio
+async def test_disk_backend_ttl(tmp_path):
+    backend = DiskCacheBackend(directory=str(tmp_path), ttl=30)
+    await backend.set("a", "text")
+    os.utime(tmp_path / "a.md", (time.time() - 60, time.time() - 60))
+    assert await backend.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_mongo_backend(async_mongo):
+    # Room for two 6-byte entries
+    backend = MongoCacheBackend(collection=async_mongo.parse_cache, max_bytes=12)
+    await backend.set("a", "text a")
+    await backend.set("b", "text b")
+    await backend.set("c", "text c")
+    assert await backend.get("a") is None
+    assert await backend.get("c") == "text c"
+    assert async_mongo.parse_cache.sync.count_documents({}) == 2
+    assert backend.size == 12
+
+    # Replacing an entry only counts the difference, which here evicts b
+    await backend.set("c", "text c2")
+    assert backend.size == 7
+    assert await backend.get("b") is None
+    # An entry larger than the whole cache is never stored
+    await backend.set("huge", "x" * 100)
+    assert await backend.get("huge") is None
+
+    expired = MongoCacheBackend(collection=async_mongo.parse_cache, ttl=-1)
+    await expired.set("d", "text d")
+    assert await expired.get("d") is None
+
+
+@pytest.mark.asyncio
+async def test_mongo_backend_uses_the_connected_database(async_mongo):
+    import mongomock
+    from app.db import database
+    from benchmarks.mock_db import AsyncMockDatabase
+
+    # Built before the lifespan connects, as get_parse_cache() may be
+    backend = MongoCacheBackend()
+    database.use(async_mongo)
+    try:
+        await backend.set("a", "text a")
+        assert async_mongo.parse_cache.sync.count_documents({}) == 1
+        other = AsyncMockDatabase(mongomock.MongoClient()["other"])
+        database.use(other)
+        assert await backend.get("a") is None
+    finally:
+        database.close()
+
+
+@pytest.mark.asyncio
+async def test_parse_many_batches_only_misses(tmp_path):
+    paths = []
+    for name, content in [("a.pdf", b"a"), ("b.pdf", b"b"), ("b2.pdf", b"b"), ("c.pdf", b"c")]:
+        (tmp_path / name).write_bytes(content)
+        paths.append(str(tmp_path / name))
+    cache = ParseCache(MemoryCacheBackend())
+    await cache.parse(paths[0], AsyncMock(return_value="text a"), SETTINGS)
+
+    batch_parser = AsyncMock(return_value=["text b", RuntimeError("c failed")])
+    with pytest.raises(RuntimeError, match="c failed"):
+        await cache.parse_many(paths, batch_parser, SETTINGS)
+    # a.pdf was cached and b2.pdf duplicates b.pdf, so only b and c are parsed
+    batch_parser.assert_awaited_once_with([paths[1], paths[3]])
+
+    # The successful parse was cached before the failure was raised
+    batch_parser = AsyncMock(return_value=["text c"])
+    assert await cache.parse_many(paths, batch_parser, SETTINGS) == ["text a", "text b", "text b", "text c"]
+    batch_parser.assert_awaited_once_with([paths[3]])
+
+
+@pytest.mark.asyncio
+async def test_parse_many_shares_parses_in_flight(tmp_path):
+    paths = []
+    for name, content in [("a.pdf", b"a"), ("b.pdf", b"b"), ("c.pdf", b"c")]:
+        (tmp_path / name).write_bytes(content)
+        paths.append(str(tmp_path / name))
+
+    async def slow_parser(path):
+        await asyncio.sleep(0.05)
+        return f"single {os.path.basename(path)}"
+
+    async def slow_batch_parser(batch):
+        await asyncio.sleep(0.05)
+        return [f"batch {os.path.basename(path)}" for path in batch]
+    parser = AsyncMock(side_effect=slow_parser)
+    batch_parser = AsyncMock(side_effect=slow_batch_parser)
+    cache = ParseCache(MemoryCacheBackend())
+
+    # a.pdf is being parsed on its own as the first batch starts, and the second batch
+    # starts while the first is still parsing
+    single = asyncio.create_task(cache.parse(paths[0], parser, SETTINGS))
+    await asyncio.sleep(0)
+    first = asyncio.create_task(cache.parse_many(paths[:2], batch_parser, SETTINGS))
+    await asyncio.sleep(0.01)
+    second = await cache.parse_many(paths, batch_parser, SETTINGS)
+
+    assert await single == "single a.pdf"
+    assert await first == ["single a.pdf", "batch b.pdf"]
+    assert second == ["single a.pdf", "batch b.pdf", "batch c.pdf"]
+    parser.assert_awaited_once_with(paths[0])
+    assert batch_parser.await_args_list[0].args == ([paths[1]],)
+    assert batch_parser.await_args_list[1].args == ([paths[2]],)
+    assert cache._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_parse_waits_for_a_failing_batch(tmp_path):
+    path = tmp_path / "a.pdf"
+    path.write_bytes(b"a")
+
+    async def failing_batch_parser(batch):
+        await asyncio.sleep(0.05)
+        return [RuntimeError("a failed")]
+    cache = ParseCache(MemoryCacheBackend())
+    batch = asyncio.create_task(cache.parse_many([str(path)], failing_batch_parser, SETTINGS, return_exceptions=True))
+    await asyncio.sleep(0.01)
+    parser = AsyncMock(return_value="text")
+    with pytest.raises(RuntimeError, match="a failed"):
+        await cache.parse(str(path), parser, SETTINGS)
+    assert isinstance((await batch)[0], RuntimeError)
+    parser.assert_not_awaited()
+    # Failures are not cached
+    assert await cache.parse(str(path), parser, SETTINGS) == "text"
+
+
+@pytest.mark.asyncio
+async def test_in_memory_sources_share_entries_with_files(sample_file):
+    content = open(sample_file, "rb").read()
+    assert await source_digest(sample_file) == file_digest(sample_file)
+    assert await source_digest(content) == file_digest(sample_file)
+    assert await source_digest(memoryview(content)) == file_digest(sample_file)
+
+    buffer = io.BytesIO(content)
+    buffer.seek(3)
+    assert await source_digest(buffer) == file_digest(sample_file)
+    # Hashing leaves the buffer at its start for the parser
+    assert buffer.tell() == 0
+
+    parser = AsyncMock(return_value="# Lecture one")
+    cache = ParseCache(MemoryCacheBackend())
+    assert await cache.parse(buffer, parser, SETTINGS) == "# Lecture one"
+    assert await cache.parse(sample_file, parser, SETTINGS) == "# Lecture one"
+    parser.assert_awaited_once_with(buffer)
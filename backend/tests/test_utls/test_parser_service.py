@@ -0,0 +1,160 @@
+from app.utils import staging
+from app.utils.ocr import ParserService, parser_input
+from llama_parse import LlamaParse
+from types import SimpleNamespace
+from unittest.mock import patch
+import io
+import os
+import pytest
+import tempfile
+
+
+def doc(text):
+    return SimpleNamespace(text=text)
+
+
+@pytest.mark.asyncio
+async def test_parser_service_reuses_one_http_client():
+    service = ParserService(api_key="llx-test")
+    assert service.parser.custom_client is service.http_client
+    assert service.batch_parser.custom_client is service.http_client
+    assert service.batch_parser.ignore_errors and not service.parser.ignore_errors
+    await service.aclose()
+    assert service.http_client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_parse_many_sends_one_batch():
+    service = ParserService(api_key="llx-test")
+    calls = []
+
+    async def aload_data(self, file_path, *args, **kwargs):
+        calls.append(file_path)
+        return [doc(f"text of {path}") for path in file_path]
+
+    with patch.object(LlamaParse, "aload_data", aload_data):
+        results = await service.parse_many(["a.pdf", "b.pdf"])
+    assert results == ["text of a.pdf", "text of b.pdf"]
+    assert calls == [["a.pdf", "b.pdf"]]
+    await service.aclose()
+
+
+@pytest.mark.asyncio
+async def test_parse_many_falls_back_per_file_on_partial_failure():
+    service = ParserService(api_key="llx-test")
+    error = RuntimeError("bad file")
+
+    async def aload_data(self, file_path, *args, **kwargs):
+        if isinstance(file_path, list):
+            # b.pdf failed, so the batch only returns one document
+            return [doc("text of a.pdf")]
+        if file_path == "b.pdf":
+            raise error
+        return [doc(f"text of {file_path}")]
+
+    with patch.object(LlamaParse, "aload_data", aload_data):
+        results = await service.parse_many(["a.pdf", "b.pdf"])
+    assert results == ["text of a.pdf", error]
+    await service.aclose()
+
+
+@pytest.mark.asyncio
+async def test_parse_sends_buffers_without_copies():
+    service = ParserService(api_key="llx-test")
+    calls = []
+
+    async def aload_data(self, file_path, extra_info=None):
+        calls.append((file_path, extra_info))
+        return [doc(f"text of {extra_info['file_name']}")]
+
+    content = b"%PDF- scanned"
+    buffer = io.BytesIO(content)
+    buffer.name = "/staging/x/notes.pdf"
+    buffer.read()
+    with patch.object(LlamaParse, "aload_data", aload_data):
+        assert await service.parse(content, "a.pdf") == "text of a.pdf"
+        assert await service.parse(memoryview(content), "b.pdf") == "text of b.pdf"
+        assert await service.parse(buffer) == "text of notes.pdf"
+    assert calls[0][0] is content and calls[1][0] is content
+    # Buffers are passed as they are, rewound
+    assert calls[2][0] is buffer and buffer.tell() == 0
+    with pytest.raises(ValueError):
+        await service.parse(b"no name")
+    await service.aclose()
+
+
+@pytest.mark.asyncio
+async def test_other_file_objects_use_one_spooled_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(staging, "STAGING_DIR", str(tmp_path))
+    source = tempfile.SpooledTemporaryFile()
+    source.write(b"%PDF- spooled")
+    async with parser_input(source, "lecture.pdf") as (file_input, extra_info):
+        assert extra_info is None
+        assert os.path.basename(file_input) == "lecture.pdf"
+        assert open(file_input, "rb").read() == b"%PDF- spooled"
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_parse_many_mixes_paths_and_buffers():
+    service = ParserService(api_key="llx-test")
+    calls = []
+
+    async def aload_data(self, file_path, extra_info=None):
+        calls.append((file_path, extra_info))
+        return [doc(f"text of {getattr(path, 'name', path)}") for path in file_path]
+
+    buffers = []
+    for name in ["a.pages-1-3.pdf", "a.pages-7-9.pdf"]:
+        buffers.append(io.BytesIO(b"%PDF- pages"))
+        buffers[-1].name = name
+    with patch.object(LlamaParse, "aload_data", aload_data):
+        results = await service.parse_many(["a.pdf", buffers[0], "b.pdf", buffers[1], b"no name"])
+    assert results[:4] == ["text of a.pdf", "text of a.pages-1-3.pdf", "text of b.pdf", "text of a.pages-7-9.pdf"]
+    assert isinstance(results[4], ValueError)
+    # Paths go as one batch, buffers of one type as another
+    assert (["a.pdf", "b.pdf"], None) in calls
+    assert (buffers, {"file_name": "a.pages-1-3.pdf"}) in calls
+    await service.aclose()
+
+
+def split_pages(pages):
+    """
+    aload_data that behaves like LlamaParse on files of pages[name] pages: one document
+    per page with split_by_page on, one per file otherwise; files with no entry fail
+    """
+    async def aload_data(self, file_path, extra_info=None):
+        documents = []
+        for path in file_path if isinstance(file_path, list) else [file_path]:
+            name = getattr(path, "name", None) or (extra_info or {}).get("file_name") or path
+            if name not in pages:
+                if self.ignore_errors:
+                    continue
+                raise RuntimeError(f"cannot parse {name}")
+            texts = [f"{name} page {page}" for page in range(1, pages[name] + 1)]
+            documents += [doc(text) for text in texts] if self.split_by_page else [doc("\n---\n".join(texts))]
+        return documents
+    return aload_data
+
+
+@pytest.mark.asyncio
+async def test_multi_page_files_keep_every_page():
+    service = ParserService(api_key="llx-test")
+    assert not service.parser.split_by_page and not service.batch_parser.split_by_page
+    buffer = io.BytesIO(b"%PDF- pages")
+    buffer.name = "scan.pages-0-3.pdf"
+    with patch.object(LlamaParse, "aload_data", split_pages({"a.pdf": 2, "scan.pages-0-3.pdf": 3})):
+        assert await service.parse("a.pdf") == "a.pdf page 1\n---\na.pdf page 2"
+        # A two-page file batched with one that fails is not matched to the wrong file
+        results = await service.parse_many(["a.pdf", "broken.pdf", buffer])
+    assert results[0] == "a.pdf page 1\n---\na.pdf page 2"
+    assert isinstance(results[1], RuntimeError)
+    assert results[2].split("\n---\n") == [f"scan.pages-0-3.pdf page {page}" for page in [1, 2, 3]]
+    await service.aclose()
+
+    # Even if the parser returns pages, parse() keeps all of them
+    service = ParserService(api_key="llx-test")
+    service.parser = service.parser.model_copy(update={"split_by_page": True})
+    with patch.object(LlamaParse, "aload_data", split_pages({"a.pdf": 2})):
+        assert await service.parse("a.pdf") == "a.pdf page 1\n\na.pdf page 2"
+    await service.aclose()
@@ -0,0 +1,88 @@
+from app.utils.quiz_cache import QuizCache, document_version, quiz_fingerprint
+from bson import ObjectId
+from datetime import datetime
+import pytest
+
+PARAMS = {"num_questions": 10, "model": "fake"}
+
+
+@pytest.fixture
+def quizzes(async_mongo):
+    return async_mongo.quizzes
+
+
+def ready_quiz(subject_id, key) -> dict:
+    return {
+        "_id": ObjectId(), "subject_ids": [subject_id], "status": "ready", "created_at": datetime.now(),
+        "questions": [], "metadata": {"cache_key": key},
+    }
+
+
+def test_fingerprint_tracks_documents_and_params():
+    subject = {"_id": ObjectId(), "documents": [{"id": ObjectId()}, {"id": ObjectId()}]}
+    other = {"_id": ObjectId(), "documents": []}
+    key = quiz_fingerprint([subject, other], PARAMS)
+    assert quiz_fingerprint([other, {**subject, "documents": subject["documents"][::-1]}], PARAMS) == key
+    assert quiz_fingerprint([subject, other], {**PARAMS, "num_questions": 5}) != key
+    assert quiz_fingerprint([{**subject, "documents": subject["documents"][:1]}, other], PARAMS) != key
+
+
+def test_fingerprint_tracks_document_versions():
+    def subject(metadata=None):
+        version = document_version({"metadata": metadata}) if metadata else None
+        return {"_id": subject_id, "documents": [{"id": document_id, "version": version}]}
+
+    subject_id, document_id = ObjectId(), ObjectId()
+    key = quiz_fingerprint([subject({"status": "parsing", "pages_parsed": 10})], PARAMS)
+    # More ranges of a split PDF, then the finished document
+    assert quiz_fingerprint([subject({"status": "parsing", "pages_parsed": 20})], PARAMS) != key
+    assert quiz_fingerprint([subject()], PARAMS) != key
+
+
+@pytest.mark.asyncio
+async def test_lookup_falls_back_to_stored_quizzes(quizzes):
+    subject_id = ObjectId()
+    quiz = ready_quiz(subject_id, "key")
+    quizzes.sync.insert_one(quiz)
+    quizzes.sync.insert_one({**ready_quiz(subject_id, "failed"), "status": "failed"})
+
+    cache = QuizCache()
+    assert (await cache.lookup("key", quizzes))["_id"] == quiz["_id"]
+    assert await cache.lookup("failed", quizzes) is None
+    # Served from memory from now on
+    quizzes.sync.delete_many({})
+    assert (await cache.lookup("key", quizzes))["_id"] == quiz["_id"]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+@pytest.mark.asyncio
+async def test_pending_quizzes_are_shared(quizzes):
+    cache = QuizCache()
+    quiz_id = ObjectId()
+    cache.pending("key", quiz_id)
+    assert await cache.lookup("key", quizzes) == {"_id": quiz_id, "status": "pending"}
+    cache.settle("key")
+    assert await cache.lookup("key", quizzes) is None
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction(quizzes):
+    cache = QuizCache(max_entries=2)
+    for key in ["a", "b", "c"]:
+        cache.remember(ready_quiz(ObjectId(), key))
+    assert await cache.lookup("a", quizzes) is None
+    assert await cache.lookup("c", quizzes) is not None
+
+
+@pytest.mark.asyncio
+async def test_invalidate_subject(quizzes):
+    subject_id, other_id = ObjectId(), ObjectId()
+    cache = QuizCache()
+    for quiz in [ready_quiz(subject_id, "a"), ready_quiz(other_id, "b")]:
+        quizzes.sync.insert_one(quiz)
+        cache.remember(quiz)
+
+    await cache.invalidate_subject(subject_id, quizzes)
+    assert await cache.lookup("a", quizzes) is None
+    assert await cache.lookup("b", quizzes) is not None
+    assert "cache_key" not in quizzes.sync.find_one({"subject_ids": subject_id})["metadata"]
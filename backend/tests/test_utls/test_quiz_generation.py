@@ -0,0 +1,216 @@
+from app.db.database import Database
+from app.db.schemas import Quiz
+from app.utils import vector_index
+from app.utils.quiz_generation import QuestionDeduper, generate_quiz
+from app.utils.quiz_models import FakeQuizModel, RateLimitedModel, RateLimiter, parse_questions
+from app.utils.vector_index import index_documents
+from bson import ObjectId
+from datetime import datetime
+import asyncio
+import numpy as np
+import time
+import pytest
+
+WORDS = ["membrane", "nucleus", "ribosome", "chloroplast", "vacuole", "cytoplasm", "enzyme", "protein",
+         "glucose", "oxygen", "nitrogen", "mitosis", "meiosis", "genome", "allele", "species", "habitat",
+         "predator", "bacteria", "fungus", "pollen", "nectar", "xylem", "phloem", "stomata", "cortex"]
+# Every sentence draws on different vocabulary, so the generated questions are not near-duplicates
+MATERIAL = " ".join(
+    f"The {a} depends on {b} while {c} regulates {d} near the {e}."
+    for a, b, c, d, e in zip(WORDS, WORDS[3:] + WORDS[:3], WORDS[7:] + WORDS[:7], WORDS[11:] + WORDS[:11], WORDS[17:] + WORDS[:17])
+)
+
+
+@pytest.fixture(autouse=True)
+def index_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(vector_index, "EMBEDDING_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(vector_index, "_indexes", {})
+
+
+@pytest.fixture
+def db(async_mongo):
+    return Database.of(async_mongo)
+
+
+@pytest.fixture
+def quizzes(db):
+    return db.quizzes
+
+
+async def pending_quiz(quizzes, subject_id) -> ObjectId:
+    now = datetime.now()
+    quiz = Quiz(subject_ids=[subject_id], created_at=now, updated_at=now, questions=[], metadata={})
+    await quizzes.insert_one(quiz.model_dump(by_alias=True))
+    return quiz.id
+
+
+def test_deduper_drops_near_identical_questions():
+    deduper = QuestionDeduper()
+    kept = deduper.filter([
+        {"question": "What does the mitochondria produce for the cell?"},
+        {"question": "What does the mitochondria produce for the cell ?"},
+        {"question": "Which organelle stores genetic information?"},
+    ])
+    assert [q["question"] for q in kept] == [
+        "What does the mitochondria produce for the cell?",
+        "Which organelle stores genetic information?",
+    ]
+    assert deduper.filter([{"question": "Which organelle stores genetic information?"}]) == []
+
+
+def test_parse_questions_drops_malformed_entries():
+    reply = 'Here you go: [{"question": "Q1", "choices": ["a", "b"], "answer": "a"}, {"question": "Q2", "choices": ["a"], "answer": "c"}]'
+    assert parse_questions(reply) == [{"question": "Q1", "choices": ["a", "b"], "answer": "a", "explanation": None}]
+    assert parse_questions("no json") == []
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        await limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_generate_quiz_streams_batches(quizzes, db):
+    subject_id = ObjectId()
+    await index_documents(subject_id, [{"_id": ObjectId(), "filename": "notes.md", "ocr_text": MATERIAL}])
+    quiz_id = await pending_quiz(quizzes, subject_id)
+
+    class StaggeredModel(FakeQuizModel):
+        """Each call is slower than the last, so batches land one at a time."""
+        started = 0
+
+        async def generate(self, context, count):
+            self.started += 1
+            await asyncio.sleep(0.05 * self.started)
+            return await super().generate(context, count)
+
+    model = RateLimitedModel(StaggeredModel(), max_concurrency=8, requests_per_second=1000)
+    task = asyncio.create_task(generate_quiz(quiz_id, [subject_id], 12, model=model, db=db))
+
+    # The first batch is stored while later ones are still being generated
+    while not (await quizzes.find_one({"_id": quiz_id}))["questions"]:
+        await asyncio.sleep(0.01)
+    partial = await quizzes.find_one({"_id": quiz_id})
+    assert partial["status"] == "pending"
+    await task
+
+    quiz = await quizzes.find_one({"_id": quiz_id})
+    assert quiz["status"] == "ready"
+    assert len(partial["questions"]) < len(quiz["questions"]) <= 12
+    # ceil(12 / QUIZ_BATCH_SIZE) sections, fewer if the subject has fewer chunks
+    assert model.model.calls == min(3, len(vector_index.get_subject_index(subject_id)))
+    assert all(isinstance(q["id"], str) for q in quiz["questions"])
+
+
+@pytest.mark.asyncio
+async def test_generate_quiz_indexes_older_subjects(quizzes, db, async_mongo):
+    subject_id = ObjectId()
+    async_mongo.documents.sync.insert_one({"_id": ObjectId(), "subject_id": subject_id, "filename": "a.md", "ocr_text": MATERIAL})
+    quiz_id = await pending_quiz(quizzes, subject_id)
+    await generate_quiz(quiz_id, [subject_id], 3, model=FakeQuizModel(), db=db)
+    quiz = await quizzes.find_one({"_id": quiz_id})
+    assert quiz["status"] == "ready"
+    assert len(quiz["questions"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_generate_quiz_marks_failures(quizzes, db):
+    subject_id = ObjectId()
+    await index_documents(subject_id, [{"_id": ObjectId(), "filename": "notes.md", "ocr_text": MATERIAL}])
+    quiz_id = await pending_quiz(quizzes, subject_id)
+
+    class BrokenModel(FakeQuizModel):
+        async def generate(self, context, count):
+            raise RuntimeError("model unavailable")
+
+    with pytest.raises(RuntimeError):
+        await generate_quiz(quiz_id, [subject_id], 3, model=BrokenModel(), db=db)
+    quiz = await quizzes.find_one({"_id": quiz_id})
+    assert quiz["status"] == "failed"
+    assert quiz["metadata"]["error"] == "model unavailable"
+
+
+@pytest.mark.asyncio
+async def test_first_question_does_not_wait_for_the_whole_subject(quizzes, db, async_mongo, monkeypatch):
+    """An older subject is indexed in the background; the quiz starts once one batch is searchable."""
+    from app.utils import quiz_generation
+    monkeypatch.setattr(quiz_generation, "QUIZ_INDEX_BATCH_DOCUMENTS", 2)
+    subject_id = ObjectId()
+    async_mongo.documents.sync.insert_many([
+        {"_id": ObjectId(), "subject_id": subject_id, "filename": f"{i}.md", "ocr_text": MATERIAL} for i in range(6)
+    ])
+    release = asyncio.Event()
+    index_documents = quiz_generation.index_documents
+    batches = []
+
+    async def slow_index_documents(subject_id, documents):
+        # Every batch after the first waits until the quiz is done
+        if batches:
+            await release.wait()
+        batches.append(len(documents))
+        return await index_documents(subject_id, documents)
+
+    monkeypatch.setattr(quiz_generation, "index_documents", slow_index_documents)
+    quiz_id = await pending_quiz(quizzes, subject_id)
+    await asyncio.wait_for(generate_quiz(quiz_id, [subject_id], 3, model=FakeQuizModel(), db=db), 5)
+    assert (await quizzes.find_one({"_id": quiz_id}))["status"] == "ready"
+    index = vector_index.get_subject_index(subject_id)
+    assert batches == [2] and index.incomplete
+
+    release.set()
+    task, _ = quiz_generation._backfills[str(subject_id)]
+    await task
+    assert len(index.document_ids()) == 6
+    assert not index.incomplete
+
+
+@pytest.mark.asyncio
+async def test_interrupted_indexing_is_resumed(db, async_mongo):
+    from app.utils.quiz_generation import _backfills, ensure_indexed
+    subject_id = ObjectId()
+    documents = [{"_id": ObjectId(), "subject_id": subject_id, "filename": f"{i}.md", "ocr_text": MATERIAL} for i in range(3)]
+    async_mongo.documents.sync.insert_many(documents)
+    # A restart left the index with one document and the marker still set
+    index = vector_index.get_subject_index(subject_id)
+    await index_documents(subject_id, documents[:1])
+    index.mark_incomplete()
+
+    await ensure_indexed(subject_id, db)
+    while str(subject_id) in _backfills:
+        await asyncio.sleep(0.01)
+    assert index.document_ids() == {str(document["_id"]) for document in documents}
+    assert len(index.segments) == 2
+    assert not index.incomplete
+
+
+@pytest.mark.asyncio
+async def test_subject_indexed_by_another_embedder_is_indexed_again(db, async_mongo):
+    from app.utils.quiz_generation import _backfills, ensure_indexed
+    subject_id = ObjectId()
+    document = {"_id": ObjectId(), "subject_id": subject_id, "filename": "a.md", "ocr_text": MATERIAL}
+    async_mongo.documents.sync.insert_one(document)
+    index = vector_index.get_subject_index(subject_id)
+    index.add(np.ones((1, 8), dtype=np.float32), ["old"], [0], [{"document_id": str(document["_id"]), "filename": "a.md"}], "openai:old-model")
+
+    await ensure_indexed(subject_id, db)
+    while str(subject_id) in _backfills:
+        await asyncio.sleep(0.01)
+    assert {segment.embedder for segment in index.segments} == {"hashing"}
+    assert index.document_ids() == {str(document["_id"])}
+
+
+@pytest.mark.asyncio
+async def test_section_material_gathers_related_chunks():
+    from app.utils.quiz_generation import section_material
+    subject_id = ObjectId()
+    await index_documents(subject_id, [
+        {"_id": ObjectId(), "filename": "cells.md", "ocr_text": "Mitosis divides the cell nucleus into two nuclei."},
+        {"_id": ObjectId(), "filename": "war.md", "ocr_text": "The treaty ended the war between the empires."},
+        {"_id": ObjectId(), "filename": "more.md", "ocr_text": "During mitosis the nucleus divides and the cell splits."},
+    ])
+    material = await section_material(subject_id, "Mitosis divides the cell nucleus into two nuclei.", max_chars=110)
+    assert material == "Mitosis divides the cell nucleus into two nuclei.\n\nDuring mitosis the nucleus divides and the cell splits."
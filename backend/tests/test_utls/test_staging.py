@@ -0,0 +1,80 @@
+from app.utils import staging
+from app.utils.staging import stage_uploads, StagingBudget
+from fastapi import HTTPException, UploadFile
+import tempfile
+import os
+import time
+import pytest
+
+CHUNK = 1024 * 1024
+
+
+def make_upload(filename, size):
+    """Build an UploadFile backed by an on-disk spool, like Starlette does for large bodies."""
+    spool = tempfile.SpooledTemporaryFile(max_size=0)
+    block = os.urandom(CHUNK)
+    written = 0
+    while written < size:
+        n = min(CHUNK, size - written)
+        spool.write(block[:n])
+        written += n
+    spool.seek(0)
+    return UploadFile(file=spool, filename=filename, size=size)
+
+
+@pytest.fixture(autouse=True)
+def staging_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(staging, "STAGING_DIR", str(tmp_path))
+    monkeypatch.setattr(staging, "CHUNK_SIZE", CHUNK)
+    monkeypatch.setattr(staging, "budget", StagingBudget(staging.MAX_PROCESS_BYTES))
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_stage_uploads_releases_budget(staging_dir):
+    staged_files = await stage_uploads([make_upload("a.txt", 10), make_upload("b.PDF", 20)])
+    assert [s.ext for s in staged_files] == [".txt", ".pdf"]
+    assert staging.budget.used == 30
+    for staged in staged_files:
+        staged.release()
+        staged.release()
+    assert staging.budget.used == 0
+    assert os.listdir(staging_dir) == []
+
+
+@pytest.mark.asyncio
+async def test_stage_uploads_request_limit(monkeypatch, staging_dir):
+    monkeypatch.setattr(staging, "MAX_REQUEST_BYTES", 2 * CHUNK)
+    with pytest.raises(HTTPException) as exc:
+        await stage_uploads([make_upload("a.pdf", CHUNK), make_upload("b.pdf", 2 * CHUNK)])
+    assert exc.value.status_code == 413
+    assert staging.budget.used == 0
+    assert os.listdir(staging_dir) == []
+
+
+@pytest.mark.asyncio
+async def test_stage_uploads_process_limit(monkeypatch):
+    monkeypatch.setattr(staging, "budget", StagingBudget(CHUNK))
+    with pytest.raises(HTTPException) as exc:
+        await stage_uploads([make_upload("a.pdf", 2 * CHUNK)])
+    assert exc.value.status_code == 503
+    assert "Retry-After" in exc.value.headers
+    assert staging.budget.used == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_files_stay_on_disk_without_holding_the_budget(staging_dir):
+    kept, lost = await stage_uploads([make_upload("a.pdf", 10), make_upload("b.pdf", 20)])
+    kept.unreserve()
+    assert staging.budget.used == 20
+    assert os.path.exists(kept.path)
+    # Releasing the file later does not credit its bytes twice
+    kept.release()
+    assert staging.budget.used == 20
+
+    # A file whose owner never released it is credited back when its directory is swept
+    old = time.time() - staging.STAGING_TTL - 60
+    os.utime(os.path.dirname(lost.path), (old, old))
+    assert staging.sweep_staging_area() == 1
+    assert staging.budget.used == 0
+    assert os.listdir(staging_dir) == []
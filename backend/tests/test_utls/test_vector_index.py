@@ -0,0 +1,128 @@
+from app.utils.embeddings import HashingEmbedder, chunk_text
+from app.utils import vector_index
+from app.utils.vector_index import SubjectIndex, index_documents, retrieve
+from bson import ObjectId
+import numpy as np
+import time
+import pytest
+
+PHOTOSYNTHESIS = "Photosynthesis converts light energy into chemical energy in the chloroplast."
+MITOSIS = "Mitosis is cell division producing two identical daughter cells with the same chromosomes."
+TREATY = "The Treaty of Versailles ended the First World War and imposed reparations on Germany."
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "EMBEDDING_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(vector_index, "_indexes", {})
+    return tmp_path
+
+
+def test_chunk_text_respects_size_and_overlaps():
+    paragraphs = [f"Paragraph {i} " + "word " * 40 for i in range(20)]
+    chunks = chunk_text("\n\n".join(paragraphs), chunk_chars=500, overlap=100)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 500 + 100 for chunk in chunks)
+    # Every paragraph survives chunking
+    assert all(any(p.strip() in chunk for chunk in chunks) for p in paragraphs)
+
+
+def test_chunk_text_cuts_long_paragraphs():
+    chunks = chunk_text("word " * 1000, chunk_chars=300, overlap=0)
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    assert sum(chunk.count("word") for chunk in chunks) == 1000
+
+
+def test_hashing_embedder_is_deterministic_and_normalised():
+    embedder = HashingEmbedder(dim=64)
+    a = embedder.embed_sync([PHOTOSYNTHESIS, ""])
+    b = HashingEmbedder(dim=64).embed_sync([PHOTOSYNTHESIS, ""])
+    assert a.dtype == np.float32 and a.shape == (2, 64)
+    assert np.array_equal(a, b)
+    assert np.isclose(np.linalg.norm(a[0]), 1.0)
+    assert not a[1].any()
+
+
+@pytest.mark.asyncio
+async def test_index_and_retrieve_top_chunks():
+    subject_id = ObjectId()
+    docs = [
+        {"_id": ObjectId(), "filename": "bio.md", "ocr_text": f"{PHOTOSYNTHESIS}\n\n{MITOSIS}"},
+        {"_id": ObjectId(), "filename": "history.md", "ocr_text": TREATY},
+    ]
+    # Two ingestion batches become two segments
+    assert await index_documents(subject_id, docs[:1]) == 1
+    assert await index_documents(subject_id, docs[1:]) == 1
+
+    results = await retrieve(subject_id, "treaty reparations germany", k=1)
+    assert results[0]["filename"] == "history.md"
+    assert results[0]["document_id"] == str(docs[1]["_id"])
+    assert results[0]["text"] == TREATY
+
+
+@pytest.mark.asyncio
+async def test_index_is_memory_mapped_and_shared_across_instances(index_dir):
+    subject_id = ObjectId()
+    await index_documents(subject_id, [{"_id": ObjectId(), "filename": "a.md", "ocr_text": MITOSIS}])
+
+    # A fresh instance, e.g. in another worker process, maps the same files
+    index = SubjectIndex(subject_id, root=str(index_dir))
+    index.refresh()
+    assert len(index) == 1
+    assert isinstance(index.segments[0].vectors, np.memmap)
+
+
+def test_search_is_fast_on_large_index(index_dir):
+    rng = np.random.default_rng(0)
+    dim = 384
+    n = 20000
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = SubjectIndex("large", root=str(index_dir))
+    index.add(vectors, [f"chunk {i}" for i in range(n)], [0] * n, [{"document_id": "d", "filename": "f"}])
+
+    query = vectors[1234]
+    assert index.search(query, k=5)[0]["text"] == "chunk 1234"
+    start = time.perf_counter()
+    for _ in range(20):
+        index.search(query, k=5)
+    # Generous bound so the test is stable on slow machines
+    assert (time.perf_counter() - start) / 20 < 0.05
+
+
+def test_compact_merges_segments(index_dir):
+    embedder = HashingEmbedder()
+    index = SubjectIndex("compact", root=str(index_dir))
+    for i, text in enumerate([PHOTOSYNTHESIS, MITOSIS, TREATY]):
+        index.add(embedder.embed_sync([text]), [text], [0], [{"document_id": str(i), "filename": f"{i}.md"}])
+    assert len(index.segments) == 3
+    index.compact()
+    assert len(index.segments) == 1
+    assert len(index) == 3
+    result = index.search(embedder.embed_sync(["cell division chromosomes"])[0], k=1)[0]
+    assert result["document_id"] == "1"
+
+
+def test_search_skips_segments_of_another_embedder(index_dir, caplog):
+    embedder = HashingEmbedder()
+    index = SubjectIndex("mixed", root=str(index_dir))
+    index.add(embedder.embed_sync([MITOSIS]), [MITOSIS], [0], [{"document_id": "hashed", "filename": "a.md"}])
+    index.add(embedder.embed_sync([PHOTOSYNTHESIS]), [PHOTOSYNTHESIS], [0], [{"document_id": "other", "filename": "b.md"}], "openai:text-embedding-3-small")
+    index.add(np.ones((1, 16), dtype=np.float32), [TREATY], [0], [{"document_id": "narrow", "filename": "c.md"}], "hashing")
+    query = embedder.embed_sync(["cell division"])[0]
+
+    with caplog.at_level("WARNING", logger="app.utils.vector_index"):
+        assert [result["document_id"] for result in index.search(query, k=3, embedder="hashing")] == ["hashed"]
+    assert len(caplog.records) == 2
+    # Without an embedder only the dimensions are checked
+    assert {result["document_id"] for result in index.search(query, k=3)} == {"hashed", "other"}
+
+    # Merging keeps each embedder's vectors apart
+    index.add(embedder.embed_sync([TREATY]), [TREATY], [0], [{"document_id": "treaty", "filename": "d.md"}])
+    index.compact()
+    assert sorted((segment.embedder, segment.dim) for segment in index.segments) == [
+        ("hashing", 16), ("hashing", 384), ("openai:text-embedding-3-small", 384),
+    ]
+
+    assert index.drop_stale("hashing") == 1
+    assert index.document_ids() == {"hashed", "narrow", "treaty"}